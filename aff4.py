@@ -22,15 +22,19 @@ from builtins import str
 from builtins import object
 
 import argparse
+import contextlib
+import functools
+import io
 import sys, os, errno, shutil, uuid
 import time
 import logging
+from multiprocessing.pool import ThreadPool
 
 from pyaff4 import container, version
 from pyaff4 import lexicon, logical, escaping
 from pyaff4 import rdfvalue, hashes, utils
 from pyaff4 import block_hasher, data_store, linear_hasher, zip
-from pyaff4 import aff4_map
+from pyaff4 import aff4_map, extraction, ingest, verifier
 
 #logging.basicConfig(level=logging.DEBUG)
 
@@ -139,6 +143,9 @@ class VerificationListener(object):
     def onValidBlockHash(self, a):
         pass
 
+    def onValidBlockHashes(self, imageStreamURI, offset, count, digests):
+        pass
+
     def onInvalidBlockHash(self, a, b, imageStreamURI, offset):
         self.results.append("Invalid block hash comarison for stream %s at offset %d" % (imageStreamURI, offset))
 
@@ -148,6 +155,10 @@ class VerificationListener(object):
     def onInvalidHash(self, typ, a, b, streamURI):
         self.results.append("Invalid %s comarison for stream %s" % (typ, streamURI))
 
+    def onSpotCheck(self, imageStreamURI, sampled, total, probability):
+        self.results.append("Spot check of %s verified %d of %d blocks. Detection probability = %.4f" % (
+            imageStreamURI, sampled, total, probability))
+
 class LinearVerificationListener(object):
     def __init__(self):
         self.results = []
@@ -172,7 +183,12 @@ def trimVolume(volume, image):
         return image
 
 
-def verify(file, password):
+def makeSpotCheck(confidence):
+    if confidence is None:
+        return None
+    return block_hasher.SpotCheck(confidence=confidence)
+
+def verify(file, password, spot_check=None):
     with container.Container.openURNtoContainer(rdfvalue.URN.FromFileName(file)) as volume:
         if password != None:
             assert not issubclass(volume.__class__, container.PhysicalImageContainer)
@@ -193,9 +209,9 @@ def verify(file, password):
             if type(volume) == container.PhysicalImageContainer:
                 image = volume.image
                 listener = VerificationListener()
-                validator = block_hasher.Validator(listener)
                 print("Verifying AFF4 File: %s" % file)
-                validator.validateContainer(rdfvalue.URN.FromFileName(file))
+                with block_hasher.Validator(listener, spot_check=spot_check) as validator:
+                    validator.validateContainer(rdfvalue.URN.FromFileName(file))
                 for result in listener.results:
                     print("\t%s" % result)
             elif type(volume) == container.LogicalImageContainer:
@@ -205,14 +221,62 @@ def verify(file, password):
                     print ("\t%s <%s>" % (image.name(), trimVolume(volume.urn, image.urn)))
                     hasher.hash(image)
 
-def ingestZipfile(container_name, zipfiles, append, check_bytes):
+def printVerificationResults(job):
+    if job.image_urn is None:
+        print("Verifying AFF4 File: %s" % job.filename)
+        for result in job.results or []:
+            if result.typ == "SpotCheck":
+                print("\tSpot check of %s verified %s. Detection probability = %s" % (result.urn, result.stored, result.calculated))
+            elif result.valid:
+                print("\tValidation of %s %s succeeded. Hash = %s" % (result.urn, result.typ, result.stored))
+            elif result.offset is not None:
+                print("\tInvalid block hash comarison for stream %s at offset %d" % (result.urn, result.offset))
+            else:
+                print("\tInvalid %s comarison for stream %s" % (result.typ, result.urn))
+    else:
+        print("\t%s <%s>" % (job.name, job.image_urn))
+        for result in job.results or []:
+            if result.valid:
+                print ("\t\t%s Verified (%s)" % (result.typ, result.calculated))
+            else:
+                print ("\t\t%s Hash failure stored = %s calculated = %s)" % (result.typ, result.stored, result.calculated))
+
+    if job.error is not None:
+        print("\t\tVerification failed: %s" % job.error)
+
+def verifyAll(files, password, workers, spot_check=None):
+    # Containers are listed up front, then their images verified on the
+    # worker pool. The report keeps the order of a sequential run.
+    scheduler = verifier.VerificationScheduler(workers, spot_check=spot_check)
+    containers = []
+    for file in files:
+        header = io.StringIO()
+        def describe(volume):
+            with contextlib.redirect_stdout(header):
+                printVolumeInfo(file, volume)
+                printCaseInfo(volume)
+
+        jobs = scheduler.AddContainer(file, password[0] if password else None,
+                                      onOpen=describe)
+        containers.append((header.getvalue(), len(jobs)))
+
+    results = scheduler.Run()
+    for header, count in containers:
+        sys.stdout.write(header)
+        for _ in range(count):
+            printVerificationResults(next(results))
+
+def openZipMember(zipfile, member_range):
+    return zip.MemberReader(open(zipfile, "rb"), member_range)
+
+def ingestZipfile(container_name, zipfiles, append, check_bytes, workers=1):
     # TODO: check path in exists
     start = time.time()
     with data_store.MemoryDataStore() as resolver:
 
 
         container_urn = rdfvalue.URN.FromFileName(container_name)
-        urn = None
+        urns = []
 
         if not os.path.exists(container_name):
             volume = container.Container.createURN(resolver, container_urn)
@@ -223,7 +287,8 @@ def ingestZipfile(container_name, zipfiles, append, check_bytes):
 
         resolver = volume.resolver
 
-        with volume as volume:
+        with volume as volume, \
+                ingest.LogicalIngester(volume, workers=workers, hashbased=True, checkBytes=check_bytes) as ingester:
             for zipfile in zipfiles:
                 basefilename = os.path.basename(zipfile)
                 if basefilename.endswith(".bag.zip"):
@@ -244,61 +309,75 @@ def ingestZipfile(container_name, zipfiles, append, check_bytes):
                         pathname = basefilename +  member.SerializeToString()[len(result.urn.SerializeToString()):]
                         print(pathname)
 
-                        with resolver.AFF4FactoryOpen(member, version=version.aff4v10) as src:
+                        # Members queued but not yet written are not in
+                        # the volume yet, so ask the ingester about those.
+                        if volume.containsLogicalImage(pathname) or ingester.IsQueued(pathname):
+                            print("\tCollision: this ARN is already present in this volume.")
+                            continue
 
-                            hasher = linear_hasher.StreamHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
-                            if volume.containsLogicalImage(pathname):
-                                print("\tCollision: this ARN is already present in this volume.")
-                                continue
+                        # The workers inflate, hash and chunk the members
+                        # straight from the zip file, and the ingester writes
+                        # them to the volume in this order.
+                        source = functools.partial(openZipMember, zipfile, zip_file.LocateMember(member))
+                        fsmeta = logical.FSMetadata(pathname, pathname, info.file_size)
+                        urns.extend(ingester.Add(pathname, fsmeta, source))
 
-                            urn = volume.writeLogicalStreamRabinHashBased(pathname, hasher, info.file_size, check_bytes)
-                            #fsmeta.urn = urn
-                            #fsmeta.store(resolver)
-                            for h in hasher.hashes:
-                                hh = hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
-                                resolver.Add(container_urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+            urns.extend(ingester.Flush())
 
         print ("Finished in %d (s)" % int(time.time() - start))
-        return urn
+        if urns:
+            return urns[-1]
+        return None
 
-def addPathNamesToVolume(resolver, volume, pathnames, recursive, hashbased):
-    for pathname in pathnames:
-        if not os.path.exists(pathname):
-            print("Path %s not found. Skipping." % pathname)
-            continue
-        pathname = utils.SmartUnicode(pathname)
-        print("\tAdding: %s" % pathname)
-        fsmeta = logical.FSMetadata.create(pathname)
-        if os.path.isdir(pathname):
-            image_urn = None
-            if volume.isAFF4Collision(pathname):
-                image_urn = rdfvalue.URN("aff4://%s" % uuid.uuid4())
+def addPathNamesToVolume(resolver, volume, pathnames, recursive, hashbased, workers=1, incremental=False):
+    with ingest.LogicalIngester(volume, workers=workers, hashbased=hashbased) as ingester:
+        for pathname, fsmeta, isDirectory in logical.walk(pathnames, recursive):
+            if fsmeta is None:
+                print("Path %s not found. Skipping." % pathname)
+                continue
+            print("\tAdding: %s" % pathname)
+            if isDirectory:
+                ingest.addFolder(volume, pathname, fsmeta)
+            elif incremental and ingester.IsUnchanged(pathname, fsmeta):
+                print("\t\tUnchanged. Skipping.")
             else:
-                image_urn = volume.urn.Append(escaping.arnPathFragment_from_path(pathname), quote=False)
-
-            fsmeta.urn = image_urn
-            fsmeta.store(resolver)
-            resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(pathname))
-            resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
-                         rdfvalue.URN(lexicon.standard11.FolderImage))
-            resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.standard.Image))
-            if recursive:
-                for child in os.listdir(pathname):
-                    pathnames.append(os.path.join(pathname, child))
-        else:
-            with open(pathname, "rb") as src:
-                hasher = linear_hasher.StreamHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
-                if hashbased == False:
-                    urn = volume.writeLogicalStream(pathname, hasher, fsmeta.length)
-                else:
-                    urn = volume.writeLogicalStreamRabinHashBased(pathname, hasher, fsmeta.length)
-                fsmeta.urn = urn
-                fsmeta.store(resolver)
-                for h in hasher.hashes:
-                    hh = hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
-                    resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
-
-def addPathNames(container_name, pathnames, recursive, append, hashbased, password):
+                # Files are read, hashed and compressed by the workers and
+                # written to the volume in this order.
+                ingester.Add(pathname, fsmeta)
+
+def addTarsToVolume(volume, tarnames, hashbased, workers=1):
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+    try:
+        for tarname in tarnames:
+            print("\tAdding members of: %s" % tarname)
+            if tarname == "-":
+                tarfile = getattr(sys.stdin, "buffer", sys.stdin) # binary stdin on python 3
+                for pathname, urn in ingest.ingestTar(volume, tarfile, hashbased=hashbased, pool=pool):
+                    printTarMember(pathname, urn)
+            else:
+                with open(tarname, "rb") as tarfile:
+                    for pathname, urn in ingest.ingestTar(volume, tarfile, hashbased=hashbased, pool=pool):
+                        printTarMember(pathname, urn)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def printTarMember(pathname, urn):
+    if urn is None:
+        print("\tNot a file or folder: %s. Skipping." % pathname)
+    else:
+        print("\tAdding: %s" % pathname)
+
+def addToVolume(resolver, volume, pathnames, recursive, hashbased, workers, incremental, tar):
+    if tar:
+        addTarsToVolume(volume, pathnames, hashbased, workers)
+    else:
+        addPathNamesToVolume(resolver, volume, pathnames, recursive, hashbased, workers, incremental)
+
+def addPathNames(container_name, pathnames, recursive, append, hashbased, password, workers=1, incremental=False, tar=False):
     with data_store.MemoryDataStore() as resolver:
         container_urn = rdfvalue.URN.FromFileName(container_name)
         urn = None
@@ -314,18 +393,18 @@ def addPathNames(container_name, pathnames, recursive, append, hashbased, passwo
                 if password != None:
                     volume.setPassword(password[0])
                     childVolume = volume.getChildContainer()
-                    addPathNamesToVolume(childVolume.resolver, childVolume, pathnames, recursive, hashbased)
+                    addToVolume(childVolume.resolver, childVolume, pathnames, recursive, hashbased, workers, incremental, tar)
                 else:
-                    addPathNamesToVolume(resolver, volume, pathnames, recursive, hashbased)
+                    addToVolume(resolver, volume, pathnames, recursive, hashbased, workers, incremental, tar)
         else:
             with container.Container.openURNtoContainer(container_urn, mode="+") as volume:
                 print("Appending to AFF4Container: file://%s <%s>" % (container_name, volume.urn))
                 if password != None:
                     volume.setPassword(password[0])
                     childVolume = volume.getChildContainer()
-                    addPathNamesToVolume(childVolume.resolver, childVolume, pathnames, recursive, hashbased)
+                    addToVolume(childVolume.resolver, childVolume, pathnames, recursive, hashbased, workers, incremental, tar)
                 else:
-                    addPathNamesToVolume(resolver, volume, pathnames, recursive, hashbased)
+                    addToVolume(resolver, volume, pathnames, recursive, hashbased, workers, incremental, tar)
 
         return urn
 
@@ -336,41 +415,36 @@ def nextOrNone(iterable):
     except:
         return None
 
-def extractAllFromVolume(container_urn, volume, destFolder):
+def copyToStdout(resolver, imageURNs):
+    sys.stdout.flush()
+    out = getattr(sys.stdout, "buffer", sys.stdout) # binary stdout on python 3
+    for imageUrn in imageURNs:
+        with resolver.AFF4FactoryOpen(imageUrn) as srcStream:
+            shutil.copyfileobj(srcStream, out, extraction.COPY_BUFFER_SIZE)
+    out.flush()
+
+def extractAllFromVolume(container_urn, volume, destFolder, workers=1):
     printVolumeInfo(container_urn.original_filename, volume)
     resolver = volume.resolver
-    for imageUrn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, lexicon.standard11.FileImage):
-        imageUrn = utils.SmartUnicode(imageUrn)
+    imageURNs = [utils.SmartUnicode(imageUrn) for imageUrn in
+                 resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, lexicon.standard11.FileImage)]
+    if destFolder == "-":
+        copyToStdout(resolver, imageURNs)
+        return
 
+    extractor = extraction.LogicalExtractor(volume, workers=workers)
+    pathNames = {}
+    for imageUrn in imageURNs:
         pathName = next(resolver.QuerySubjectPredicate(volume.urn, imageUrn, lexicon.standard11.pathName)).value
-        with resolver.AFF4FactoryOpen(imageUrn) as srcStream:
-            if destFolder != "-":
-                drive, pathName = os.path.splitdrive(pathName) # Windows drive letters
-                destFile = os.path.join(destFolder, drive[:-1], pathName.strip("/\\"))
-                if not os.path.exists(os.path.dirname(destFile)):
-                    try:
-                        os.makedirs(os.path.dirname(destFile))
-                    except OSError as exc:  # Guard against race condition
-                        if exc.errno != errno.EEXIST:
-                            raise
-                with open(destFile, "wb") as destStream:
-                    shutil.copyfileobj(srcStream, destStream)
-                    print("\tExtracted %s to %s" % (pathName, destFile))
-
-                lastWritten = nextOrNone(
-                    resolver.QuerySubjectPredicate(volume.urn, imageUrn, lexicon.standard11.lastWritten))
-                lastAccessed = nextOrNone(
-                    resolver.QuerySubjectPredicate(volume.urn, imageUrn, lexicon.standard11.lastAccessed))
-                recordChanged = nextOrNone(
-                    resolver.QuerySubjectPredicate(volume.urn, imageUrn, lexicon.standard11.recordChanged))
-                birthTime = nextOrNone(
-                    resolver.QuerySubjectPredicate(volume.urn, imageUrn, lexicon.standard11.birthTime))
-                logical.resetTimestamps(destFile, lastWritten, lastAccessed, recordChanged, birthTime)
+        drive, pathName = os.path.splitdrive(pathName) # Windows drive letters
+        destFile = os.path.join(destFolder, drive[:-1], pathName.strip("/\\"))
+        pathNames[destFile] = pathName
+        extractor.Add(imageUrn, destFile)
 
-            else:
-                shutil.copyfileobj(srcStream, sys.stdout)
+    for imageUrn, destFile in extractor.Run():
+        print("\tExtracted %s to %s" % (pathNames[destFile], destFile))
 
-def extractAll(container_name, destFolder, password):
+def extractAll(container_name, destFolder, password, workers=1):
     container_urn = rdfvalue.URN.FromFileName(container_name)
     urn = None
 
@@ -379,40 +453,51 @@ def extractAll(container_name, destFolder, password):
             assert not issubclass(volume.__class__, container.PhysicalImageContainer)
             volume.setPassword(password[0])
             childVolume = volume.getChildContainer()
-            extractAllFromVolume(container_urn, childVolume, destFolder)
+            extractAllFromVolume(container_urn, childVolume, destFolder, workers)
         else:
-            extractAllFromVolume(container_urn, volume, destFolder)
+            extractAllFromVolume(container_urn, volume, destFolder, workers)
+
+
 
+def findImages(volume, specs):
+    # each spec is either an image URN or a glob over the path names
+    for spec in specs:
+        if spec.startswith("aff4:"):
+            yield spec
+            continue
 
+        found = False
+        for pathName, imageUrn in volume.pathIndex().glob(spec):
+            found = True
+            yield imageUrn
+        if not found:
+            print("No images match %s. Skipping." % spec)
 
-def extractFromVolume(container_urn, volume, imageURNs, destFolder):
+def extractFromVolume(container_urn, volume, imageURNs, destFolder, workers=1):
     printVolumeInfo(container_urn.original_filename, volume)
     resolver = volume.resolver
-    for imageUrn in imageURNs:
-        imageUrn = utils.SmartUnicode(imageUrn)
+    imageURNs = [utils.SmartUnicode(imageUrn) for imageUrn in findImages(volume, imageURNs)]
+    if destFolder == "-":
+        copyToStdout(resolver, imageURNs)
+        return
 
+    # -x does not restore the timestamps
+    extractor = extraction.LogicalExtractor(volume, workers=workers, resetTimestamps=False)
+    pathNames = {}
+    for imageUrn in imageURNs:
         pathName = next(resolver.QuerySubjectPredicate(volume.urn, imageUrn, volume.lexicon.pathName))
-
-        with resolver.AFF4FactoryOpen(imageUrn) as srcStream:
-            if destFolder != "-":
-                pathName = escaping.arnPathFragment_from_path(pathName.value)
-                while pathName.startswith("/"):
-                    pathName = pathName[1:]
-                drive, pathName = os.path.splitdrive(pathName) # Windows drive letters
-                destFile = os.path.join(destFolder, drive[:-1], pathName.strip("/\\"))
-                if not os.path.exists(os.path.dirname(destFile)):
-                    try:
-                        os.makedirs(os.path.dirname(destFile))
-                    except OSError as exc:  # Guard against race condition
-                        if exc.errno != errno.EEXIST:
-                            raise
-                with open(destFile, "wb") as destStream:
-                    shutil.copyfileobj(srcStream, destStream, length=32 * 2014)
-                    print("\tExtracted %s to %s" % (pathName, destFile))
-            else:
-                shutil.copyfileobj(srcStream, sys.stdout)
-
-def extract(container_name, imageURNs, destFolder, password):
+        pathName = escaping.arnPathFragment_from_path(pathName.value)
+        while pathName.startswith("/"):
+            pathName = pathName[1:]
+        drive, pathName = os.path.splitdrive(pathName) # Windows drive letters
+        destFile = os.path.join(destFolder, drive[:-1], pathName.strip("/\\"))
+        pathNames[destFile] = pathName
+        extractor.Add(imageUrn, destFile)
+
+    for imageUrn, destFile in extractor.Run():
+        print("\tExtracted %s to %s" % (pathNames[destFile], destFile))
+
+def extract(container_name, imageURNs, destFolder, password, workers=1):
     with data_store.MemoryDataStore() as resolver:
         container_urn = rdfvalue.URN.FromFileName(container_name)
         urn = None
@@ -422,9 +507,14 @@ def extract(container_name, imageURNs, destFolder, password):
                 assert not issubclass(volume.__class__, container.PhysicalImageContainer)
                 volume.setPassword(password[0])
                 childVolume = volume.getChildContainer()
-                extractFromVolume(container_urn, childVolume, imageURNs, destFolder)
+                extractFromVolume(container_urn, childVolume, imageURNs, destFolder, workers)
             else:
-                extractFromVolume(container_urn, volume, imageURNs, destFolder)
+                extractFromVolume(container_urn, volume, imageURNs, destFolder, workers)
+
+def readPathList(filename):
+    # one image URN or path glob per line
+    with open(filename) as fd:
+        return [line.rstrip("\r\n") for line in fd if line.strip()]
 
 
 
@@ -447,19 +537,29 @@ def main(argv):
     parser.add_argument('-c', "--create-logical", action="store_true",
                         help='create an AFF4 logical container containing srcFiles')
     parser.add_argument('-x', "--extract", action="store_true",
-                        help='extract objects from the container')
+                        help='extract objects from the container, given as URNs or path globs (e.g. "Users/*/NTUSER.DAT")')
     parser.add_argument('-X', "--extract-all", action="store_true",
                         help='extract ALL objects from the container')
+    parser.add_argument('-L', "--path-list", nargs=1, action="store",
+                        help='with -x, a file listing the URNs or path globs of the objects to extract, one per line')
     parser.add_argument('-H', "--hash", action="store_true",
                         help='use hash based imaging for storing content')
     parser.add_argument('-p', "--paranoid", action="store_true",
                         help='do a byte-for-byte comparison when matching hashes are found with hash based imaging')
     parser.add_argument('-a', "--append", action="store_true",
                         help='append to an existing image')
+    parser.add_argument('-I', "--incremental", action="store_true",
+                        help='when appending, skip files already in the container with the same size and timestamps')
+    parser.add_argument('-T', "--tar", action="store_true",
+                        help='with -c or -a, srcFiles are tar archives (optionally compressed, - for stdin) whose members are added as logical images')
     parser.add_argument('-i', "--ingest", action="store_true",
                         help='ingest a zip file into a hash based image')
     parser.add_argument('-e', "--password", nargs=1, action="store",
                         help='provide a password for encryption. This causes an encrypted container to be used.')
+    parser.add_argument('-w', "--workers", type=int, action="store", default=1,
+                        help='number of workers to verify, add, ingest or extract files with. Extra containers to verify may be given as srcFiles')
+    parser.add_argument('-s', "--spot-check", type=float, action="store", metavar="CONFIDENCE",
+                        help='verify only a random sample of the blocks of physical images, sized to find 0.01%% corruption with the given confidence (e.g. 0.99)')
     parser.add_argument('aff4container', help='the pathname of the AFF4 container')
     parser.add_argument('srcFiles', nargs="*", help='source files and folders to add as logical image')
 
@@ -472,7 +572,7 @@ def main(argv):
 
     if args.create_logical == True:
         dest = args.aff4container
-        addPathNames(dest, args.srcFiles, args.recursive, args.append, args.hash, args.password)
+        addPathNames(dest, args.srcFiles, args.recursive, args.append, args.hash, args.password, args.workers, args.incremental, args.tar)
     elif  args.meta == True:
         dest = args.aff4container
         meta(dest, args.password)
@@ -481,16 +581,23 @@ def main(argv):
         list(dest, args.password)
     elif  args.verify == True:
         dest = args.aff4container
-        verify(dest, args.password)
+        spot_check = makeSpotCheck(args.spot_check)
+        if args.workers > 1 or args.srcFiles:
+            verifyAll([dest] + args.srcFiles, args.password, args.workers, spot_check)
+        else:
+            verify(dest, args.password, spot_check)
     elif args.extract == True:
         dest = args.aff4container
-        extract(dest, args.srcFiles, args.folder[0], args.password)
+        specs = args.srcFiles
+        if args.path_list:
+            specs = specs + readPathList(args.path_list[0])
+        extract(dest, specs, args.folder[0], args.password, args.workers)
     elif args.extract_all == True:
         dest = args.aff4container
-        extractAll(dest, args.folder[0], args.password)
+        extractAll(dest, args.folder[0], args.password, args.workers)
     elif args.ingest == True:
         dest = args.aff4container
-        ingestZipfile(dest, args.srcFiles, False, args.paranoid)
+        ingestZipfile(dest, args.srcFiles, False, args.paranoid, args.workers)
 
 
 if __name__ == "__main__":
@@ -197,7 +197,16 @@ class AFF4Object(object):
         return self._dirty
 
     def MarkDirty(self):
-        self._dirty = True
+        if not self._dirty:
+            self._dirty = True
+            self.resolver.ObjectCache.NoteDirty(self)
+
+    def CacheWeight(self):
+        """An estimate of the memory (in bytes) this object holds.
+
+        Used by the resolver's object cache to bound its size.
+        """
+        return 1024
 
 
 class AFF4Volume(AFF4Object):
@@ -259,6 +268,32 @@ class AFF4Stream(AFF4Object):
     def Read(self, length):
         raise NotImplementedError()
 
+    def ReadAt(self, offset, length):
+        """Reads up to length bytes from offset.
+
+        Unlike SeekRead() followed by Read(), the read pointer is left
+        untouched. Subclasses should implement this directly and build Read()
+        on top of it; this fallback emulates it for those which do not.
+        """
+        readptr = self.readptr
+        try:
+            self.SeekRead(offset)
+            return self.Read(length)
+        finally:
+            self.readptr = readptr
+
+    def ReadAtInto(self, offset, buffer):
+        """Reads from offset into a writable buffer.
+
+        Returns the number of bytes read.
+        """
+        data = self.ReadAt(offset, len(buffer))
+        if not data:
+            return 0
+
+        memoryview(buffer)[:len(data)] = data
+        return len(data)
+
     def Write(self, data):
         raise NotImplementedError()
 
@@ -323,6 +358,101 @@ class AFF4Stream(AFF4Object):
         #self.SeekWrite(0)
 
 
+class AFF4StreamCursor(object):
+    """A private read cursor over a stream shared between threads.
+
+    In concurrent read mode the resolver hands these out in place of the
+    cached stream. Each cursor keeps its own read pointer and reads from the
+    shared stream while holding that stream's lock. Only the read only
+    attributes in SHARED_ATTRIBUTES are taken from the underlying stream.
+    """
+
+    SHARED_ATTRIBUTES = frozenset(
+        ["urn", "resolver", "version", "properties", "closed"])
+
+    def __init__(self, stream, lock):
+        self.stream = stream
+        self.lock = lock
+        self.readptr = 0
+
+    def __getattr__(self, name):
+        if name in AFF4StreamCursor.SHARED_ATTRIBUTES:
+            return getattr(self.stream, name)
+
+        raise AttributeError(
+            "%s is not available on a concurrent read cursor." % name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Return the shared stream to the resolver cache.
+        self.stream.resolver.Return(self.stream)
+
+        if exc_value != None:
+            return False
+
+    def Read(self, length):
+        data = self.ReadAt(self.readptr, length)
+        if data:
+            self.readptr += len(data)
+        return data
+
+    def ReadAt(self, offset, length):
+        with self.lock:
+            return self.stream.ReadAt(offset, length)
+
+    def ReadAtInto(self, offset, buffer):
+        with self.lock:
+            return self.stream.ReadAtInto(offset, buffer)
+
+    def SeekRead(self, offset, whence=0):
+        if whence == SEEK_SET:
+            self.readptr = offset
+        elif whence == SEEK_CUR:
+            self.readptr += offset
+        elif whence == SEEK_END:
+            self.readptr = offset + self.Size()
+
+        if self.readptr < 0:
+            self.readptr = 0
+
+    def TellRead(self):
+        return self.readptr
+
+    def Size(self):
+        with self.lock:
+            return self.stream.Size()
+
+    def Tell(self):
+        return self.readptr
+
+    def Prepare(self):
+        self.readptr = 0
+
+    def Write(self, data):
+        raise IOError("Stream %s is open for concurrent reading only." %
+                      self.stream.urn)
+
+    def WriteStream(self, source, progress=None):
+        self.Write(None)
+
+    def SeekWrite(self, offset, whence=0):
+        self.Write(None)
+
+    def write(self, data):
+        self.Write(data)
+
+    def read(self, length=1024*1024):
+        return self.Read(length)
+
+    def seek(self, offset, whence=0):
+        self.SeekRead(offset, whence=whence)
+
+    def tell(self):
+        return self.readptr
+
+
 class ProgressContext(object):
     last_time = 0
     last_offset = 0
@@ -141,7 +141,7 @@ class AFF4GStore(aff4_directory.AFF4Directory):
                     if (urn_string and
                             self.urn.SerializeToString() != urn_string):
                         self.resolver.DeleteSubject(self.urn)
-                        self.urn.Set(urn_string)
+                        self.urn = rdfvalue.URN(urn_string)
 
                     # Set these triples with the new URN so we know how to open
                     # it.
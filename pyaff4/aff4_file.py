@@ -116,13 +116,43 @@ class FileBackedObject(aff4.AFF4Stream):
             self.properties.seekable = False
 
     def Read(self, length):
-        if self.fd.tell() != self.readptr:
-            self.fd.seek(self.readptr)
-
-        result = self.fd.read(length)
+        result = self.ReadAt(self.readptr, length)
         self.readptr += len(result)
         return result
 
+    def _CanPRead(self):
+        # Only read only files: buffered writes are not visible to pread.
+        return hasattr(os, "pread") and getattr(self.fd, "mode", None) == "rb"
+
+    def ReadAt(self, offset, length):
+        if isinstance(self.fd, io.BytesIO):
+            with self.fd.getbuffer() as buf:
+                return bytes(buf[offset:offset + length])
+
+        if self._CanPRead():
+            return os.pread(self.fd.fileno(), length, offset)
+
+        if self.fd.tell() != offset:
+            self.fd.seek(offset)
+
+        return self.fd.read(length)
+
+    def ReadOnlyFileno(self):
+        """Returns the descriptor of the backing file if it is open read only.
+
+        Such a descriptor can be read directly with pread, sendfile and the
+        like. Returns None otherwise.
+        """
+        if isinstance(self.fd, io.BytesIO) or not self._CanPRead():
+            return None
+        return self.fd.fileno()
+
+    def ReadAtInto(self, offset, buffer):
+        if self._CanPRead() and hasattr(os, "preadv"):
+            return os.preadv(self.fd.fileno(), [buffer], offset)
+
+        return super(FileBackedObject, self).ReadAtInto(offset, buffer)
+
     def ReadAll(self):
         res = b""
         while True:
@@ -195,6 +225,13 @@ class FileBackedObject(aff4.AFF4Stream):
     def CloseFile(self):
         self.fd.close()
 
+    def CacheWeight(self):
+        fd = getattr(self, "fd", None)
+        if isinstance(fd, io.BytesIO) and not fd.closed:
+            with fd.getbuffer() as buf:
+                return buf.nbytes
+        return super(FileBackedObject, self).CacheWeight()
+
 def GenericFileHandler(resolver, urn, *args, **kwargs):
     if os.path.isdir(urn.ToFilename()):
         directory_handler = registry.AFF4_TYPE_MAP[lexicon.AFF4_DIRECTORY_TYPE]
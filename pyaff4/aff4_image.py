@@ -21,6 +21,8 @@ from builtins import str
 from past.utils import old_div
 from builtins import object
 import binascii
+import collections
+import functools
 import logging
 import lz4.block
 import struct
@@ -42,61 +44,98 @@ from pyaff4 import hashes, zip
 LOGGER = logging.getLogger("pyaff4")
 DEBUG = False
 
+def _CompressChunk(compression, chunk_size, chunk):
+    """Returns the data to store in the bevy for a chunk."""
+    if compression == lexicon.AFF4_IMAGE_COMPRESSION_ZLIB:
+        compressed_chunk = zlib.compress(chunk)
+    elif compression == lexicon.AFF4_IMAGE_COMPRESSION_LZ4:
+        compressed_chunk = lz4.block.compress(chunk)
+    elif (snappy and compression ==
+          lexicon.AFF4_IMAGE_COMPRESSION_SNAPPY):
+        compressed_chunk = snappy.compress(chunk)
+    elif compression in (lexicon.AFF4_IMAGE_COMPRESSION_STORED,
+                         lexicon.AFF4_IMAGE_COMPRESSION_NONE):
+        compressed_chunk = chunk
+    else:
+        raise RuntimeError("Unsupported compression method %s" % compression)
+
+    if len(compressed_chunk) < chunk_size - 16:
+        return compressed_chunk
+
+    # On final chunks that aren't compressed, pad if they are less than chunk_size
+    # so that at decompression we won't try to decompress an already decompressed chunk.
+    if len(chunk) < chunk_size:
+        chunk += b"\x00" * (chunk_size - len(chunk))
+    return chunk
+
+
 class _CompressorStream(object):
     """A stream which chunks up another stream.
 
-    Each read() operation will return a compressed chunk.
+    Each read() operation will return a compressed chunk. If a pool is given,
+    chunks are read ahead in batches and compressed by the pool's workers.
     """
-    def __init__(self, owner, stream):
+    # How many chunks to read ahead for each batch sent to the pool.
+    READ_AHEAD_CHUNKS = 64
+
+    def __init__(self, owner, stream, pool=None):
         self.owner = owner
         self.stream = stream
+        self.pool = pool
         self.chunk_count_in_bevy = 0
         self.size = 0
         self.bevy_index = []
         self.bevy_length = 0
 
+        # Chunks read from the stream so far, and (length, compressed chunk)
+        # pairs which have not been returned yet.
+        self.chunks_read = 0
+        self.ready = collections.deque()
+
     def tell(self):
         return self.stream.tell()
 
-    def read(self, _):
-        # Stop copying when the bevy is full.
-        if self.chunk_count_in_bevy >= self.owner.chunks_per_segment:
-            return ""
+    def _ReadAhead(self):
+        count = 1
+        if self.pool is not None:
+            count = self.READ_AHEAD_CHUNKS
 
-        chunk = self.stream.read(self.owner.chunk_size)
-        if not chunk:
-            return ""
+        chunks = []
+        # Stop reading when the bevy is full.
+        while (len(chunks) < count and
+               self.chunks_read < self.owner.chunks_per_segment):
+            chunk = self.stream.read(self.owner.chunk_size)
+            if not chunk:
+                break
 
-        self.size += len(chunk)
+            chunks.append(chunk)
+            self.chunks_read += 1
 
-        if self.owner.compression == lexicon.AFF4_IMAGE_COMPRESSION_ZLIB:
-            compressed_chunk = zlib.compress(chunk)
-        elif self.owner.compression == lexicon.AFF4_IMAGE_COMPRESSION_LZ4:
-            compressed_chunk = lz4.block.compress(chunk)
-        elif (snappy and self.owner.compression ==
-              lexicon.AFF4_IMAGE_COMPRESSION_SNAPPY):
-            compressed_chunk = snappy.compress(chunk)
-        elif self.owner.compression in (lexicon.AFF4_IMAGE_COMPRESSION_STORED, 
-                                        lexicon.AFF4_IMAGE_COMPRESSION_NONE):
-            compressed_chunk = chunk
+        compress = functools.partial(
+            _CompressChunk, self.owner.compression, self.owner.chunk_size)
+        if self.pool is None or len(chunks) < 2:
+            compressed_chunks = [compress(chunk) for chunk in chunks]
+        else:
+            # The results come back in the order of the chunks.
+            compressed_chunks = self.pool.map(compress, chunks)
 
-        chunkLen = len(chunk)
-        compressedLen = len(compressed_chunk)
+        for i, chunk in enumerate(chunks):
+            self.ready.append((len(chunk), compressed_chunks[i]))
+
+    def read(self, _):
+        if not self.ready:
+            self._ReadAhead()
+
+        if not self.ready:
+            return ""
+
+        chunkLen, compressed_chunk = self.ready.popleft()
+        self.size += chunkLen
         self.chunk_count_in_bevy += 1
 
-        if compressedLen < self.owner.chunk_size - 16:
-            self.bevy_index.append((self.bevy_length, compressedLen))
-            self.bevy_length += compressedLen
-            return compressed_chunk
-        else:
-            # On final chunks that aren't compressed, pad if they are less than chunk_size
-            # so that at decompression we won't try to decompress an already decompressed chunk.
-            if chunkLen < self.owner.chunk_size:
-                padding = self.owner.chunk_size - chunkLen
-                chunk += b"\x00" * padding
-            self.bevy_index.append((self.bevy_length, self.owner.chunk_size))
-            self.bevy_length += self.owner.chunk_size
-            return chunk
+        self.bevy_index.append((self.bevy_length, len(compressed_chunk)))
+        self.bevy_length += len(compressed_chunk)
+        return compressed_chunk
 
 
 class AFF4Image(aff4.AFF4Stream):
@@ -190,8 +229,11 @@ class AFF4Image(aff4.AFF4Stream):
     def Length(self):
         return self.size
 
-    def WriteStream(self, source_stream, progress=None):
-        """Copy data from a source stream into this stream."""
+    def WriteStream(self, source_stream, progress=None, pool=None):
+        """Copy data from a source stream into this stream.
+
+        If a pool is given the chunks are compressed by its workers.
+        """
         if progress is None:
             if DEBUG:
                 progress = aff4.DEFAULT_PROGRESS
@@ -206,7 +248,7 @@ class AFF4Image(aff4.AFF4Stream):
         with self.resolver.AFF4FactoryOpen(volume_urn) as volume:
             # Write a bevy at a time.
             while 1:
-                stream = _CompressorStream(self, source_stream)
+                stream = _CompressorStream(self, source_stream, pool=pool)
 
                 bevy_urn = self.urn.Append("%08d" % self.bevy_number)
                 progress.start = (self.bevy_number *
@@ -405,17 +447,25 @@ class AFF4Image(aff4.AFF4Stream):
         if length == 0:
             return ""
 
-        length = min(length, self.Size() - self.readptr)
+        result = self.ReadAt(self.readptr, length)
+        self.readptr += len(result)
+
+        return result
+
+    def ReadAt(self, offset, length):
+        length = min(int(length), self.Size() - offset)
+        if length <= 0:
+            return b""
 
-        initial_chunk_id, initial_chunk_offset = divmod(self.readptr,
+        initial_chunk_id, initial_chunk_offset = divmod(offset,
                                                         self.chunk_size)
 
-        final_chunk_id, _ = divmod(self.readptr + length - 1, self.chunk_size)
+        final_chunk_id, _ = divmod(offset + length - 1, self.chunk_size)
 
         # We read this many full chunks at once.
         chunks_to_read = final_chunk_id - initial_chunk_id + 1
         chunk_id = initial_chunk_id
-        result = b""
+        result = []
 
         while chunks_to_read > 0:
             #chunks_read, data = self._ReadPartial(chunk_id, chunks_to_read)
@@ -427,16 +477,14 @@ class AFF4Image(aff4.AFF4Stream):
                 break
 
             chunks_to_read -= chunks_read
-            result += data
+            chunk_id += chunks_read
+            result.append(data)
 
+        result = b"".join(result)
         if initial_chunk_offset:
             result = result[initial_chunk_offset:]
 
-        result = result[:length]
-
-        self.readptr += len(result)
-
-        return result
+        return result[:length]
 
     def ReadAll(self):
         res = b""
@@ -449,6 +497,17 @@ class AFF4Image(aff4.AFF4Stream):
             else:
                 res += data
 
+    def CacheWeight(self):
+        weight = len(self.buffer) + len(self.cache) * self.chunk_size
+        return weight + self._BevyWeight() + super(AFF4Image, self).CacheWeight()
+
+    def _BevyWeight(self):
+        """The memory held by the bevy being written."""
+        weight = 0
+        for chunk in self.bevy:
+            weight += len(chunk)
+        return weight
+
     def _parse_bevy_index(self, bevy):
         """Read and return the bevy's index.
 
@@ -494,7 +553,7 @@ class AFF4Image(aff4.AFF4Stream):
             return result
 
     def reloadBevy(self, bevy_id):
-        if "AXIOMProcess" in self.version.tool:
+        if self.version is not None and "AXIOMProcess" in self.version.tool:
             # Axiom does strange stuff with paths and URNs, we need to fix the URN for reading bevys
             volume_urn = '/'.join(self.urn.SerializeToString().split('/')[0:3])
             original_filename = self.resolver.Get(volume_urn, self.urn, rdfvalue.URN(lexicon.standard11.pathName))[0]
@@ -508,37 +567,47 @@ class AFF4Image(aff4.AFF4Stream):
             bevy_index_urn = rdfvalue.URN("%s.index" % bevy_urn)
         if LOGGER.isEnabledFor(logging.INFO):
             LOGGER.info("Reload Bevy %s", bevy_urn)
-        chunks = []
 
         with self.resolver.AFF4FactoryOpen(bevy_urn, version=self.version) as bevy:
             bevy_index = self._parse_bevy_index(bevy)
-            for i in range(0, len(bevy_index)):
-                off, sz = bevy_index[i]
-                bevy.SeekRead(off, 0)
-                chunk = bevy.Read(sz)
-                chunks.append(self.onChunkLoad(chunk, bevy_id, i))
-
-                # trim the chunk if it is the final one and it exceeds the size of the stream
-                endOfChunkAddress = (bevy_id * self.chunks_per_segment + i + 1) * self.chunk_size
-                if endOfChunkAddress > self.size:
-                    toKeep = self.chunk_size - (endOfChunkAddress - self.size)
-                    chunk = chunks[i][0:toKeep]
-                    chunks[i] = chunk
-                    self.cache[i] = chunk
-                    bevy_index = bevy_index[0:i+1]
-                    break
+
+            # Chunks past the one holding the end of the stream are not loaded.
+            first_chunk_id = bevy_id * self.chunks_per_segment
+            last = max(self.size // self.chunk_size - first_chunk_id, 0)
+            trim = last < len(bevy_index)
+            if trim:
+                bevy_index = bevy_index[0:last+1]
+
+            chunks = self.onBevyLoad(bevy, bevy_index, bevy_id)
+
+            # trim the final chunk if it exceeds the size of the stream
+            if trim:
+                toKeep = self.size - (first_chunk_id + last) * self.chunk_size
+                chunk = chunks[last][0:toKeep]
+                chunks[last] = chunk
+                self.cache[first_chunk_id + last] = chunk
         self.bevy = chunks
         self.bevy_index = bevy_index
         self.bevy_length = len(bevy_index)
         self.bevy_number = bevy_id
         self.bevy_is_loaded_from_disk = True
 
+    def onBevyLoad(self, bevy, bevy_index, bevy_id):
+        """Reads and decompresses the chunks of the bevy listed in bevy_index."""
+        chunks = []
+        for i in range(0, len(bevy_index)):
+            off, sz = bevy_index[i]
+            chunk = bevy.ReadAt(off, sz)
+            chunks.append(self.onChunkLoad(chunk, bevy_id, i))
+
+        return chunks
+
     def onChunkLoad(self, chunk, bevy_id, chunk_id):
         return self.doDecompress(chunk, bevy_id*self.chunks_per_segment + chunk_id)
 
     def _ReadPartialRO(self, chunk_id, chunks_to_read):
         chunks_read = 0
-        result = b""
+        result = []
         if LOGGER.isEnabledFor(logging.INFO):
             LOGGER.info("ReadPartialRO chunk=%x count=%x", chunk_id, chunks_to_read)
         while chunks_to_read > 0:
@@ -547,7 +616,7 @@ class AFF4Image(aff4.AFF4Stream):
 
             r = self.cache.get(chunk_id)
             if r != None:
-                result += r
+                result.append(r)
                 chunks_to_read -= 1
                 chunk_id += 1
                 chunks_read += 1
@@ -565,17 +634,17 @@ class AFF4Image(aff4.AFF4Stream):
             if local_chunk_index < len(self.bevy):
                 r = self.bevy[local_chunk_index]
                 self.cache[chunk_id] = r
-                result += r
+                result.append(r)
                 chunks_to_read -= 1
                 chunk_id += 1
                 chunks_read += 1
                 continue
 
-        return chunks_read, result
+        return chunks_read, b"".join(result)
 
     def _ReadPartial(self, chunk_id, chunks_to_read):
         chunks_read = 0
-        result = b""
+        result = []
         if LOGGER.isEnabledFor(logging.INFO):
             LOGGER.info("ReadPartial chunk=%x count=%x", chunk_id, chunks_to_read)
         while chunks_to_read > 0:
@@ -584,7 +653,7 @@ class AFF4Image(aff4.AFF4Stream):
 
             r = self.cache.get(chunk_id)
             if r != None:
-                result += r
+                result.append(r)
                 chunks_to_read -= 1
                 chunk_id += 1
                 chunks_read += 1
@@ -596,7 +665,7 @@ class AFF4Image(aff4.AFF4Stream):
                     #if len(self.buffer) == self.chunk_size:
                     r = self.buffer
                     self.cache[chunk_id] = r
-                    result += r
+                    result.append(r)
                     chunks_to_read -= 1
                     chunk_id += 1
                     chunks_read += 1
@@ -608,7 +677,7 @@ class AFF4Image(aff4.AFF4Stream):
                     r = self.bevy[local_chunk_index]
                     self.cache[chunk_id] = r
                     #result += self.doDecompress(r, chunk_id)
-                    result += r
+                    result.append(r)
                     chunks_to_read -= 1
                     chunk_id += 1
                     chunks_read += 1
@@ -621,7 +690,7 @@ class AFF4Image(aff4.AFF4Stream):
                 while chunks_to_read > 0:
                     r = self.cache.get(chunk_id)
                     if r != None:
-                        result += r
+                        result.append(r)
                         chunks_to_read -= 1
                         chunk_id += 1
                         chunks_read += 1
@@ -631,7 +700,7 @@ class AFF4Image(aff4.AFF4Stream):
                     data = self._ReadChunkFromBevy(chunk_id, bevy)
                     self.cache[chunk_id] = data
 
-                    result += data
+                    result.append(data)
 
                     chunks_to_read -= 1
                     chunk_id += 1
@@ -641,7 +710,7 @@ class AFF4Image(aff4.AFF4Stream):
                     if bevy_id < old_div(chunk_id, self.chunks_per_segment):
                         break
 
-        return chunks_read, result
+        return chunks_read, b"".join(result)
 
     def _ReadChunkFromBevy(self, chunk_id, bevy):
         bevy_index = self._parse_bevy_index(bevy)
@@ -660,8 +729,7 @@ class AFF4Image(aff4.AFF4Stream):
 
         # The index is a list of (offset, compressed_length)
         chunk_offset, chunk_size = bevy_index[chunk_id_in_bevy]
-        bevy.SeekRead(chunk_offset, 0)
-        cbuffer = bevy.Read(chunk_size)
+        cbuffer = bevy.ReadAt(chunk_offset, chunk_size)
 
         return self.doDecompress(cbuffer, chunk_id)
 
@@ -708,21 +776,32 @@ class AFF4PreSImage(AFF4Image):
             bevy_id, hashes.toShortAlgoName(hash_datatype)))
 
     def readBlockHash(self, chunk_id, hash_datatype):
-        bevy_id = old_div(chunk_id, self.chunks_per_segment)
+        bevy_id, chunk_id_in_bevy = divmod(chunk_id, self.chunks_per_segment)
         bevy_blockHash_urn = self._get_block_hash_urn(
             bevy_id, hash_datatype)
         blockLength = hashes.length(hash_datatype)
 
         with self.resolver.AFF4FactoryOpen(
                 bevy_blockHash_urn) as bevy_blockHashes:
-            idx = chunk_id * blockLength
-
-            bevy_blockHashes.SeekRead(idx)
-            hash_value = bevy_blockHashes.Read(blockLength)
+            idx = chunk_id_in_bevy * blockLength
+            hash_value = bevy_blockHashes.ReadAt(idx, blockLength)
 
             return hashes.newImmutableHash(
                 binascii.hexlify(hash_value), hash_datatype)
 
+    def readBlockHashes(self, bevy_id, hash_datatype):
+        """Returns all the stored block hashes of a bevy.
+
+        The result is the raw blockHash segment, i.e. the digests of the
+        bevy's chunks concatenated in chunk order.
+        """
+        bevy_blockHash_urn = self._get_block_hash_urn(
+            bevy_id, hash_datatype)
+
+        with self.resolver.AFF4FactoryOpen(
+                bevy_blockHash_urn) as bevy_blockHashes:
+            return bevy_blockHashes.ReadAt(0, bevy_blockHashes.Size())
+
 
 class AFF4SImage(AFF4PreSImage):
     def _get_block_hash_urn(self, bevy_id, hash_datatype):
@@ -17,11 +17,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import str
 from builtins import object
+import array
 import collections
 import intervaltree
 import logging
 import struct
 import sys
+import threading
 import traceback
 
 from pyaff4 import aff4
@@ -160,9 +162,8 @@ class _MapStreamHelper(object):
             # Read and copy the data.
             source_urn = self.source.targets[current_range.target_id]
             with self.resolver.AFF4FactoryOpen(source_urn) as source:
-                source.SeekRead(current_range.target_offset + self.range_offset)
-
-                data = source.Read(to_read)
+                data = source.ReadAt(
+                    current_range.target_offset + self.range_offset, to_read)
                 if not data:
                     break
 
@@ -234,50 +235,67 @@ class AFF4Map(aff4.AFF4Stream):
             pass
 
     def Read(self, length):
-        result = b""
-        for interval in sorted(self.tree[self.readptr:self.readptr+length]):
+        result = self.ReadAt(self.readptr, length)
+        self.readptr += len(result)
+        return result
+
+    def ReadAt(self, offset, length):
+        result = []
+        for interval in sorted(self.tree[offset:offset+length]):
             range = interval.data
 
             # The start of the range is ahead of us - we pad with zeros.
-            if range.map_offset > self.readptr:
-                padding = min(length, range.map_offset - self.readptr)
-                result += b"\x00" * padding
-                self.readptr += padding
+            if range.map_offset > offset:
+                padding = min(length, range.map_offset - offset)
+                result.append(b"\x00" * padding)
+                offset += padding
                 length -= padding
 
             if length == 0:
                 break
 
             target = self.targets[range.target_id]
-            length_to_read_in_target = min(length, range.map_end - self.readptr)
+            length_to_read_in_target = min(length, range.map_end - offset)
+            target_offset = range.target_offset_at_map_offset(offset)
+
+            # Hash based targets (aff4:sha512:...) resolve straight to a range
+            # of the block store, so we read from there directly.
+            reference = self.resolver.ResolveHashReference(target)
+            if reference is not None:
+                (target, chunk_offset, chunk_length) = reference
+                length_to_read_in_target = max(0, min(
+                    length_to_read_in_target, chunk_length - target_offset))
+                target_offset += chunk_offset
 
             bytes_read = 0
             try:
                 with self.resolver.AFF4FactoryOpen(target, version=self.version) as target_stream:
-                    target_stream.SeekRead(
-                        range.target_offset_at_map_offset(self.readptr))
-
-                    buffer = target_stream.Read(length_to_read_in_target)
+                    buffer = target_stream.ReadAt(
+                        target_offset, length_to_read_in_target)
                     if buffer == None:
                         bytes_read = 0
                     else:
                         bytes_read = len(buffer)
-                        result += buffer
+                        result.append(buffer)
 
             except IOError:
                 traceback.print_exc()
                 LOGGER.debug("*** Stream %s not found. Substituting zeros. ***",
-                             target_stream)
-                result += b"\x00" * length_to_read_in_target
+                             target)
+                result.append(b"\x00" * length_to_read_in_target)
             finally:
                 length -= bytes_read
-                self.readptr += bytes_read
+                offset += bytes_read
 
-        return result
+        return b"".join(result)
 
     def Size(self):
         return self.tree.end()
 
+    def CacheWeight(self):
+        # Each range is a namedtuple held by an interval in the tree.
+        return len(self.tree) * 256 + super(AFF4Map, self).CacheWeight()
+
     def AddRange(self, map_offset, target_offset, length, target):
         """Add a new mapping range."""
         rdfvalue.AssertURN(target)
@@ -524,57 +542,137 @@ class AFF4Map2(AFF4Map):
             # we get IOErrors here on creation from scratch. This is safe and expected.
             pass
 
-def isByteRangeARN(urn):
+def parseByteRangeARN(urn):
+    """Splits a byte range ARN (aff4://...[0xoffset:0xlength]) into parts.
+
+    Returns a (target, offset, length) tuple, or None if urn is not a byte
+    range ARN. The ARN is split as a string as the bracketed range is not a
+    valid URL netloc.
+    """
+    if isinstance(urn, rdfvalue.URN):
+        urn = urn.value
+    urn = utils.SmartUnicode(urn)
+
     if not urn.startswith("aff4://"):
-        return False
+        return None
     if not urn.endswith("]"):
-        return False
+        return None
     try:
         (target, rangepair) = urn.split("[")
         rangepair = rangepair[0:len(rangepair) - 1]
         (offset, length) = rangepair.split(":")
 
-        offset = int(offset, 16)
-        length = int(length, 16)
-        return True
-    except:
-        return False
+        return (target, int(offset, 16), int(length, 16))
+    except ValueError:
+        return None
+
+def isByteRangeARN(urn):
+    return parseByteRangeARN(urn) is not None
+
+
+class HashReferenceTable(object):
+    """A compact table of hash ARNs (aff4:sha512:...) to block store ranges.
+
+    Deduplicated logical images reference their chunks by hash, and each hash
+    is bound to a ByteRangeARN in the block store via aff4:dataStream. Rather
+    than going through the resolver and reparsing the ByteRangeARN for every
+    chunk read, we keep the parsed range in flat arrays, with block store
+    URNs stored once and referenced by index.
+
+    Entries may be added lazily while other threads read the table (see
+    DataStore.ResolveHashReference), so Add() is serialized and an entry
+    only becomes visible to Get() once it is complete.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = []
+        self.target_idx_map = {}
+        self.index = {}
+        self.target_ids = array.array("I")
+        self.offsets = array.array("Q")
+        self.lengths = array.array("Q")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, hash_urn):
+        return utils.SmartUnicode(hash_urn) in self.index
+
+    def Add(self, hash_urn, byte_range_urn):
+        hash_urn = utils.SmartUnicode(hash_urn)
+        if hash_urn in self.index:
+            return
+
+        byte_range = parseByteRangeARN(byte_range_urn)
+        if byte_range is None:
+            return
+
+        (target, offset, length) = byte_range
+        with self.lock:
+            if hash_urn in self.index:
+                return
+
+            target_id = self.target_idx_map.get(target)
+            if target_id is None:
+                target_id = len(self.targets)
+                self.targets.append(rdfvalue.URN(target))
+                self.target_idx_map[target] = target_id
+
+            self.target_ids.append(target_id)
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.index[hash_urn] = len(self.offsets) - 1
+
+    def Remove(self, hash_urn):
+        # The arrays are append only, we just drop the index entry.
+        self.index.pop(utils.SmartUnicode(hash_urn), None)
+
+    def Get(self, hash_urn):
+        """Returns the (block store URN, offset, length) of hash_urn or None."""
+        idx = self.index.get(hash_urn)
+        if idx is None:
+            return None
+
+        return (self.targets[self.target_ids[idx]], self.offsets[idx],
+                self.lengths[idx])
+
 
 class ByteRangeARN(aff4.AFF4Stream):
 
     def __init__(self, version, resolver=None, urn=None):
         super(ByteRangeARN, self).__init__(
             resolver=resolver, urn=urn)
-        (target, rangepair) = urn.SerializeToString().split("[")
-        rangepair = rangepair[0:len(rangepair)-1]
-        (offset, length) = rangepair.split(":")
+        (target, offset, length) = parseByteRangeARN(urn)
         self.target = target
-        self.offset = int(offset,16)
-        self.length = int(length,16)
+        self.offset = offset
+        self.length = length
         self.version = version
 
 
     def Read(self, length):
-        result = b""
         if self.readptr >= self.length:
             return None
-        length_to_read_in_target = min(length, self.length)
+
+        result = self.ReadAt(self.readptr, length)
+        self.readptr += len(result)
+        return result
+
+    def ReadAt(self, offset, length):
+        length_to_read_in_target = min(length, self.length - offset)
+        if length_to_read_in_target <= 0:
+            return b""
+
         try:
             with self.resolver.AFF4FactoryOpen(self.target, version=self.version) as target_stream:
-                #if target_stream.IsDirty():
-                #    target_stream.FlushBuffers()
-                target_stream.SeekRead(self.offset + self.readptr)
-                buffer = target_stream.Read(length_to_read_in_target)
+                buffer = target_stream.ReadAt(self.offset + offset,
+                                              length_to_read_in_target)
                 assert len(buffer) == length_to_read_in_target
-                result += buffer
+                return buffer
         except IOError:
             LOGGER.debug("*** Stream %s not found. Substituting zeros. ***",
-                         target_stream)
-            result += b"\x00" * length_to_read_in_target
-        finally:
-            length -= length_to_read_in_target
-            self.readptr += length_to_read_in_target
-        return result
+                         self.target)
+            return b"\x00" * length_to_read_in_target
 
     def Write(self, data):
         raise NotImplementedError()
@@ -26,13 +26,17 @@ from builtins import object
 import binascii
 import collections
 import hashlib
+import math
+import random
 import six
+from multiprocessing.pool import ThreadPool
 
 from pyaff4 import container
 from pyaff4 import data_store
 from pyaff4 import hashes
 from pyaff4 import lexicon
 from pyaff4 import rdfvalue
+from pyaff4 import utils
 from pyaff4 import zip
 
 
@@ -56,6 +60,9 @@ hashOrderingMap = { lexicon.HASH_MD5 : 1,
                     lexicon.HASH_SHA512 : 4,
                     lexicon.HASH_BLAKE2B: 5}
 
+# Number of chunks read from an image stream and verified as one batch.
+BLOCK_HASH_BATCH_CHUNKS = 256
+
 class ValidationListener(object):
     def __init__(self):
         pass
@@ -63,6 +70,16 @@ class ValidationListener(object):
     def onValidBlockHash(self, a):
         pass
 
+    def onValidBlockHashes(self, imageStreamURI, offset, count, digests):
+        """Called once per verified batch of blocks.
+
+        count blocks of the batch starting at offset in imageStreamURI
+        verified successfully. digests are the hex digests which matched, as
+        would have been passed to onValidBlockHash() one at a time.
+        """
+        for digest in digests:
+            self.onValidBlockHash(digest)
+
     def onInvalidBlockHash(self, a, b, imageStreamURI, offset):
         raise InvalidBlockHashComparison(
             "Invalid block hash comarison for stream %s at offset %d" % (imageStreamURI, offset))
@@ -73,6 +90,73 @@ class ValidationListener(object):
     def onInvalidHash(self, typ, a, b, streamURI):
         raise InvalidHashComparison("Invalid %s comarison for stream %s" % (typ, streamURI))
 
+    def onSpotCheck(self, imageStreamURI, sampled, total, probability):
+        """Called once a spot check of imageStreamURI completes.
+
+        sampled of the total blocks were verified, which detects the
+        configured corruption rate with the given probability.
+        """
+        pass
+
+
+class SpotCheck(object):
+    """A plan for verifying a random sample of an image's blocks.
+
+    The sample is sized so that if at least corruption_rate of the blocks
+    are corrupt, at least one corrupt block is sampled with probability
+    confidence. With stratified sampling the image is split into as many
+    equal strata as there are samples, and one block is drawn from each.
+    """
+
+    def __init__(self, confidence=0.99, corruption_rate=0.0001,
+                 stratified=True, seed=None):
+        if not 0 < confidence < 1:
+            raise ValueError("Confidence must be between 0 and 1")
+        if not 0 < corruption_rate <= 1:
+            raise ValueError("Corruption rate must be between 0 and 1")
+
+        self.confidence = confidence
+        self.corruption_rate = corruption_rate
+        self.stratified = stratified
+        self.random = random.Random(seed)
+
+    def SampleSize(self, total):
+        if self.corruption_rate >= 1:
+            return min(1, total)
+
+        size = math.ceil(math.log(1 - self.confidence) /
+                         math.log(1 - self.corruption_rate))
+        return int(min(size, total))
+
+    def DetectionProbability(self, sampled, total):
+        """The chance that sampled blocks find corruption_rate damage."""
+        if sampled >= total:
+            return 1.0
+        return 1 - (1 - self.corruption_rate) ** sampled
+
+    def Sample(self, total):
+        """Returns the sorted block numbers to verify."""
+        size = self.SampleSize(total)
+        if size >= total:
+            return list(range(total))
+
+        if not self.stratified:
+            return sorted(self.random.sample(range(total), size))
+
+        result = []
+        for i in range(size):
+            start = i * total // size
+            end = (i + 1) * total // size
+            result.append(self.random.randrange(start, end))
+
+        return result
+
+def _digest(hashDataType, block):
+    h = hashes.new(hashDataType)
+    h.update(block)
+    return h.digest()
+
+
 class BlockHashesHash(object):
     def __init__(self, blockHashAlgo, hash, hashDataType):
         self.blockHashAlgo = blockHashAlgo
@@ -93,26 +177,74 @@ class BlockHashesHash(object):
 
 
 class Validator(object):
-    def __init__(self, listener=None):
+    def __init__(self, listener=None, workers=None, spot_check=None):
         if listener == None:
             self.listener = ValidationListener()
         else:
             self.listener = listener
         self.delegate = None
+        # Blocks are hashed serially unless more than one worker is asked for.
+        self.workers = workers
+        self.pool = None
+
+        # If set to a SpotCheck, only a sample of the blocks is verified.
+        self.spot_check = spot_check
+
+        # Image stream URN to the mismatches found by validateBlockRange(),
+        # for streams whose blocks were verified in ranges beforehand.
+        self.blockMismatches = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def getPool(self):
+        """Returns the pool blocks are hashed on, created on first use.
+
+        Returns None if the blocks are to be hashed serially.
+        """
+        if self.pool is None and self.workers is not None and self.workers > 1:
+            self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def mapBlocks(self, function, blocks):
+        pool = self.getPool()
+        if pool is None:
+            return [function(block) for block in blocks]
+        return pool.map(function, blocks)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def newDelegate(self, resolver, lex):
+        if lex == lexicon.standard:
+            delegate = InterimStdValidator(resolver, lex, self.listener, self.workers, self.spot_check)
+        elif lex == lexicon.legacy:
+            delegate = PreStdValidator(resolver, lex, self.listener, self.workers, self.spot_check)
+        else:
+            raise ValueError
+
+        # Delegates hash on our pool, so it is closed with us.
+        delegate.pool = self.getPool()
+        delegate.blockMismatches = self.blockMismatches
+        return delegate
 
     def validateContainer(self, urn):
         (version, lex) = container.Container.identifyURN(urn)
         resolver = data_store.MemoryDataStore(lex)
 
-        with zip.ZipFile.NewZipFile(resolver, version, urn) as zip_file:
-            if lex == lexicon.standard:
-                self.delegate = InterimStdValidator(resolver, lex, self.listener)
-            elif lex == lexicon.legacy:
-                self.delegate = PreStdValidator(resolver, lex, self.listener)
-            else:
-                raise ValueError
-            self.delegate.volume_arn = zip_file.urn
-            self.delegate.doValidateContainer()
+        try:
+            with zip.ZipFile.NewZipFile(resolver, version, urn) as zip_file:
+                self.delegate = self.newDelegate(resolver, lex)
+                self.delegate.volume_arn = zip_file.urn
+                self.delegate.doValidateContainer()
+        finally:
+            self.close()
 
     def validateContainerMultiPart(self, urn_a, urn_b):
         # in this simple example, we assume that both files passed are
@@ -120,17 +252,38 @@ class Validator(object):
         (version, lex) = container.Container.identifyURN(urn_a)
         resolver = data_store.MemoryDataStore(lex)
 
-        with zip.ZipFile.NewZipFile(resolver, version, urn_a) as zip_filea:
-            with zip.ZipFile.NewZipFile(resolver, version, urn_b) as zip_fileb:
-                if lex == lexicon.standard:
-                    self.delegate = InterimStdValidator(resolver, lex, self.listener)
-                elif lex == lexicon.legacy:
-                    self.delegate = PreStdValidator(resolver, lex, self.listener)
-                else:
-                    raise ValueError
+        try:
+            with zip.ZipFile.NewZipFile(resolver, version, urn_a) as zip_filea:
+                with zip.ZipFile.NewZipFile(resolver, version, urn_b) as zip_fileb:
+                    self.delegate = self.newDelegate(resolver, lex)
+
+                    self.delegate.volume_arn = zip_filea.urn
+                    self.delegate.doValidateContainer()
+        finally:
+            self.close()
+
+    def validateBlockRange(self, urn, imageStreamURI, firstChunk, count):
+        """Verifies count blocks of an image stream from firstChunk.
+
+        This lets the blocks of a large image be verified in parallel.
+        Returns the mismatches found (see hashBlocks). Those of all the
+        ranges of a stream, set in blockMismatches, then complete the
+        validation of the container without reading the blocks again.
+        """
+        (version, lex) = container.Container.identifyURN(urn)
+        resolver = data_store.MemoryDataStore(lex)
 
-                self.delegate.volume_arn = zip_filea.urn
-                self.delegate.doValidateContainer()
+        try:
+            with zip.ZipFile.NewZipFile(resolver, version, urn) as zip_file:
+                delegate = self.newDelegate(resolver, lex)
+                delegate.volume_arn = zip_file.urn
+                with resolver.AFF4FactoryOpen(imageStreamURI) as imageStream:
+                    return delegate.hashBlocks(
+                        imageStreamURI, imageStream,
+                        delegate.getStoredBlockHashes(imageStreamURI),
+                        firstChunk, count)
+        finally:
+            self.close()
 
     def validateBlockMapHash(self, mapStreamURI, imageStreamURI):
         storedHash = next(self.resolver.QuerySubjectPredicate(
@@ -175,53 +328,283 @@ class Validator(object):
         return hashes.newImmutableHash(calculatedHash.hexdigest(), storedHashDataType)
 
     def calculateBlockHashesHash(self, imageStreamURI):
+        if self.spot_check is not None:
+            return self.spotCheckBlockHashesHash(imageStreamURI)
+
+        if self.blockMismatches is not None:
+            mismatches = self.blockMismatches.get(utils.SmartUnicode(imageStreamURI))
+            if mismatches is not None:
+                return self.mergeBlockHashesHash(imageStreamURI, mismatches)
+
         hash = self.getStoredBlockHashes(imageStreamURI)
 
+        calculatedBlockHashes = []
+        for h in hash:
+            calculatedBlockHashes.append(hashes.new(h.hashDataType))
+
         with self.resolver.AFF4FactoryOpen(imageStreamURI) as imageStream:
+            self.hashBlocks(imageStreamURI, imageStream, hash, 0, None,
+                            calculatedBlockHashes)
+
+        # we now have the block hashes hash calculated
+        return self._blockHashesHashes(hash, calculatedBlockHashes)
 
+    def _blockHashesHashes(self, hash, calculatedBlockHashes):
+        res = []
+        for i in range(len(hash)):
+            a = hash[i].blockHashAlgo
+            b = calculatedBlockHashes[i].hexdigest()
+            c = hash[i].hashDataType
+            blockHashesHash = BlockHashesHash(a, b, c)
+            res.append(blockHashesHash)
+
+        return res
+
+    def hashBlocks(self, imageStreamURI, imageStream, hash, firstChunk, count,
+                   calculatedBlockHashes=None):
+        """Verifies the blocks of an image stream against their stored hashes.
+
+        count chunks from firstChunk are verified, or all of the rest if
+        count is None. The calculated digests are added to
+        calculatedBlockHashes if given. Returns the calculated digests which
+        did not match, as a list of (block hash datatype, chunk index, digest).
+        """
+        mismatches = []
+
+        # The stored block hashes of the current bevy, per algorithm.
+        storedBevies = {}
+
+        chunk_size = imageStream.chunk_size
+        offset = firstChunk * chunk_size
+        end = imageStream.size
+        if count is not None:
+            end = min(end, offset + count * chunk_size)
+
+        while offset < end:
+            data = imageStream.ReadAt(
+                offset, min(chunk_size * BLOCK_HASH_BATCH_CHUNKS, end - offset))
+            if not data:
+                break
+
+            blocks = [data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size)]
+            chunkIdx = old_div(offset, chunk_size)
+
+            valid = [True] * len(blocks)
+            validDigests = [[] for _ in blocks]
+            for i in range(len(hash)):
+                hashDataType = hash[i].blockHashAlgo
+
+                # Hash the batch on the pool, then compare all of it
+                # against the stored hashes at once.
+                digests = self.mapBlocks(
+                    lambda block: _digest(hashDataType, block), blocks)
+                calculated = b"".join(digests)
+                stored = self._readStoredBlockHashes(
+                    imageStream, hashDataType, chunkIdx, len(blocks),
+                    storedBevies)
+
+                matches = None
+                if calculated != stored:
+                    matches = self._reportInvalidBlockHashes(
+                        imageStreamURI, hashDataType, offset,
+                        chunk_size, digests, stored)
+
+                for j, digest in enumerate(digests):
+                    if matches is None or matches[j]:
+                        validDigests[j].append(digest)
+                    else:
+                        valid[j] = False
+                        mismatches.append((hashDataType, chunkIdx + j, digest))
+
+                if calculatedBlockHashes is not None:
+                    calculatedBlockHashes[i].update(calculated)
+
+            self._reportValidBlockHashes(
+                imageStreamURI, offset, sum(valid), validDigests)
+
+            offset = offset + len(data)
+
+        return mismatches
+
+    def mergeBlockHashesHash(self, imageStreamURI, mismatches):
+        """Calculates the blockHashesHash of blocks verified by hashBlocks.
+
+        Where the blocks matched, their digests are the stored ones, so the
+        hash is computed over the stored block hashes with the mismatching
+        digests put in their place. This gives the same result as hashing
+        the blocks again.
+        """
+        hash = self.getStoredBlockHashes(imageStreamURI)
+
+        with self.resolver.AFF4FactoryOpen(imageStreamURI) as imageStream:
             calculatedBlockHashes = []
             for h in hash:
                 calculatedBlockHashes.append(hashes.new(h.hashDataType))
 
-            offset = 0
-            while offset < imageStream.size:
-                imageStream.seek(offset)
-                block = imageStream.Read(imageStream.chunk_size)
+            chunks_per_segment = imageStream.chunks_per_segment
+            replaced = collections.defaultdict(list)
+            for hashDataType, chunkIdx, digest in mismatches:
+                bevy_id, chunk_id_in_bevy = divmod(chunkIdx, chunks_per_segment)
+                replaced[(utils.SmartUnicode(hashDataType), bevy_id)].append(
+                    (chunk_id_in_bevy, digest))
+
+            total = ((imageStream.size + imageStream.chunk_size - 1) //
+                     imageStream.chunk_size)
+            bevies = (total + chunks_per_segment - 1) // chunks_per_segment
+            for bevy_id in range(bevies):
+                chunks_in_bevy = min(chunks_per_segment,
+                                     total - bevy_id * chunks_per_segment)
 
                 for i in range(len(hash)):
-                    calculatedBlockHashesHash = calculatedBlockHashes[i]
                     hashDataType = hash[i].blockHashAlgo
+                    blockLength = hashes.length(hashDataType)
+                    digests = imageStream.readBlockHashes(bevy_id, hashDataType)
+                    digests = bytearray(digests[:chunks_in_bevy * blockLength])
+                    for chunk_id_in_bevy, digest in replaced.get(
+                            (utils.SmartUnicode(hashDataType), bevy_id), []):
+                        start = chunk_id_in_bevy * blockLength
+                        digests[start:start + blockLength] = digest
+                    calculatedBlockHashes[i].update(bytes(digests))
+
+        return self._blockHashesHashes(hash, calculatedBlockHashes)
+
+    def spotCheckBlockHashesHash(self, imageStreamURI):
+        """Verifies a sample of the blocks of an image stream.
+
+        The blockHashesHash is computed over the stored block hashes, which
+        checks the hash segments themselves, and the sampled blocks are
+        checked against them one bevy at a time.
+        """
+        hash = self.getStoredBlockHashes(imageStreamURI)
 
-                    # verify the block hash
-                    h = hashes.new(hashDataType)
-                    h.update(block)
-                    calculatedBlockHash = h.hexdigest()
-
-                    chunkIdx = old_div(offset, imageStream.chunk_size)
-                    storedBlockHash = imageStream.readBlockHash(chunkIdx, hashDataType)
-                    if calculatedBlockHash != storedBlockHash:
-                        self.listener.onInvalidBlockHash(
-                            calculatedBlockHash,
-                            storedBlockHash.value,
-                            imageStreamURI, offset)
-                    else:
-                        self.listener.onValidBlockHash(calculatedBlockHash)
+        with self.resolver.AFF4FactoryOpen(imageStreamURI) as imageStream:
+            calculatedBlockHashes = []
+            for h in hash:
+                calculatedBlockHashes.append(hashes.new(h.hashDataType))
 
-                    calculatedBlockHashesHash.update(h.digest())
+            chunk_size = imageStream.chunk_size
+            chunks_per_segment = imageStream.chunks_per_segment
+            total = (imageStream.size + chunk_size - 1) // chunk_size
 
-                offset = offset + imageStream.chunk_size
+            samples = collections.defaultdict(list)
+            for chunkIdx in self.spot_check.Sample(total):
+                samples[chunkIdx // chunks_per_segment].append(chunkIdx)
+
+            bevies = (total + chunks_per_segment - 1) // chunks_per_segment
+            for bevy_id in range(bevies):
+                chunks_in_bevy = min(chunks_per_segment,
+                                     total - bevy_id * chunks_per_segment)
+
+                stored = []
+                for i in range(len(hash)):
+                    hashDataType = hash[i].blockHashAlgo
+                    blockLength = hashes.length(hashDataType)
+                    digests = imageStream.readBlockHashes(bevy_id, hashDataType)
+                    digests = digests[:chunks_in_bevy * blockLength]
+                    calculatedBlockHashes[i].update(digests)
+                    stored.append(digests)
+
+                chunks = samples.get(bevy_id)
+                if not chunks:
+                    continue
+
+                valid = 0
+                validDigests = []
+                for chunkIdx in chunks:
+                    offset = chunkIdx * chunk_size
+                    block = imageStream.ReadAt(offset, chunk_size)
+                    chunk_id_in_bevy = chunkIdx % chunks_per_segment
+
+                    ok = True
+                    for i in range(len(hash)):
+                        hashDataType = hash[i].blockHashAlgo
+                        blockLength = hashes.length(hashDataType)
+                        digest = _digest(hashDataType, block)
+                        storedDigest = stored[i][chunk_id_in_bevy * blockLength:
+                                                 (chunk_id_in_bevy + 1) * blockLength]
+                        if digest != storedDigest:
+                            ok = False
+                            self.listener.onInvalidBlockHash(
+                                binascii.hexlify(digest).decode("ascii"),
+                                binascii.hexlify(storedDigest).decode("ascii"),
+                                imageStreamURI, offset)
+                        else:
+                            validDigests.append(digest)
+                    if ok:
+                        valid += 1
+
+                self._reportValidBlockHashes(
+                    imageStreamURI, bevy_id * chunks_per_segment * chunk_size,
+                    valid, [validDigests])
+
+            sampled = sum(len(x) for x in samples.values())
+            self.listener.onSpotCheck(
+                imageStreamURI, sampled, total,
+                self.spot_check.DetectionProbability(sampled, total))
 
-        # we now have the block hashes hash calculated
         res = []
         for i in range(len(hash)):
-            a = hash[i].blockHashAlgo
-            b = calculatedBlockHashes[i].hexdigest()
-            c = hash[i].hashDataType
-            blockHashesHash = BlockHashesHash(a, b, c)
-            res.append(blockHashesHash)
+            res.append(BlockHashesHash(hash[i].blockHashAlgo,
+                                       calculatedBlockHashes[i].hexdigest(),
+                                       hash[i].hashDataType))
 
         return res
 
+    def _readStoredBlockHashes(self, imageStream, hashDataType, chunkIdx,
+                               count, storedBevies):
+        """Returns the stored digests of count chunks from chunkIdx."""
+        blockLength = hashes.length(hashDataType)
+        result = []
+        end = chunkIdx + count
+        while chunkIdx < end:
+            bevy_id, chunk_id_in_bevy = divmod(
+                chunkIdx, imageStream.chunks_per_segment)
+
+            cached = storedBevies.get(hashDataType)
+            if cached is None or cached[0] != bevy_id:
+                cached = (bevy_id, imageStream.readBlockHashes(
+                    bevy_id, hashDataType))
+                storedBevies[hashDataType] = cached
+
+            to_read = min(end - chunkIdx,
+                          imageStream.chunks_per_segment - chunk_id_in_bevy)
+            result.append(cached[1][chunk_id_in_bevy * blockLength:
+                                    (chunk_id_in_bevy + to_read) * blockLength])
+            chunkIdx += to_read
+
+        return b"".join(result)
+
+    def _reportInvalidBlockHashes(self, imageStreamURI, hashDataType, offset,
+                                  chunk_size, digests, stored):
+        """Reports the mismatching blocks of a batch.
+
+        Returns a list of flags, true for the blocks which matched.
+        """
+        blockLength = hashes.length(hashDataType)
+        matches = []
+        for i, digest in enumerate(digests):
+            storedDigest = stored[i * blockLength:(i + 1) * blockLength]
+            matches.append(digest == storedDigest)
+            if matches[-1]:
+                continue
+
+            self.listener.onInvalidBlockHash(
+                binascii.hexlify(digest).decode("ascii"),
+                binascii.hexlify(storedDigest).decode("ascii"),
+                imageStreamURI, offset + i * chunk_size)
+
+        return matches
+
+    def _reportValidBlockHashes(self, imageStreamURI, offset, count,
+                                validDigests):
+        digests = [binascii.hexlify(digest).decode("ascii")
+                   for blockDigests in validDigests
+                   for digest in blockDigests]
+        if digests:
+            self.listener.onValidBlockHashes(
+                imageStreamURI, offset, count, digests)
+
     def getStoredBlockHashes(self, imageStreamURI):
         hashes = []
         for hash in self.resolver.QuerySubjectPredicate(self.volume_arn, imageStreamURI, self.lexicon.blockHashesHash):
@@ -328,8 +711,8 @@ class Validator(object):
 
 # A block hash validator for AFF4 Pre-Standard images produced by Evimetry 1.x-2.1
 class PreStdValidator(Validator):
-    def __init__(self, resolver, lex, listener=None):
-        Validator.__init__(self, listener)
+    def __init__(self, resolver, lex, listener=None, workers=None, spot_check=None):
+        Validator.__init__(self, listener, workers, spot_check)
         self.resolver = resolver
         self.lexicon = lex
 
@@ -388,8 +771,8 @@ class PreStdValidator(Validator):
 
 # A block hash validator for AFF4 Interim Standard images produced by Evimetry 3.0
 class InterimStdValidator(Validator):
-    def __init__(self, resolver, lex, listener=None):
-        Validator.__init__(self, listener)
+    def __init__(self, resolver, lex, listener=None, workers=None, spot_check=None):
+        Validator.__init__(self, listener, workers, spot_check)
         self.resolver = resolver
         self.lexicon = lex
 
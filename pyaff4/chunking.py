@@ -0,0 +1,250 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Content defined chunking and chunk hashing for hash based imaging."""
+
+from builtins import object
+from builtins import range
+import bisect
+import hashlib
+import math
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyaff4 import hashes
+from pyaff4 import lexicon
+
+MIN_SIZE = 2 * 1024
+AVG_SIZE = 8 * 1024
+MAX_SIZE = 64 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+# How many bytes of chunks are hashed by the workers at a time.
+HASH_BATCH_SIZE = 4 * 1024 * 1024
+
+# The gear hash covers the last 32 bytes.
+WINDOW_SIZE = 32
+_MASK32 = (1 << 32) - 1
+
+# The gear hash maps each byte value to a random 32 bit number. It is fixed,
+# as changing it moves the chunk boundaries and so defeats deduplication
+# against existing containers.
+GEAR = tuple(struct.unpack("<I", hashlib.sha256(struct.pack("<I", i)).digest()[:4])[0]
+             for i in range(256))
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32)
+
+
+def _Mask(bits):
+    # The top bits of the gear hash depend on the most bytes.
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def _CandidatesPython(data, hardMask, easyMask):
+    hard = []
+    easy = []
+    h = 0
+    for i, b in enumerate(data):
+        h = ((h << 1) + GEAR[b]) & _MASK32
+        if not h & easyMask:
+            easy.append(i)
+            if not h & hardMask:
+                hard.append(i)
+    return hard, easy
+
+
+def _CandidatesNumpy(data, hardMask, easyMask):
+    # The gear hash after byte i is the sum of GEAR[data[i - k]] << k for
+    # k < 32, so it is built for all positions at once by doubling the
+    # number of bytes summed in each of 5 passes.
+    h = _GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    shifted = numpy.empty_like(h)
+    shift = 1
+    while shift < WINDOW_SIZE:
+        numpy.left_shift(h[:-shift], shift, out=shifted[:-shift])
+        h[shift:] += shifted[:-shift]
+        shift *= 2
+
+    easy = numpy.flatnonzero((h & numpy.uint32(easyMask)) == 0)
+    hard = easy[(h[easy] & numpy.uint32(hardMask)) == 0]
+    return hard.tolist(), easy.tolist()
+
+
+def findCandidates(data, hardMask, easyMask):
+    """Returns the positions in data after which the gear hash matches the
+    masks, as two sorted lists (hard, easy).
+
+    The hash is started afresh at the beginning of data, so it is only
+    complete from byte WINDOW_SIZE - 1 on. NumPy is used where it is installed.
+    """
+    if numpy is not None:
+        return _CandidatesNumpy(data, hardMask, easyMask)
+    return _CandidatesPython(data, hardMask, easyMask)
+
+
+def _Fill(stream, view):
+    """Reads into view until it is full or the stream ends."""
+    filled = 0
+    readinto = getattr(stream, "readinto", None)
+    while filled < len(view):
+        if readinto is not None:
+            count = readinto(view[filled:])
+        else:
+            data = stream.read(len(view) - filled)
+            count = len(data)
+            view[filled:filled + count] = data
+
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class Chunker(object):
+    """Splits a stream into content defined chunks with FastCDC.
+
+    Boundaries are found with a 32 bit gear hash. Chunks are at least
+    minSize and at most maxSize bytes long. Normalized chunking uses a
+    harder mask up to avgSize and an easier one beyond it, which keeps
+    most chunks near avgSize.
+
+    The stream is read in large buffers, and the chunks are memoryviews of
+    those buffers rather than copies. Only the unchunked tail of a buffer
+    (less than maxSize bytes) is carried over into the next one.
+    """
+
+    def __init__(self, minSize=MIN_SIZE, avgSize=AVG_SIZE, maxSize=MAX_SIZE,
+                 bufferSize=BUFFER_SIZE):
+        # Candidates past minSize must have a complete hash window.
+        if not WINDOW_SIZE <= minSize < avgSize < maxSize <= bufferSize:
+            raise ValueError("Bad chunk sizes %d/%d/%d" % (minSize, avgSize, maxSize))
+
+        self.minSize = minSize
+        self.avgSize = avgSize
+        self.maxSize = maxSize
+        self.bufferSize = bufferSize
+
+        bits = int(round(math.log(avgSize, 2)))
+        self.hardMask = _Mask(bits + 2)
+        self.easyMask = _Mask(bits - 2)
+
+    def _Cut(self, hard, easy, start, end, eof):
+        """Returns the end of the chunk starting at start, or None if more
+        data is needed to find it."""
+        i = bisect.bisect_left(hard, start + self.minSize)
+        if i < len(hard) and hard[i] < start + self.avgSize:
+            return hard[i] + 1
+
+        if end >= start + self.avgSize:
+            i = bisect.bisect_left(easy, start + self.avgSize)
+            if i < len(easy) and easy[i] < start + self.maxSize:
+                return easy[i] + 1
+
+        if end >= start + self.maxSize:
+            return start + self.maxSize
+        if eof:
+            return end
+        return None
+
+    def chunks(self, stream, length=None):
+        """Yields (offset, chunk) for the chunks of the first length bytes of
+        stream, or all of it if length is None.
+
+        Each chunk is a memoryview of a buffer which is not reused, so it
+        stays valid after the next chunk is read.
+        """
+        offset = 0
+        tail = b""
+        eof = False
+        while not eof:
+            toread = self.bufferSize
+            if length is not None:
+                toread = min(toread, length - offset - len(tail))
+
+            buffer = bytearray(len(tail) + toread)
+            buffer[:len(tail)] = tail
+            count = _Fill(stream, memoryview(buffer)[len(tail):])
+            if count < toread or toread == 0:
+                eof = True
+                del buffer[len(tail) + count:]
+
+            hard, easy = findCandidates(buffer, self.hardMask, self.easyMask)
+            view = memoryview(buffer)
+            start = 0
+            while start < len(buffer):
+                end = self._Cut(hard, easy, start, len(buffer), eof)
+                if end is None:
+                    break
+
+                yield offset + start, view[start:end]
+                start = end
+
+            tail = view[start:]
+            offset += start
+
+
+def _Sha512(chunk):
+    h = hashes.new(lexicon.HASH_SHA512)
+    h.update(chunk)
+    return h
+
+
+def _Batches(chunks, batchSize):
+    batch = []
+    size = 0
+    for item in chunks:
+        batch.append(item)
+        size += len(item[1])
+        if size >= batchSize:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def hashChunks(chunks, pool=None, batchSize=HASH_BATCH_SIZE):
+    """Adds the SHA-512 hash to each (offset, chunk) pair in chunks.
+
+    Yields (offset, chunk, hash) in the order of chunks. With a pool, the
+    chunks are gathered into batches of about batchSize bytes, and each
+    batch is hashed by the workers while the next one is read.
+    """
+    if pool is None:
+        for offset, chunk in chunks:
+            yield offset, chunk, _Sha512(chunk)
+        return
+
+    pending = None
+    for batch in _Batches(chunks, batchSize):
+        result = pool.map_async(_Sha512, [chunk for _, chunk in batch])
+        if pending is not None:
+            for item in _Hashed(*pending):
+                yield item
+        pending = (batch, result)
+
+    if pending is not None:
+        for item in _Hashed(*pending):
+            yield item
+
+
+def _Hashed(batch, result):
+    for (offset, chunk), h in zip(batch, result.get()):
+        yield offset, chunk, h
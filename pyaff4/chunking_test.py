@@ -0,0 +1,144 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import io
+import os
+import random
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from pyaff4 import chunking
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import rdfvalue
+
+
+def randomBytes(count, seed):
+    rand = random.Random(seed)
+    return bytes(bytearray(rand.getrandbits(8) for _ in range(count)))
+
+
+class ChunkerTest(unittest.TestCase):
+    def setUp(self):
+        self.data = randomBytes(300000, 1)
+        self.chunker = chunking.Chunker(minSize=256, avgSize=1024,
+                                        maxSize=4096, bufferSize=16384)
+
+    def chunks(self, chunker, data, length=None):
+        return [(offset, bytes(chunk))
+                for offset, chunk in chunker.chunks(io.BytesIO(data), length)]
+
+    def testChunks(self):
+        chunks = self.chunks(self.chunker, self.data)
+        self.assertEqual(self.data, b"".join(chunk for _, chunk in chunks))
+
+        offset = 0
+        for chunk_offset, chunk in chunks:
+            self.assertEqual(offset, chunk_offset)
+            offset += len(chunk)
+
+        for _, chunk in chunks[:-1]:
+            self.assertTrue(256 <= len(chunk) <= 4096)
+        self.assertTrue(700 < len(self.data) // len(chunks) < 1500)
+
+        # The boundaries do not depend on how the stream is buffered.
+        other = chunking.Chunker(minSize=256, avgSize=1024, maxSize=4096,
+                                 bufferSize=5000)
+        self.assertEqual(chunks, self.chunks(other, self.data))
+
+    def testLength(self):
+        chunks = self.chunks(self.chunker, self.data + b"extra", len(self.data))
+        self.assertEqual(self.data, b"".join(chunk for _, chunk in chunks))
+
+        self.assertEqual([], self.chunks(self.chunker, b""))
+        self.assertEqual([(0, b"short")], self.chunks(self.chunker, b"short"))
+
+    def testMaxSize(self):
+        # No boundaries are found in runs of a single byte value.
+        chunks = self.chunks(self.chunker, b"\x00" * 10000)
+        self.assertEqual([4096, 4096, 1808], [len(c) for _, c in chunks])
+
+    def testShift(self):
+        # Inserting bytes only changes the chunks around the insertion.
+        chunks = set(self.chunks(self.chunker, self.data))
+        shifted = set((offset - 5, chunk) for offset, chunk in
+                      self.chunks(self.chunker, b"hello" + self.data))
+        self.assertTrue(len(chunks & shifted) > len(chunks) - 5)
+
+    @unittest.skipIf(chunking.numpy is None, "NumPy is not installed")
+    def testNumpy(self):
+        data = bytearray(self.data)
+        for masks in [(self.chunker.hardMask, self.chunker.easyMask),
+                      (chunking._Mask(8), chunking._Mask(4))]:
+            self.assertEqual(chunking._CandidatesPython(data, *masks),
+                             chunking._CandidatesNumpy(data, *masks))
+
+    def testHashChunks(self):
+        chunks = list(self.chunker.chunks(io.BytesIO(self.data)))
+        serial = [(offset, h.digest())
+                  for offset, _, h in chunking.hashChunks(iter(chunks))]
+
+        pool = ThreadPool(4)
+        try:
+            parallel = [(offset, h.digest()) for offset, _, h in
+                        chunking.hashChunks(iter(chunks), pool, batchSize=10000)]
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(serial, parallel)
+
+
+class RabinHashBasedTest(unittest.TestCase):
+    filename = tempfile.gettempdir() + "/aff4_test_chunking.aff4"
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def testDedup(self):
+        data = randomBytes(200000, 2)
+        urn = rdfvalue.URN.FromFileName(self.filename)
+        pool = ThreadPool(4)
+        try:
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(resolver, urn) as volume:
+                    volume.writeLogicalStreamRabinHashBased(
+                        "/a", io.BytesIO(data), len(data))
+                    stored = volume.block_store_stream.TellWrite()
+
+                    # Only the chunks around the change are stored again.
+                    volume.writeLogicalStreamRabinHashBased(
+                        "/b", io.BytesIO(data[:1000] + b"changed" + data[1000:]),
+                        len(data) + 7, pool=pool)
+                    self.assertTrue(
+                        volume.block_store_stream.TellWrite() - stored < 3 * chunking.AVG_SIZE)
+        finally:
+            pool.close()
+            pool.join()
+
+        with container.Container.openURNtoContainer(urn) as volume:
+            images = dict((image.pathName.value, image) for image in volume.images())
+            with volume.resolver.AFF4FactoryOpen(images["/a"].urn) as fd:
+                self.assertEqual(data, fd.Read(fd.Size()))
+            with volume.resolver.AFF4FactoryOpen(images["/b"].urn) as fd:
+                self.assertEqual(data[:1000] + b"changed" + data[1000:], fd.Read(fd.Size()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import io
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from pyaff4 import aff4_image
+from pyaff4 import aff4_map
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import lexicon
+from pyaff4 import rdfvalue
+from pyaff4 import utils
+from pyaff4 import zip
+
+
+class ConcurrentReadTest(unittest.TestCase):
+    filename = tempfile.gettempdir() + u"/aff4_test_concurrent.aff4"
+    filename_urn = rdfvalue.URN.FromFileName(filename)
+
+    def setUp(self):
+        self.streams = {}
+        for i in range(4):
+            self.streams["/file%d" % i] = os.urandom(
+                random.randint(1000, 50000))
+
+        try:
+            os.unlink(self.filename)
+        except (IOError, OSError):
+            pass
+
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, self.filename_urn) as volume:
+                volume.maxSegmentResidentSize = 64 * 1024
+                for path, data in self.streams.items():
+                    volume.writeLogical(path, io.BytesIO(data), len(data))
+
+    def tearDown(self):
+        try:
+            os.unlink(self.filename)
+        except (IOError, OSError):
+            pass
+
+    def testConcurrentReads(self):
+        with container.Container.openURNtoContainer(self.filename_urn) as volume:
+            urns = dict((utils.SmartUnicode(image.pathName), image.urn)
+                        for image in volume.images())
+            self.assertEqual(sorted(urns), sorted(self.streams))
+
+            volume.resolver.EnableConcurrentReads()
+            errors = []
+
+            def worker(seed):
+                rand = random.Random(seed)
+                try:
+                    for _ in range(200):
+                        path = rand.choice(sorted(self.streams))
+                        expected = self.streams[path]
+                        offset = rand.randint(0, len(expected) - 1)
+                        length = rand.randint(1, 4096)
+                        with volume.resolver.AFF4FactoryOpen(urns[path]) as fd:
+                            fd.SeekRead(offset)
+                            data = fd.Read(length)
+                            if data != expected[offset:offset + length]:
+                                errors.append((path, offset, length))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker, args=(i,))
+                       for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+
+    def _checkReads(self, resolver, urns, streams):
+        errors = []
+
+        def worker(seed):
+            rand = random.Random(seed)
+            try:
+                for _ in range(200):
+                    name = rand.choice(sorted(streams))
+                    expected = streams[name]
+                    offset = rand.randint(0, len(expected) - 1)
+                    length = rand.randint(1, 1000)
+                    with resolver.AFF4FactoryOpen(urns[name]) as fd:
+                        fd.SeekRead(offset)
+                        data = fd.Read(length)
+                        if data != expected[offset:offset + length]:
+                            errors.append((name, offset, length))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+    def testConcurrentImageAndMapReads(self):
+        version = container.Version(1, 1, "pyaff4")
+        data = os.urandom(20000)
+        half = len(data) // 2
+
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn,
+                         lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+            with zip.ZipFile.NewZipFile(
+                    resolver, version, self.filename_urn) as zip_file:
+                image_urn = zip_file.urn.Append("image")
+                map_urn = zip_file.urn.Append("map")
+                with zip_file.CreateMember(
+                        zip_file.urn.Append("container.description")) as fd:
+                    fd.Write(zip_file.urn.SerializeToString().encode("utf-8"))
+
+                # Small chunks make most reads span several bevies.
+                with aff4_image.AFF4Image.NewAFF4Image(
+                        resolver, image_urn, zip_file.urn) as image:
+                    image.chunk_size = 100
+                    image.chunks_per_segment = 4
+                    image.Write(data)
+
+                # The map swaps the two halves of the image.
+                with aff4_map.AFF4Map.NewAFF4Map(
+                        resolver, map_urn, zip_file.urn) as image_map:
+                    image_map.AddRange(0, half, len(data) - half, image_urn)
+                    image_map.AddRange(len(data) - half, 0, half, image_urn)
+
+        streams = dict(image=data, map=data[half:] + data[:half])
+        urns = dict(image=image_urn, map=map_urn)
+
+        with data_store.MemoryDataStore() as resolver:
+            with zip.ZipFile.NewZipFile(
+                    resolver, version, self.filename_urn) as zip_file:
+                resolver.EnableConcurrentReads()
+                self._checkReads(resolver, urns, streams)
+
+                # Cursors only expose the shared stream's read only state.
+                with resolver.AFF4FactoryOpen(image_urn) as fd:
+                    self.assertEqual(fd.urn, image_urn)
+                    with self.assertRaises(AttributeError):
+                        fd.chunk_size
+                    with self.assertRaises(IOError):
+                        fd.write(b"data")
+
+    def testMetadataIsReadOnly(self):
+        with container.Container.openURNtoContainer(self.filename_urn) as volume:
+            volume.resolver.EnableConcurrentReads()
+            with self.assertRaises(RuntimeError):
+                volume.resolver.Set(lexicon.transient_graph, volume.urn,
+                                    lexicon.AFF4_STREAM_WRITE_MODE,
+                                    rdfvalue.XSDString("append"))
+
+
+if __name__ == '__main__':
+    unittest.main()
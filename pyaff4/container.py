@@ -29,13 +29,13 @@ from pyaff4 import aff4
 from pyaff4 import escaping
 from pyaff4.aff4_metadata import RDFObject
 from pyaff4 import zip, keybag
+from pyaff4 import chunking, path_index
 from pyaff4.version import Version
 from pyaff4 import utils
 
 import yaml
 import uuid
 import base64
-import fastchunking
 
 class Image(object):
     def __init__(self, image, resolver, dataStream):
@@ -69,6 +69,7 @@ class Container(object):
         self.resolver.ObjectCache.Get(self.backing_store.urn)
         self.zip_file = zip_file
         self.resolver.ObjectCache.Get(self.zip_file.urn)
+        self._pathIndex = None
 
 
     def __enter__(self):
@@ -276,12 +277,27 @@ class Container(object):
         else:
             return False
 
+    def pathIndex(self):
+        """Returns a path_index.PathIndex of the file images in the volume.
+
+        It is built from the metadata on first use.
+        """
+        if self._pathIndex is None:
+            self._pathIndex = path_index.PathIndex(
+                (image.pathName, image.urn) for image in self.images())
+        return self._pathIndex
+
 class PhysicalImageContainer(Container):
     def __init__(self, backing_store, zip_file, version, volumeURN, resolver, lex, image, dataStream):
         super(PhysicalImageContainer, self).__init__(backing_store, zip_file, version, volumeURN, resolver, lex)
         self.image = Image(image, resolver, dataStream)
         self.dataStream = dataStream
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The data stream was opened for us, release it with the volume.
+        self.resolver.Return(self.dataStream)
+        super(PhysicalImageContainer, self).__exit__(exc_type, exc_value, traceback)
+
 class LogicalImageContainer(Container):
     def __init__(self, backing_store, zip_file, version, volumeURN, resolver, lex):
         super(LogicalImageContainer, self).__init__(backing_store, zip_file, version, volumeURN, resolver, lex)
@@ -356,19 +372,22 @@ class WritableLogicalImageContainer(Container):
                     versionFile.Flush()
 
     # write the logical stream as a compressed block stream using the Stream API
-    def writeCompressedBlockStream(self, image_urn, filename, readstream):
+    def writeCompressedBlockStream(self, image_urn, filename, readstream, pool=None):
         with aff4_image.AFF4Image.NewAFF4Image(self.resolver, image_urn, self.urn) as stream:
             stream.compression = lexicon.AFF4_IMAGE_COMPRESSION_SNAPPY
-            stream.WriteStream(readstream)
+            stream.WriteStream(readstream, pool=pool)
+
+    # the zip compression method used for logical images stored as zip segments
+    def zipCompressionMethod(self):
+        if self.compression_method is not None and self.compression_method == lexicon.AFF4_IMAGE_COMPRESSION_STORED:
+            return zip.ZIP_STORED
+        return zip.ZIP_DEFLATE
 
         # write the logical stream as a zip segment using the Stream API
     def writeZipStream(self, image_urn, filename, readstream, progress=None):
         with self.resolver.AFF4FactoryOpen(self.urn) as volume:
             with volume.CreateMember(image_urn) as streamed:
-                if self.compression_method is not None and self.compression_method == lexicon.AFF4_IMAGE_COMPRESSION_STORED:
-                    streamed.compression_method = zip.ZIP_STORED
-                else:
-                    streamed.compression_method = zip.ZIP_DEFLATE
+                streamed.compression_method = self.zipCompressionMethod()
                 streamed.WriteStream(readstream, progress=progress)
 
     # create a file like object for writing a logical image as a new compressed block stream
@@ -404,15 +423,13 @@ class WritableLogicalImageContainer(Container):
         self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(filename))
         return writer
 
-    def writeLogicalStream(self, filename, readstream, length, allow_large_zipsegments=False, progress=None):
-        image_urn = None
-        if self.isAFF4Collision(filename):
-            image_urn = rdfvalue.URN("aff4://%s" % uuid.uuid4())
-        else:
-            image_urn = self.urn.Append(escaping.arnPathFragment_from_path(filename), quote=False)
+    def writeLogicalStream(self, filename, readstream, length, allow_large_zipsegments=False, progress=None, pool=None,
+                           image_urn=None):
+        if image_urn is None:
+            image_urn = self.newImageURN(filename)
 
         if length > self.maxSegmentResidentSize and not allow_large_zipsegments:
-            self.writeCompressedBlockStream(image_urn, filename, readstream)
+            self.writeCompressedBlockStream(image_urn, filename, readstream, pool=pool)
             self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
                               rdfvalue.URN(lexicon.AFF4_IMAGE_TYPE))
         else:
@@ -424,6 +441,21 @@ class WritableLogicalImageContainer(Container):
         self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(filename))
         return image_urn
 
+    # write a logical image from data already compressed with zipCompressionMethod()
+    def writeCompressedLogicalStream(self, filename, data, length, crc32, image_urn=None):
+        if image_urn is None:
+            image_urn = self.newImageURN(filename)
+
+        with self.resolver.AFF4FactoryOpen(self.urn) as volume:
+            volume.AddCompressedMember(image_urn, data, length, crc32,
+                                       compression_method=self.zipCompressionMethod())
+
+        self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.AFF4_ZIP_SEGMENT_IMAGE_TYPE))
+        self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.standard11.FileImage))
+        self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.standard.Image))
+        self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(filename))
+        return image_urn
+
     def writeLogical(self, filename, readstream, length):
         image_urn = None
         if self.isAFF4Collision(filename):
@@ -442,6 +474,18 @@ class WritableLogicalImageContainer(Container):
         self.resolver.Add(self.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(filename))
         return image_urn
 
+    def pathIndex(self):
+        # images are still being added, so the index is not kept
+        return path_index.PathIndex(
+            (image.pathName, image.urn) for image in self.images())
+
+    def newImageURN(self, filename):
+        """Returns the URN to store an image of filename under: its path, or a
+        fresh aff4:// URN if the path is reserved."""
+        if self.isAFF4Collision(filename):
+            return rdfvalue.URN("aff4://%s" % uuid.uuid4())
+        return self.urn.Append(escaping.arnPathFragment_from_path(filename), quote=False)
+
     def isAFF4Collision(self, filename):
         if filename in ["information.turtle", "version.txt", "container.description"]:
             return True
@@ -506,64 +550,21 @@ class WritableHashBasedImageContainer(WritableLogicalImageContainer):
             else:
                 logical_file_map.AddRange(chunk_offset, 0, len(chunk), hashid)
 
-    def writeLogicalStreamRabinHashBased(self, filename, readstream, length, check_bytes=False):
-        logical_file_id = None
-        if self.isAFF4Collision(filename):
-            logical_file_id = rdfvalue.URN("aff4://%s" % uuid.uuid4())
-        else:
-            logical_file_id = self.urn.Append(escaping.arnPathFragment_from_path(filename), quote=False)
-
-        chunk_size = 32*1024
-        cdc = fastchunking.RabinKarpCDC(window_size=48, seed=0)
-        chunker = cdc.create_chunker(chunk_size=4096)
+    def writeLogicalStreamRabinHashBased(self, filename, readstream, length, check_bytes=False, pool=None,
+                                         image_urn=None):
+        # content defined chunks (FastCDC), hashed on the pool's workers if given
+        chunks = chunking.Chunker().chunks(readstream, length)
+        return self.writeHashedChunks(filename, chunking.hashChunks(chunks, pool), check_bytes, image_urn)
 
+    # write a logical image from (offset, chunk, sha512 hash) tuples, in order
+    def writeHashedChunks(self, filename, hashed_chunks, check_bytes=False, image_urn=None):
+        logical_file_id = image_urn
+        if logical_file_id is None:
+            logical_file_id = self.newImageURN(filename)
 
         with aff4_map.AFF4Map.NewAFF4Map(
                 self.resolver, logical_file_id, self.urn) as logical_file_map:
-            file_offset = 0
-            lastbuffer = None
-            lastoffset = 0
-            chunk_offset = 0
-            while file_offset < length:
-                toread = min(length-file_offset, chunk_size)
-                buffer = readstream.read(toread)
-
-                foundBoundaries = False
-                for boundary in chunker.next_chunk_boundaries(buffer):
-                    foundBoundaries = True
-
-                    if lastbuffer != None:
-                        l = len(lastbuffer)
-                        chunk = lastbuffer[lastoffset:]
-                        chunk_offset = file_offset - len(chunk)
-                        chunk = chunk + buffer[:boundary]
-                        lastbuffer = None
-                    else:
-                        chunk = buffer[lastoffset:boundary]
-                        chunk_offset = file_offset + lastoffset
-
-                    h = hashes.new(lexicon.HASH_SHA512)
-                    h.update(chunk)
-
-                    self.preserveChunk(logical_file_map, chunk, chunk_offset, h, check_bytes)
-
-                    lastoffset = boundary
-
-                if not foundBoundaries:
-                    if lastbuffer != None:
-                        lastbuffer = lastbuffer + buffer
-                    else:
-                        lastbuffer = buffer
-                else:
-                    lastbuffer = buffer
-                file_offset += toread
-
-
-            if lastbuffer != None and lastoffset < len(lastbuffer):
-                chunk = lastbuffer[lastoffset:]
-                chunk_offset = file_offset - len(chunk)
-                h = hashes.new(lexicon.HASH_SHA512)
-                h.update(chunk)
+            for chunk_offset, chunk, h in hashed_chunks:
                 self.preserveChunk(logical_file_map, chunk, chunk_offset, h, check_bytes)
 
         logical_file_map.Close()
@@ -573,7 +574,22 @@ class WritableHashBasedImageContainer(WritableLogicalImageContainer):
         self.resolver.Add(self.urn, logical_file_id, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(filename))
         return logical_file_id
 
-    def writeLogicalStreamHashBased(self, filename, readstream, length, check_bytes=False):
+    def readPaddedChunks(self, readstream, length, chunk_size):
+        file_offset = 0
+        while file_offset < length:
+            toread = min(length-file_offset, chunk_size)
+            chunk = readstream.read(toread)
+
+            # pad the chunk to chunksize if it is small
+            read_chunk_size = len(chunk)
+            if read_chunk_size < chunk_size:
+                chunk = chunk + b"\x00" * (chunk_size - read_chunk_size)
+
+            yield file_offset, chunk
+            file_offset += toread
+
+    def writeLogicalStreamHashBased(self, filename, readstream, length, check_bytes=False, pool=None):
+        # chunks are hashed in batches on the pool's workers if given, and written in order
         logical_file_id = None
         if self.isAFF4Collision(filename):
             logical_file_id = rdfvalue.URN("aff4://%s" % uuid.uuid4())
@@ -584,18 +600,9 @@ class WritableHashBasedImageContainer(WritableLogicalImageContainer):
 
         with aff4_map.AFF4Map.NewAFF4Map(
                 self.resolver, logical_file_id, self.urn) as logical_file_map:
-            file_offset = 0
-            while file_offset < length:
+            chunks = self.readPaddedChunks(readstream, length, chunk_size)
+            for file_offset, chunk, h in chunking.hashChunks(chunks, pool):
                 toread = min(length-file_offset, chunk_size)
-                chunk = readstream.read(toread)
-
-                # pad the chunk to chunksize if it is small
-                read_chunk_size = len(chunk)
-                if read_chunk_size < chunk_size:
-                    chunk = chunk + b"\x00" * (chunk_size - read_chunk_size)
-
-                h = hashes.new(lexicon.HASH_SHA512)
-                h.update(chunk)
                 # we use RFC rfc4648
                 hashid = rdfvalue.URN("aff4:sha512:" + base64.urlsafe_b64encode(h.digest()).decode())
 
@@ -639,8 +646,6 @@ class WritableHashBasedImageContainer(WritableLogicalImageContainer):
                         logical_file_map.AddRange(file_offset, 0, toread, hashid)
                     #print("[%x, %x] -> %s -> %s" % (file_offset, toread, hashid, existing_bytestream_reference_id))
 
-                file_offset += toread
-
         logical_file_map.Close()
 
         self.resolver.Add(self.urn, logical_file_id, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.standard11.FileImage))
@@ -752,10 +757,18 @@ class EncryptedImageContainer(Container):
 
         return super(EncryptedImageContainer, self).__exit__(exc_type, exc_value, traceback)
 
-    def setPassword(self, password):
+    def setPassword(self, password, keyCache=None):
+        """Unlocks (or, for a new container, protects) it with password.
+
+        If keyCache is a keybag.KeyCache, keys it already holds are reused
+        rather than unwrapped again.
+        """
         if len(self.block_store_stream.keybags) > 0:
             for passKeyBag in filter(lambda x: type(x) == keybag.PasswordWrappedKeyBag, self.block_store_stream.keybags):
-                vek = passKeyBag.unwrap_key(password)
+                if keyCache is not None:
+                    vek = keyCache.Unwrap(passKeyBag, password)
+                else:
+                    vek = passKeyBag.unwrap_key(password)
                 self.block_store_stream.setKey(vek)
         else:
             kb = keybag.PasswordWrappedKeyBag.create(password)
@@ -769,9 +782,12 @@ class EncryptedImageContainer(Container):
         kb.write(self.resolver, self.block_store_stream.urn)
         self.resolver.Add(self.urn, self.block_store_stream.urn, lexicon.standard11.keyBag, kb.ID)
 
-    def setPrivateKey(self, privateKey):
+    def setPrivateKey(self, privateKey, keyCache=None):
         for certKeyBag in filter(lambda x: type(x) == keybag.CertEncryptedKeyBag, self.block_store_stream.keybags):
-            vek = certKeyBag.unwrap_key(privateKey)
+            if keyCache is not None:
+                vek = keyCache.Unwrap(certKeyBag, privateKey)
+            else:
+                vek = certKeyBag.unwrap_key(privateKey)
             self.block_store_stream.setKey(vek)
         self.init_child()
 
@@ -343,6 +343,31 @@ class AFF4ImageTest(unittest.TestCase):
                     txt = fd.ReadAll()
                     self.assertEqual(src, txt)
 
+    def testCreateAndReadMultipleBevies(self):
+        try:
+            os.unlink(self.filenameB)
+        except (IOError, OSError):
+            pass
+
+        data = os.urandom(2 * 1024 * 1024 + 1000)
+        container_urn = rdfvalue.URN.FromFileName(self.filenameB)
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, container_urn, encryption=True) as volume:
+                volume.setPassword("password")
+                logicalContainer = volume.getChildContainer()
+                with logicalContainer.newLogicalStream("hello", len(data)) as w:
+                    w.Write(data)
+
+        with container.Container.openURNtoContainer(container_urn) as volume:
+                volume.setPassword("password")
+                childVolume = volume.getChildContainer()
+                images = list(childVolume.images())
+                with childVolume.resolver.AFF4FactoryOpen(images[0].urn) as fd:
+                    self.assertEqual(len(data), fd.Size())
+                    for offset in (len(data) - 100, 0, 1024 * 1024 - 10, 600):
+                        self.assertEqual(data[offset:offset + 5000],
+                                         fd.ReadAt(offset, 5000))
+
     @unittest.skip
     def testCreateThenRead(self):
         self.create()
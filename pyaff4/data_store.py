@@ -29,6 +29,7 @@ import tempfile
 import traceback
 import subprocess
 import sys
+import threading
 import types
 import binascii
 
@@ -62,17 +63,30 @@ except:
 # Coerce rdflib to use
 rdflib.term._toPythonMapping[URIRef(XSD_NAMESPACE + 'hexBinary')] = lambda s: binascii.unhexlify(s)
 
+# Hash based (deduplicated) chunk references are bound to their storage by
+# aff4:dataStream.
+HASH_REFERENCE_PREFIX = u"aff4:sha512:"
+DATASTREAM = utils.SmartUnicode(lexicon.standard.dataStream)
+
 #HAS_HDT = False
 def CHECK(condition, error):
     if not condition:
         raise RuntimeError(error)
 
+# Default limits for the resolver's object cache. The weight is an estimate
+# of the memory held by the (unused) cached objects, in bytes.
+OBJECT_CACHE_MAX_ITEMS = 64
+OBJECT_CACHE_MAX_WEIGHT = 256 * 1024 * 1024
+
+
 class AFF4ObjectCacheEntry(object):
     def __init__(self, key, aff4_obj):
         self.next = self.prev = self
         self.key = key
         self.aff4_obj = aff4_obj
         self.use_count = 0
+        self.weight = 0
+        self.lock = None
 
     def unlink(self):
         self.next.prev = self.prev
@@ -97,120 +111,204 @@ class AFF4ObjectCacheEntry(object):
 
 
 class AFF4ObjectCache(object):
-    def __init__(self, max_items):
+    """An LRU cache of AFF4 objects.
+
+    Objects which are in use are held in in_use, and are never expired. Once
+    returned they go onto the LRU list, which is trimmed to max_items
+    objects and (if set) max_weight bytes of estimated memory, flushing
+    evicted objects if they are dirty.
+
+    Objects are normally modified while in use, so we note which objects are
+    dirty as they are returned (or as they become dirty, if already returned)
+    and only need to visit those when flushing.
+
+    The cache itself is safe to use from several threads. Threads sharing an
+    object serialize access to it through GetLock().
+    """
+
+    def __init__(self, max_items, max_weight=None):
         self.max_items = max_items
+        self.max_weight = max_weight
         self.in_use = {}
         self.lru_map = {}
         self.lru_list = AFF4ObjectCacheEntry(None, None)
         self.volume_file_map = {}
 
+        # Keys of the objects in the LRU list which may be dirty. Kept in the
+        # order they were noted so that objects are flushed (and so written
+        # to the volume) in a repeatable order.
+        self.dirty = collections.OrderedDict()
+        self.weight = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.forced_flushes = 0
+
+        self.lock = threading.RLock()
+
+    def Stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    forced_flushes=self.forced_flushes,
+                    items=len(self.lru_map), in_use=len(self.in_use),
+                    weight=self.weight)
+
     def _Trim(self, size=None):
         max_items = size or self.max_items
-        while len(self.lru_map) > max_items:
+        while self.lru_map and (len(self.lru_map) > max_items or (
+                self.max_weight is not None and self.weight > self.max_weight)):
             older_item = self.lru_list.prev
             #LOGGER.debug("Trimming %s from cache" % older_item.key)
 
-            self.lru_map.pop(older_item.key)
-            older_item.unlink()
+            self._Unlink(older_item)
+            self.evictions += 1
 
-            # Ensure we flush the trimmed objects.
-            older_item.aff4_obj.Flush()
+            # Ensure we flush the trimmed objects. Clean ones are simply
+            # dropped.
+            if older_item.aff4_obj.IsDirty():
+                self.forced_flushes += 1
+                older_item.aff4_obj.Flush()
 
-    def Put(self, aff4_obj, in_use_state=False):
-        if type(aff4_obj) == aff4_map.ByteRangeARN:
-            return
-        key = aff4_obj.urn.SerializeToString()
-        #LOGGER.debug("Putting %s in cache" % key)
-        CHECK(key not in self.in_use,
-              u"Object %s Put in cache while already in use." % utils.SmartUnicode(key))
+    def _Weigh(self, entry):
+        weight = entry.aff4_obj.CacheWeight()
+        self.weight += weight - entry.weight
+        entry.weight = weight
 
-        CHECK(key not in self.lru_map,
-              u"Object %s Put in cache while already in cache." % utils.SmartUnicode(key))
+    def _Link(self, entry):
+        entry.weight = 0
+        self.lru_list.append(entry)
+        self.lru_map[entry.key] = entry
+        self._Weigh(entry)
+        if entry.aff4_obj.IsDirty():
+            self.dirty[entry.key] = True
 
-        entry = AFF4ObjectCacheEntry(key, aff4_obj)
-        if in_use_state:
-            entry.use_count = 1
-            self.in_use[key] = entry
-            return
+    def _Unlink(self, entry):
+        self.lru_map.pop(entry.key)
+        entry.unlink()
+        self.weight -= entry.weight
+        self.dirty.pop(entry.key, None)
 
-        self.lru_list.append(entry)
-        self.lru_map[key] = entry
+    def Put(self, aff4_obj, in_use_state=False):
+        with self.lock:
+            if type(aff4_obj) == aff4_map.ByteRangeARN:
+                return
+            key = aff4_obj.urn.SerializeToString()
+            #LOGGER.debug("Putting %s in cache" % key)
+            CHECK(key not in self.in_use,
+                  u"Object %s Put in cache while already in use." % utils.SmartUnicode(key))
+
+            CHECK(key not in self.lru_map,
+                  u"Object %s Put in cache while already in cache." % utils.SmartUnicode(key))
+
+            entry = AFF4ObjectCacheEntry(key, aff4_obj)
+            if in_use_state:
+                entry.use_count = 1
+                self.in_use[key] = entry
+                return
 
-        self._Trim()
+            self._Link(entry)
+            self._Trim()
 
     def Contains(self, urn):
-        key = rdfvalue.URN(urn).SerializeToString()
-        entry = self.in_use.get(key)
-        if entry is not None:
-            return True
-
-        entry = self.lru_map.get(key)
-        if entry is not None:
-            return True
-        return False
-
-    def Get(self, urn):
-        key = rdfvalue.URN(urn).SerializeToString()
-        #LOGGER.debug("Getting %s from cache" % key)
-        entry = self.in_use.get(key)
-        if entry is not None:
-            entry.use_count += 1
-            return entry.aff4_obj
+        with self.lock:
+            key = rdfvalue.URN(urn).SerializeToString()
+            entry = self.in_use.get(key)
+            if entry is not None:
+                return True
 
-        # Hold onto the entry.
-        entry = self.lru_map.pop(key, None)
-        if entry is None:
-            return None
+            entry = self.lru_map.get(key)
+            if entry is not None:
+                return True
+            return False
 
-        entry.use_count = 1
+    def Get(self, urn):
+        with self.lock:
+            key = rdfvalue.URN(urn).SerializeToString()
+            #LOGGER.debug("Getting %s from cache" % key)
+            entry = self.in_use.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry.use_count += 1
+                return entry.aff4_obj
+
+            # Hold onto the entry.
+            entry = self.lru_map.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry.use_count = 1
 
-        # Remove it from the LRU list.
-        entry.unlink()
-        self.in_use[key] = entry
+            # Remove it from the LRU list.
+            self._Unlink(entry)
+            self.in_use[key] = entry
 
-        return entry.aff4_obj
+            return entry.aff4_obj
 
     def Return(self, aff4_obj):
-        if type(aff4_obj) == aff4_image.AFF4SImage:
-            print
-        if type(aff4_obj) == aff4_map.ByteRangeARN:
-            return
-        key = aff4_obj.urn.SerializeToString()
-        #LOGGER.debug("Returning %s in cache" % key)
-        entry = self.in_use.get(key)
-        CHECK(entry is not None,
-              u"Object %s Returned to cache, but it is not in use!" % key)
-        CHECK(entry.use_count > 0,
-              u"Returned object %s is not used." % key)
-
-        entry.use_count -= 1
-        if entry.use_count == 0:
-            self.lru_list.append(entry)
-            self.lru_map[key] = entry
-            self.in_use.pop(key)
-
-            self._Trim()
+        with self.lock:
+            if type(aff4_obj) == aff4_map.ByteRangeARN:
+                return
+            key = aff4_obj.urn.SerializeToString()
+            #LOGGER.debug("Returning %s in cache" % key)
+            entry = self.in_use.get(key)
+            CHECK(entry is not None,
+                  u"Object %s Returned to cache, but it is not in use!" % key)
+            CHECK(entry.use_count > 0,
+                  u"Returned object %s is not used." % key)
+
+            entry.use_count -= 1
+            if entry.use_count == 0:
+                self.in_use.pop(key)
+                self._Link(entry)
+
+                self._Trim()
+
+    def NoteDirty(self, aff4_obj):
+        """Called by objects as they become dirty.
+
+        An object marked dirty after it was returned would otherwise be missed
+        by Flush(), and its weight would be stale.
+        """
+        with self.lock:
+            entry = self.lru_map.get(aff4_obj.urn.SerializeToString())
+            if entry is not None and entry.aff4_obj is aff4_obj:
+                self.dirty[entry.key] = True
+                self._Weigh(entry)
+
+    def GetLock(self, aff4_obj):
+        """Returns the lock guarding an object which is in use."""
+        with self.lock:
+            key = aff4_obj.urn.SerializeToString()
+            entry = self.in_use.get(key)
+            CHECK(entry is not None,
+                  u"Object %s locked, but it is not in use!" % key)
+            if entry.lock is None:
+                entry.lock = threading.RLock()
+
+            return entry.lock
 
     def Remove(self, aff4_obj):
-        if type(aff4_obj) == aff4_image.AFF4SImage:
-            print
-        key = aff4_obj.urn.SerializeToString()
-        #LOGGER.debug("Removing %s in cache" % key)
-        entry = self.lru_map.pop(key, None)
-        if entry is not None:
-            entry.unlink()
-            entry.aff4_obj.Flush()
-            return
+        with self.lock:
+            key = aff4_obj.urn.SerializeToString()
+            #LOGGER.debug("Removing %s in cache" % key)
+            entry = self.lru_map.get(key)
+            if entry is not None:
+                self._Unlink(entry)
+                entry.aff4_obj.Flush()
+                return
 
-        # Is the item in use?
-        entry = self.in_use.pop(key, None)
-        if entry is not None:
-            entry.unlink()
-            entry.aff4_obj.Flush()
-            return
+            # Is the item in use?
+            entry = self.in_use.pop(key, None)
+            if entry is not None:
+                entry.unlink()
+                entry.aff4_obj.Flush()
+                return
 
-        CHECK(False,
-              "Object %s removed from cache, but was never there." % key)
+            CHECK(False,
+                  "Object %s removed from cache, but was never there." % key)
 
     def Dump(self):
         # Now dump the objects in use.
@@ -223,58 +321,63 @@ class AFF4ObjectCache(object):
             print(u"%s - %s" % (utils.SmartUnicode(entry.key), entry.use_count))
 
     def Flush(self, partial=False):
-        # It is an error to flush the object cache while there are still items
-        # in use.
-        if not partial and len(self.in_use):
-            self.Dump()
-            CHECK(len(self.in_use) == 0,
-                  "ObjectCache flushed while some objects in use!")
-
-        # First flush all objects without deleting them since some flushed
-        # objects may still want to use other cached objects. It is also
-        # possible that new objects are added during object deletion. Therefore
-        # we keep doing it until all objects are clean.
-        while 1:
-            dirty_objects_found = False
-
-            for it in self.lru_list:
-                if it.aff4_obj.IsDirty():
-                    dirty_objects_found = True
-                    LOGGER.debug("Flushing %s in cache" % it.key)
-                    it.aff4_obj.Flush()
-
-            if not dirty_objects_found:
-                break
-
-        if partial:
-            return
+        with self.lock:
+            # It is an error to flush the object cache while there are still items
+            # in use.
+            if not partial and len(self.in_use):
+                self.Dump()
+                CHECK(len(self.in_use) == 0,
+                      "ObjectCache flushed while some objects in use!")
+
+            # First flush all objects without deleting them since some flushed
+            # objects may still want to use other cached objects. It is also
+            # possible that new objects are added during object deletion. Therefore
+            # we keep doing it until all objects are clean.
+            while self.dirty:
+                key, _ = self.dirty.popitem(last=False)
+                entry = self.lru_map.get(key)
+                if entry is not None and entry.aff4_obj.IsDirty():
+                    LOGGER.debug("Flushing %s in cache" % key)
+                    entry.aff4_obj.Flush()
+
+            if partial:
+                return
 
-        # Now delete all entries.
-        for it in list(self.lru_map.values()):
-            aff4o = it.aff4_obj
-            LOGGER.debug("Closing %s in cache" % it.key)
-            aff4o.Close()
-            it.unlink()
+            # Now delete all entries.
+            for it in list(self.lru_map.values()):
+                aff4o = it.aff4_obj
+                LOGGER.debug("Closing %s in cache" % it.key)
+                aff4o.Close()
+                it.unlink()
 
 
-        # Clear the map.
-        self.lru_map.clear()
+            # Clear the map.
+            self.lru_map.clear()
+            self.weight = 0
 
 class MemoryDataStore(object):
     aff4NS = None
 
-    def __init__(self, lex=lexicon.standard, parent=None):
+    def __init__(self, lex=lexicon.standard, parent=None,
+                 cache_max_items=OBJECT_CACHE_MAX_ITEMS,
+                 cache_max_weight=OBJECT_CACHE_MAX_WEIGHT):
         self.lexicon = lex
         self.loadedVolumes = []
         self.store = collections.OrderedDict()
         self.transient_store = collections.OrderedDict()
         if parent == None:
-            self.ObjectCache = AFF4ObjectCache(10)
+            self.ObjectCache = AFF4ObjectCache(cache_max_items, cache_max_weight)
         else:
             self.ObjectCache = parent.ObjectCache
         self.flush_callbacks = {}
         self.parent = parent
 
+        # Set by EnableConcurrentReads().
+        self.concurrent = False
+
+        # aff4:sha512 chunk references, parsed once as they are loaded.
+        self.hash_references = aff4_map.HashReferenceTable()
+
         if self.lexicon == lexicon.legacy:
             self.streamFactory = stream_factory.PreStdStreamFactory(
                 self, self.lexicon)
@@ -283,6 +386,22 @@ class MemoryDataStore(object):
                 self, self.lexicon)
 
 
+    def EnableConcurrentReads(self):
+        """Switches the resolver into read only concurrent mode.
+
+        Once the containers of interest are opened, the metadata is frozen and
+        several threads may then open and read streams through this resolver.
+        Each AFF4FactoryOpen() of a stream returns a private read cursor over
+        the shared, cached stream.
+        """
+        self.concurrent = True
+        if self.parent != None:
+            self.parent.EnableConcurrentReads()
+
+    def _CheckWritable(self):
+        CHECK(not self.concurrent,
+              "Resolver is read only while in concurrent read mode.")
+
     def __enter__(self):
         return self
 
@@ -304,7 +423,9 @@ class MemoryDataStore(object):
             cb()
 
     def DeleteSubject(self, subject):
+        self._CheckWritable()
         self.store.pop(rdfvalue.URN(subject), None)
+        self.hash_references.Remove(rdfvalue.URN(subject).SerializeToString())
 
     def CacheContains(self, arn):
         return self.ObjectCache.Contains(arn)
@@ -584,6 +705,8 @@ class MemoryDataStore(object):
         # Is the object cached?
         cached_obj = self.ObjectCache.Get(urn)
         if cached_obj:
+            if self.concurrent:
+                return self._ConcurrentCursor(cached_obj)
             cached_obj.Prepare()
             #LOGGER.debug("AFF4FactoryOpen (Cached): %s" % urn)
             return cached_obj
@@ -598,9 +721,14 @@ class MemoryDataStore(object):
             #if cached_obj:
             #    cached_obj.Prepare()
             #    return cached_obj
-            bytestream_reference_id = self.GetUnique(lexicon.any, urn, rdfvalue.URN(lexicon.standard.dataStream))
+            reference = self.ResolveHashReference(urn)
+            if reference is None:
+                raise IOError("Unable to resolve hash reference %s" % urn)
+            (target, offset, length) = reference
+            bytestream_reference_id = rdfvalue.URN(
+                "%s[0x%x:0x%x]" % (target.value, offset, length))
             return aff4_map.ByteRangeARN(version, resolver=self, urn=bytestream_reference_id)
-        elif isByteRangeARN(urn.SerializeToString()):
+        elif isByteRangeARN(urn):
             return aff4_map.ByteRangeARN(version, resolver=self, urn=urn)
         else:
             uri_types = self.Get(lexicon.any, urn, rdfvalue.URN(lexicon.AFF4_TYPE))
@@ -635,6 +763,20 @@ class MemoryDataStore(object):
             obj = handler(resolver=self, urn=urn, version=version)
             obj.LoadFromURN()
 
+        if self.concurrent:
+            # The object was loaded without holding the cache lock, so another
+            # thread may have beaten us to it. Share its instance if so.
+            with self.ObjectCache.lock:
+                cached_obj = self.ObjectCache.Get(urn)
+                if cached_obj is None:
+                    self.ObjectCache.Put(obj, True)
+                    cached_obj = obj
+
+            if cached_obj is not obj:
+                obj.Close()
+
+            return self._ConcurrentCursor(cached_obj)
+
         # Cache the object for next time.
         self.ObjectCache.Put(obj, True)
 
@@ -642,6 +784,42 @@ class MemoryDataStore(object):
         obj.Prepare()
         return obj
 
+    def _ConcurrentCursor(self, obj):
+        # Only streams have a read pointer to keep private, volumes and
+        # other objects are shared as they are.
+        if not isinstance(obj, aff4.AFF4Stream):
+            return obj
+
+        return aff4.AFF4StreamCursor(obj, self.ObjectCache.GetLock(obj))
+
+    def ResolveHashReference(self, urn):
+        """Resolves a hash ARN (aff4:sha512:...) to its block store range.
+
+        Returns a (block store URN, offset, length) tuple, or None if urn is
+        not a resolvable hash ARN.
+        """
+        if isinstance(urn, rdfvalue.URN):
+            urn = urn.value
+        urn = utils.SmartUnicode(urn)
+        if not urn.startswith(HASH_REFERENCE_PREFIX):
+            return None
+
+        reference = self.hash_references.Get(urn)
+        if reference is not None:
+            return reference
+
+        # Not loaded via Add() (e.g. held by the parent or an HDT index).
+        # The table is only a parsed cache of the metadata, and is safe to
+        # fill in from several threads in concurrent read mode.
+        bytestream_reference_id = self.GetUnique(lexicon.any, urn, rdfvalue.URN(lexicon.standard.dataStream))
+        if bytestream_reference_id is None:
+            if self.parent != None:
+                return self.parent.ResolveHashReference(urn)
+            return None
+
+        self.hash_references.Add(urn, bytestream_reference_id)
+        return self.hash_references.Get(urn)
+
     def Dump(self, verbose=False):
         print(utils.SmartUnicode(self.DumpToTurtle(verbose=verbose)))
         self.ObjectCache.Dump()
@@ -674,6 +852,7 @@ class MemoryDataStore(object):
     # factors. We need to make the store _always_ hold a list for all
     # members.
     def Add(self, graph, subject, attribute, value):
+        self._CheckWritable()
         subject = rdfvalue.URN(subject).SerializeToString()
         attribute = rdfvalue.URN(attribute).SerializeToString()
         CHECK(isinstance(value, rdfvalue.RDFValue), "Value must be an RDFValue")
@@ -683,6 +862,9 @@ class MemoryDataStore(object):
         else:
             store = self.store
 
+        if attribute == DATASTREAM and subject.startswith(HASH_REFERENCE_PREFIX):
+            self.hash_references.Add(subject, value)
+
         if attribute not in store.setdefault(
                 subject, collections.OrderedDict()):
             store.get(subject)[attribute] = value
@@ -698,6 +880,7 @@ class MemoryDataStore(object):
 
 
     def Set(self, graph, subject, attribute, value):
+        self._CheckWritable()
         subject = rdfvalue.URN(subject).SerializeToString()
         attribute = rdfvalue.URN(attribute).SerializeToString()
         CHECK(isinstance(value, rdfvalue.RDFValue), "Value must be an RDFValue")
@@ -707,6 +890,10 @@ class MemoryDataStore(object):
         else:
             store = self.store
 
+        if attribute == DATASTREAM and subject.startswith(HASH_REFERENCE_PREFIX):
+            self.hash_references.Remove(subject)
+            self.hash_references.Add(subject, value)
+
         store.setdefault(subject, {})[attribute] = value
 
     # return a list of results
@@ -756,7 +943,7 @@ class MemoryDataStore(object):
 
         for subject in storeitems:
             if subject_regex is not None and subject_regex.match(subject):
-                yield rdfvalue.URN().UnSerializeFromString(subject)
+                yield rdfvalue.URN(subject)
 
     def QueryPredicate(self, graph, predicate):
         """Yields all subjects which have this predicate."""
@@ -775,8 +962,8 @@ class MemoryDataStore(object):
                     if type(values) != type([]):
                         values = [values]
                     for value in values:
-                        yield (rdfvalue.URN().UnSerializeFromString(subject),
-                               rdfvalue.URN().UnSerializeFromString(predicate),
+                        yield (rdfvalue.URN(subject),
+                               rdfvalue.URN(utils.SmartUnicode(predicate)),
                                value)
 
 
@@ -858,7 +1045,7 @@ class MemoryDataStore(object):
             store = self.store
 
         for pred, value in list(store.get(subject, {}).items()):
-            yield (rdfvalue.URN().UnSerializeFromString(pred), value)
+            yield (rdfvalue.URN(pred), value)
 
     def invalidateCachedMetadata(self, zip):
         pass
@@ -942,7 +1129,7 @@ class HDTAssistedDataStore(MemoryDataStore):
             if subject_regex is not None and subject_regex.match(s):
                 if s not in seen_subject:
                     seen_subject.add(s)
-                    yield rdfvalue.URN().UnSerializeFromString(s)
+                    yield rdfvalue.URN(s)
 
         for s in super(HDTAssistedDataStore, self).QuerySubject(graph, subject_regex=subject_regex):
             if s not in seen_subject:
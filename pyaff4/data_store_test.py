@@ -21,7 +21,10 @@ from pyaff4 import data_store
 from pyaff4 import lexicon
 from pyaff4 import rdfvalue
 from pyaff4 import streams
+from pyaff4 import aff4_map
 import unittest
+import random
+from multiprocessing.pool import ThreadPool
 
 import io
 
@@ -74,6 +77,20 @@ class AFF4ObjectCacheMock(data_store.AFF4ObjectCache):
         return [key for key in self.in_use]
 
 
+class WeightedObject(aff4.AFF4Object):
+    def __init__(self, resolver, urn, weight):
+        super(WeightedObject, self).__init__(resolver, urn)
+        self.weight = weight
+        self.flushes = 0
+
+    def CacheWeight(self):
+        return self.weight
+
+    def Flush(self):
+        self.flushes += 1
+        super(WeightedObject, self).Flush()
+
+
 class AFF4ObjectCacheTest(unittest.TestCase):
     def testLRU(self):
         cache = AFF4ObjectCacheMock(3)
@@ -142,6 +159,156 @@ class AFF4ObjectCacheTest(unittest.TestCase):
         result = cache.GetKeys()
         self.assertEquals(len(result), 2)
 
+    def testWeightLimit(self):
+        cache = AFF4ObjectCacheMock(10, max_weight=100)
+        resolver = data_store.MemoryDataStore()
+
+        obj1 = WeightedObject(resolver, "a", 60)
+        obj2 = WeightedObject(resolver, "b", 30)
+        obj3 = WeightedObject(resolver, "c", 30)
+
+        cache.Put(obj1)
+        cache.Put(obj2)
+        self.assertEquals(cache.weight, 90)
+
+        # Exceeding the weight expires the oldest object.
+        cache.Put(obj3)
+        self.assertEquals(cache.GetKeys(), ["file:///c", "file:///b"])
+        self.assertEquals(cache.weight, 60)
+
+        # It was clean so did not need flushing.
+        self.assertEquals(obj1.flushes, 0)
+        self.assertEquals(cache.Stats()["evictions"], 1)
+        self.assertEquals(cache.Stats()["forced_flushes"], 0)
+
+    def testDirtyTracking(self):
+        cache = AFF4ObjectCacheMock(2)
+        resolver = data_store.MemoryDataStore()
+
+        obj1 = WeightedObject(resolver, "a", 1)
+        obj2 = WeightedObject(resolver, "b", 1)
+        obj3 = WeightedObject(resolver, "c", 1)
+
+        cache.Put(obj1, True)
+        cache.Put(obj2)
+        self.assertEquals(cache.Get("file:///b"), obj2)
+        self.assertEquals(cache.Get("file:///d"), None)
+
+        # Objects are modified while in use, and noted when returned.
+        obj1.MarkDirty()
+        cache.Return(obj1)
+        cache.Return(obj2)
+        self.assertEquals(list(cache.dirty), ["file:///a"])
+
+        cache.Flush(partial=True)
+        self.assertEquals(obj1.flushes, 1)
+        self.assertEquals(obj2.flushes, 0)
+        self.assertEquals(list(cache.dirty), [])
+
+        # Evicting a dirty object forces a flush.
+        self.assertEquals(cache.Get("file:///a"), obj1)
+        obj1.MarkDirty()
+        cache.Return(obj1)
+        cache.Put(obj3)
+        self.assertEquals(obj1.flushes, 1)
+        cache.Put(WeightedObject(resolver, "d", 1))
+        self.assertEquals(obj1.flushes, 2)
+
+        stats = cache.Stats()
+        self.assertEquals(stats["hits"], 2)
+        self.assertEquals(stats["misses"], 1)
+        self.assertEquals(stats["forced_flushes"], 1)
+
+    def testDirtyAfterReturn(self):
+        resolver = data_store.MemoryDataStore(cache_max_items=10)
+        cache = resolver.ObjectCache
+
+        obj1 = WeightedObject(resolver, "a", 10)
+        cache.Put(obj1, True)
+        obj1.weight = 20
+        cache.Return(obj1)
+        self.assertEquals(cache.weight, 20)
+        self.assertEquals(list(cache.dirty), [])
+
+        # Modifying an object after returning it still gets it flushed, and
+        # re-weighed.
+        obj1.weight = 50
+        obj1.MarkDirty()
+        self.assertEquals(list(cache.dirty), ["file:///a"])
+        self.assertEquals(cache.weight, 50)
+
+        cache.Flush(partial=True)
+        self.assertEquals(obj1.flushes, 1)
+        self.assertFalse(obj1.IsDirty())
+
+        # Objects in use are noted when returned.
+        self.assertEquals(cache.Get("file:///a"), obj1)
+        obj1.MarkDirty()
+        self.assertEquals(list(cache.dirty), [])
+        cache.Return(obj1)
+        self.assertEquals(list(cache.dirty), ["file:///a"])
+        cache.Flush(partial=True)
+        self.assertEquals(obj1.flushes, 2)
+
+    def testFlushOrder(self):
+        resolver = data_store.MemoryDataStore(cache_max_items=100)
+        cache = resolver.ObjectCache
+        flushed = []
+
+        class OrderedObject(WeightedObject):
+            def Flush(self):
+                flushed.append(self.urn.SerializeToString())
+                super(OrderedObject, self).Flush()
+
+        # Dirty objects are flushed in the order they were returned, which
+        # fixes the order their members are written to a volume.
+        names = ["m%02d" % i for i in range(50)]
+        for name in names:
+            obj = OrderedObject(resolver, name, 1)
+            cache.Put(obj, True)
+            obj.MarkDirty()
+            cache.Return(obj)
+
+        cache.Flush(partial=True)
+        self.assertEquals(["file:///" + name for name in names], flushed)
+
+
+class HashReferenceTest(unittest.TestCase):
+    def testConcurrentResolve(self):
+        block_store = "aff4://0b8f3a94-2b8a-4a83-9e8b-5d1c7ad53f1b"
+        parent = data_store.MemoryDataStore()
+        expected = {}
+        for i in range(2000):
+            hash_urn = "aff4:sha512:%0128x" % i
+            expected[hash_urn] = (block_store, i * 0x8000, 0x8000)
+            parent.Add(None, hash_urn, rdfvalue.URN(lexicon.standard.dataStream),
+                       rdfvalue.URN("%s[0x%x:0x%x]" % expected[hash_urn]))
+
+        # As if the references were loaded from an HDT index, bypassing Add().
+        parent.hash_references = aff4_map.HashReferenceTable()
+        resolver = data_store.MemoryDataStore(parent=parent)
+        resolver.EnableConcurrentReads()
+
+        def resolve(seed):
+            urns = sorted(expected)
+            random.Random(seed).shuffle(urns)
+            return [(urn, resolver.ResolveHashReference(urn)) for urn in urns]
+
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(resolve, range(8))
+        finally:
+            pool.close()
+            pool.join()
+
+        for result in results:
+            for urn, reference in result:
+                (target, offset, length) = reference
+                self.assertEqual(expected[urn], (target.value, offset, length))
+
+        self.assertEqual(len(expected), len(parent.hash_references))
+        self.assertEqual(None, resolver.ResolveHashReference("aff4:sha512:missing"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,11 +21,13 @@ from pyaff4 import escaping
 from pyaff4 import lexicon
 from pyaff4 import rdfvalue
 from pyaff4 import linear_hasher
+from pyaff4 import aff4_map
 from pyaff4.container import Container
 from pyaff4 import hashes
 import unittest, traceback
 from pyaff4 import utils
-import os, tempfile
+import io, os, tempfile
+from multiprocessing.pool import ThreadPool
 
 """
 Tests logical file creation
@@ -103,6 +105,90 @@ class DedupeTest(unittest.TestCase):
             pass
 
 
+    def testReadViaHashReferences(self):
+        try:
+            os.unlink(self.containerName)
+        except:
+            pass
+
+        container_urn = rdfvalue.URN.FromFileName(self.containerName)
+        chunk_a = b"A" * 32768
+        chunk_b = b"B" * 32768
+        data = chunk_a + chunk_b + chunk_a + chunk_a + b"tail"
+
+        try:
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(resolver, container_urn) as volume:
+                    volume.writeLogicalStreamHashBased("/foo/bar", io.BytesIO(data), len(data), False)
+
+            with container.Container.openURNtoContainer(container_urn) as volume:
+                # Three distinct chunks (the tail is zero padded).
+                self.assertEqual(3, len(volume.resolver.hash_references))
+
+                images = list(volume.images())
+                self.assertEqual(1, len(images))
+                with volume.resolver.AFF4FactoryOpen(images[0].urn, version=volume.version) as stream:
+                    self.assertEqual(len(data), stream.Size())
+                    self.assertEqual(data, stream.Read(stream.Size()))
+
+                    stream.SeekRead(32768 - 2)
+                    self.assertEqual(b"AABB", stream.Read(4))
+        finally:
+            os.unlink(self.containerName)
+
+    def writeHashBased(self, data, pool):
+        try:
+            os.unlink(self.containerName)
+        except:
+            pass
+
+        container_urn = rdfvalue.URN.FromFileName(self.containerName)
+        try:
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(resolver, container_urn) as volume:
+                    urn = volume.writeLogicalStreamHashBased("/foo/bar", io.BytesIO(data), len(data), False, pool=pool)
+
+                    with resolver.AFF4FactoryOpen(urn) as image:
+                        ranges = [(r.map_offset, r.length, image.targets[r.target_id])
+                                  for r in image.GetRanges()]
+
+                    block_store = volume.block_store_stream.urn.SerializeToString()
+                    references = []
+                    for _, _, hashid in ranges:
+                        reference = resolver.GetUnique(lexicon.any, hashid, rdfvalue.URN(lexicon.standard.dataStream))
+                        references.append(utils.SmartUnicode(reference.value)[len(block_store):])
+
+            with container.Container.openURNtoContainer(container_urn) as volume:
+                with volume.resolver.AFF4FactoryOpen(urn, version=volume.version) as stream:
+                    self.assertEqual(data, stream.Read(stream.Size()))
+        finally:
+            os.unlink(self.containerName)
+
+        return ranges, references
+
+    def testParallelHashing(self):
+        blocks = [os.urandom(32768) for _ in range(8)]
+        # More than one batch of chunks is hashed by the workers.
+        data = b"".join(blocks[(i * 7) % 11 % 8] for i in range(160)) + b"tail"
+
+        serial = self.writeHashBased(data, None)
+        pool = ThreadPool(4)
+        try:
+            parallel = self.writeHashBased(data, pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        # The chunks are written in the same order to the block store.
+        self.assertEqual(161, len(serial[0]))
+        self.assertEqual(9, len(set(serial[1])))
+        self.assertEqual(serial, parallel)
+
+    def testParseByteRangeARN(self):
+        self.assertEqual(("aff4://foo", 0x10, 0x8000),
+                         aff4_map.parseByteRangeARN(rdfvalue.URN("aff4://foo[0x10:0x8000]")))
+        self.assertEqual(None, aff4_map.parseByteRangeARN("aff4://foo"))
+        self.assertEqual(None, aff4_map.parseByteRangeARN("aff4://foo[bar]"))
 
 
 if __name__ == '__main__':
@@ -22,11 +22,21 @@ from builtins import str
 from past.utils import old_div
 from builtins import object
 import binascii
+import collections
 import logging
+import multiprocessing
 import struct
 import math
+from multiprocessing.pool import ThreadPool
 from CryptoPlus.Cipher import python_AES
 
+try:
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
 from pyaff4 import lexicon
 from pyaff4 import rdfvalue
 from pyaff4 import registry
@@ -37,13 +47,197 @@ from pyaff4.aff4_image import  AFF4SImage
 LOGGER = logging.getLogger("pyaff4")
 DEBUG = False
 
+
+def _XTSTweaks(sector, count):
+    """Returns the 16 byte tweaks of count consecutive XTS data units.
+
+    The tweak of a data unit is its number as a 128 bit little endian integer.
+    """
+    units = [0] * (2 * count)
+    units[0::2] = range(sector, sector + count)
+    return struct.pack("<%dQ" % (2 * count), *units)
+
+
+class CryptographyXTSCipher(object):
+    """AES-XTS using the cryptography library (OpenSSL, AES-NI)."""
+
+    def __init__(self, key1, key2):
+        if Cipher is None:
+            raise ValueError("cryptography is not available")
+
+        self.algorithm = algorithms.AES(key1 + key2)
+        self.backend = default_backend()
+
+        # Fail now rather than on first use if the keys are not acceptable
+        # (e.g. OpenSSL refuses identical key halves).
+        try:
+            self._Run(b"\0" * 16, 0, 16, True)
+        except UnsupportedAlgorithm as e:
+            raise ValueError(str(e))
+
+    def _Run(self, data, sector, sector_size, encrypt):
+        # OpenSSL takes the tweak when a context is made and treats all the
+        # data given to it as one data unit, so each unit needs a context of
+        # its own. The tweaks are packed and the output buffer allocated once
+        # per run.
+        count = (len(data) + sector_size - 1) // sector_size
+        tweaks = _XTSTweaks(sector, count)
+        view = memoryview(data)
+        result = bytearray(len(data))
+        for i in range(count):
+            start = i * sector_size
+            end = min(start + sector_size, len(data))
+            cipher = Cipher(self.algorithm, modes.XTS(tweaks[i * 16:(i + 1) * 16]),
+                            backend=self.backend)
+            if encrypt:
+                context = cipher.encryptor()
+            else:
+                context = cipher.decryptor()
+            result[start:end] = context.update(view[start:end])
+            context.finalize()
+
+        return bytes(result)
+
+    def encrypt(self, data, sector, sector_size):
+        return self._Run(data, sector, sector_size, True)
+
+    def decrypt(self, data, sector, sector_size):
+        return self._Run(data, sector, sector_size, False)
+
+
+class PythonAESXTSCipher(object):
+    """AES-XTS using the pure Python CryptoPlus implementation."""
+
+    def __init__(self, key1, key2):
+        self.keys = (key1, key2)
+
+    def _Run(self, function, data, sector, sector_size):
+        # The cipher keeps state between calls, so each run gets its own and
+        # runs may go on in parallel.
+        cipher = python_AES.new(self.keys, python_AES.MODE_XTS)
+        function = getattr(cipher, function)
+        result = []
+        for i in range(0, len(data), sector_size):
+            tweak = struct.pack("<Q", sector)
+            result.append(function(data[i:i + sector_size], tweak))
+            sector += 1
+
+        return b"".join(result)
+
+    def encrypt(self, data, sector, sector_size):
+        return self._Run("encrypt", data, sector, sector_size)
+
+    def decrypt(self, data, sector, sector_size):
+        return self._Run("decrypt", data, sector, sector_size)
+
+
+# AES-XTS implementations in order of preference. A backend raises ValueError
+# from its constructor if it can not be used with the given keys.
+XTS_CIPHER_BACKENDS = [CryptographyXTSCipher, PythonAESXTSCipher]
+
+
+def NewXTSCipher(key1, key2):
+    """Returns the preferred usable AES-XTS cipher for the keys.
+
+    The cipher encrypts and decrypts runs of consecutive data units, where the
+    first unit has the number sector and each is sector_size bytes long.
+    """
+    for backend in XTS_CIPHER_BACKENDS:
+        try:
+            return backend(key1, key2)
+        except ValueError as e:
+            LOGGER.debug("XTS backend %s unavailable: %s", backend.__name__, e)
+
+    raise RuntimeError("No usable AES-XTS implementation")
+
+
+class BevyBuffer(object):
+    """The chunks of a bevy, held in one contiguous buffer.
+
+    Chunk i lives in the chunk_size slot starting at i * chunk_size, of which
+    the first lengths[i] bytes are in use. dirty has one byte per chunk, set
+    when the chunk changed since the bevy was loaded.
+    """
+
+    def __init__(self, chunk_size, data=None, lengths=()):
+        self.chunk_size = chunk_size
+        self.data = bytearray(data or b"")
+        self.lengths = list(lengths)
+        self.dirty = bytearray(len(self.lengths))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        start = i * self.chunk_size
+        return bytes(memoryview(self.data)[start:start + self.lengths[i]])
+
+    def __setitem__(self, i, chunk):
+        assert len(chunk) <= self.chunk_size
+        start = i * self.chunk_size
+        self.data[start:start + len(chunk)] = chunk
+        self.lengths[i] = len(chunk)
+        self.dirty[i] = 1
+
+    def __iter__(self):
+        for i in range(len(self.lengths)):
+            yield self[i]
+
+    def append(self, chunk):
+        assert len(chunk) <= self.chunk_size
+        self.data[len(self.lengths) * self.chunk_size:] = chunk
+        self.data.extend(b"\0" * (self.chunk_size - len(chunk)))
+        self.lengths.append(len(chunk))
+        self.dirty.append(1)
+
+    def Content(self, start=0, end=None):
+        """Returns the stored form of chunks [start, end)."""
+        if end is None:
+            end = len(self.lengths)
+        if end <= start:
+            return b""
+
+        length = (end - 1) * self.chunk_size + self.lengths[end - 1]
+        return bytes(memoryview(self.data)[start * self.chunk_size:length])
+
+    def Index(self):
+        """Returns the bevy index, a list of (offset, length)."""
+        return [(i * self.chunk_size, length)
+                for i, length in enumerate(self.lengths)]
+
+    def DirtyRuns(self):
+        """Yields the (start, end) ranges of consecutive dirty chunks."""
+        end = 0
+        while True:
+            start = self.dirty.find(1, end)
+            if start < 0:
+                return
+            end = self.dirty.find(0, start)
+            if end < 0:
+                end = len(self.dirty)
+            yield start, end
+
+    def ClearDirty(self):
+        self.dirty = bytearray(len(self.lengths))
+
+    def Weight(self):
+        return len(self.data)
+
+
 class RandomImageStream(AFF4SImage):
+    # The chunks of full bevies which are not yet stored are prepared for
+    # storage (onChunksFlush) by a pool of background_workers threads, while
+    # the caller fills the next bevy. At most background_bevies bevies wait
+    # to be written out; with 0 the caller does all the work.
+    background_bevies = 0
+    background_workers = multiprocessing.cpu_count()
+    # The fewest chunks handed to one thread.
+    background_min_chunks = 256
+
     def FlushChunk(self, chunk):
         if len(chunk) == 0:
             return
 
-        bevy_offset = self.chunk_count_in_bevy * self.chunk_size
-
         compressed_chunk = chunk
 
         compressedLen = len(compressed_chunk)
@@ -58,11 +252,10 @@ class RandomImageStream(AFF4SImage):
             bufToWrite = chunk
             lenToWrite = self.chunk_size
 
+        # The bevy index is kept by the bevy buffer, from the chunk lengths.
         if self.chunk_count_in_bevy < len(self.bevy):
-            self.bevy_index[self.chunk_count_in_bevy] = (bevy_offset, lenToWrite)
             self.bevy[self.chunk_count_in_bevy] = bufToWrite
         else:
-            self.bevy_index.append((bevy_offset, lenToWrite))
             self.bevy.append(bufToWrite)
             self.bevy_length += 1
             if self.bevy_size_has_changed == False:
@@ -124,6 +317,9 @@ class RandomImageStream(AFF4SImage):
         if toWrite == 0:
             return 0
 
+        # Write out the bevies which are ready, and report any failure.
+        self._WritePendingBevies(keep=len(self.pending_bevies))
+
         self.MarkDirty()
         if LOGGER.isEnabledFor(logging.DEBUG):
             LOGGER.debug("EncryptedStream::Write %x[%x]" % (self.writeptr, len(data)))
@@ -244,9 +440,10 @@ class RandomImageStream(AFF4SImage):
 
         # deal with the partial remainder if it exists
         if idx > 0:
+            # With no remainder, the buffer still has to move on to the next
+            # chunk rather than keep the chunks just flushed.
             remainderBuf = self.buffer[idx:]
-            if len(remainderBuf) > 0:
-                self.buffer = self.mergeBufferWithChunk(remainderBuf)
+            self.buffer = self.mergeBufferWithChunk(remainderBuf)
 
         wrote = len(data)
         self.writeptr += wrote
@@ -277,11 +474,84 @@ class RandomImageStream(AFF4SImage):
         self.currentLCA = 0
         self.maxBevyIdx = 0
         self.bevy_is_loaded_from_disk = False
+        self.pool = None
+        self.pending_bevies = collections.deque()
         super(RandomImageStream, self).LoadFromURN()
+        self.bevy = BevyBuffer(self.chunk_size)
         if self.size > 0:
             self.loadInitialBevy()
             self.maxBevyIdx = math.ceil(self.size / (self.chunk_size*self.chunks_per_segment)) -1
 
+    # hook for encryption of the chunks starting at chunk_id
+    def onChunksFlush(self, data, chunk_id):
+        return data
+
+    def onBevyLoad(self, bevy, bevy_index, bevy_id):
+        result = BevyBuffer(self.chunk_size)
+        for chunk in super(RandomImageStream, self).onBevyLoad(
+                bevy, bevy_index, bevy_id):
+            result.append(chunk)
+        return result
+
+    def _SubmitBevy(self, args, bevy_buffer, first_chunk_id):
+        """Prepares the chunks of a bevy for storage in the background."""
+        if self.pool is None:
+            self.pool = ThreadPool(self.background_workers)
+
+        chunks = len(bevy_buffer)
+        step = max(self.background_min_chunks,
+                   (chunks + self.background_workers - 1) // self.background_workers)
+        results = [self.pool.apply_async(
+                       self.onChunksFlush,
+                       (bevy_buffer.Content(i, min(i + step, chunks)),
+                        first_chunk_id + i))
+                   for i in range(0, chunks, step)]
+        self.pending_bevies.append((args, results))
+
+    def _WritePendingBevies(self, keep=0):
+        """Writes out bevies prepared in the background, oldest first.
+
+        Waits until no more than keep bevies are pending, and writes out any
+        which are ready beyond that. Raises the error of a failed bevy.
+        """
+        while self.pending_bevies:
+            args, results = self.pending_bevies[0]
+            if (len(self.pending_bevies) <= keep and
+                    not all(result.ready() for result in results)):
+                return
+
+            self.pending_bevies.popleft()
+            content = b"".join(result.get() for result in results)
+            self._WriteBevy(*args, content=content)
+
+    def _ClosePool(self, terminate=False):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            if terminate:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    def _ReadPartial(self, chunk_id, chunks_to_read):
+        # Bevies which are still pending can not be read back yet.
+        self._WritePendingBevies()
+        return super(RandomImageStream, self)._ReadPartial(
+            chunk_id, chunks_to_read)
+
+    def reloadBevy(self, bevy_id):
+        self._WritePendingBevies()
+        super(RandomImageStream, self).reloadBevy(bevy_id)
+        # The bevy buffer keeps the index.
+        self.bevy_index = None
+        self.bevy.ClearDirty()
+
+    def _BevyWeight(self):
+        weight = self.bevy.Weight()
+        for args, _ in self.pending_bevies:
+            weight += args[2].Weight()
+        return weight
+
     # extension point so that for this class we load the initial bevy on load
     # the encryption oriented subclass NOOP overrides this to defer the initialization to
     # after the set of the keys
@@ -295,7 +565,7 @@ class RandomImageStream(AFF4SImage):
 
     def _FlushBevy(self):
         if LOGGER.isEnabledFor(logging.INFO):
-            LOGGER.info("Flushing Bevy id=%x, entries=%x", self.bevy_number, len(self.bevy_index))
+            LOGGER.info("Flushing Bevy id=%x, entries=%x", self.bevy_number, len(self.bevy))
         # Bevy is empty nothing to do.
         if not self.bevy:
             return
@@ -306,46 +576,68 @@ class RandomImageStream(AFF4SImage):
         
         if self.bevy_number > self.maxBevyIdx:
             self.maxBevyIdx = self.bevy_number
-        if len(self.bevy) > self.bevy_length or self.bevy_size_has_changed:
-            volume_urn = self.resolver.GetUnique(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED)
-            with self.resolver.AFF4FactoryOpen(volume_urn, version=self.version) as volume:
-                bevy_urn = self.urn.Append("%08d" % self.bevy_number)
+
+        remove = len(self.bevy) > self.bevy_length or self.bevy_size_has_changed
+        in_place = self.bevy_is_loaded_from_disk and not self.bevy_size_has_changed
+        args = (volume_urn, self.bevy_number, self.bevy, remove, in_place)
+        if self.background_bevies > 0 and not self.bevy_is_loaded_from_disk:
+            # The buffer is handed over and the caller carries on with a new
+            # one. The volume is not thread safe, so the bevy is written out
+            # here on a later flush, once it is ready or room is needed.
+            self._WritePendingBevies(keep=self.background_bevies - 1)
+            self._SubmitBevy(args, self.bevy,
+                             self.bevy_number * self.chunks_per_segment)
+        else:
+            self._WritePendingBevies()
+            self._WriteBevy(*args)
+
+        self.chunk_count_in_bevy = 0
+        self.bevy_number += 1
+        self.bevy = BevyBuffer(self.chunk_size)
+        self.bevy_index = None
+        self.bevy_length = 0
+        self.bevy_is_loaded_from_disk = False
+        self.bevy_size_has_changed = False
+
+    def _WriteBevy(self, volume_urn, bevy_number, bevy_buffer, remove, in_place,
+                   content=None):
+        """Stores a bevy. content is its prepared chunks, if already known."""
+        bevy_urn = self.urn.Append("%08d" % bevy_number)
+        first_chunk_id = bevy_number * self.chunks_per_segment
+        with self.resolver.AFF4FactoryOpen(volume_urn, version=self.version) as volume:
+            if remove:
                 bevy_index_urn = rdfvalue.URN("%s.index" % bevy_urn)
-                #if self.bevy_is_loaded_from_disk:
                 if LOGGER.isEnabledFor(logging.INFO):
-                    ("Removing bevy member %s", bevy_urn)
+                    LOGGER.info("Removing bevy member %s", bevy_urn)
                 volume.RemoveMember(bevy_urn)
                 if LOGGER.isEnabledFor(logging.INFO):
                     LOGGER.info("Removing bevy member %s", bevy_index_urn)
                 volume.RemoveMember(bevy_index_urn)
 
-        bevy_urn = self.urn.Append("%08d" % self.bevy_number)
-        with self.resolver.AFF4FactoryOpen(volume_urn) as volume:
-            self._write_bevy_index(volume, bevy_urn, self.bevy_index, flush=True)
+            self._write_bevy_index(volume, bevy_urn, bevy_buffer.Index(), flush=True)
 
             with volume.CreateMember(bevy_urn) as bevy:
-                content = b"".join(self.bevy)
-                if LOGGER.isEnabledFor(logging.INFO):
-                    LOGGER.info("Writing Bevy Content len=%x", len(content))
-                bevy.Write(content)
-                if self.bevy_is_loaded_from_disk and not self.bevy_size_has_changed:
-                    # no need to rewrite the bevy as the zip header is still good
-                    # and the blocks have been rewritten in-place
+                if in_place:
+                    # The zip header is still good, so only the chunks which
+                    # changed are rewritten in-place.
+                    for start, end in bevy_buffer.DirtyRuns():
+                        content = self.onChunksFlush(
+                            bevy_buffer.Content(start, end), first_chunk_id + start)
+                        bevy.SeekWrite(start * self.chunk_size)
+                        bevy.Write(content)
                     bevy._dirty = False
+                else:
+                    if content is None:
+                        content = self.onChunksFlush(
+                            bevy_buffer.Content(), first_chunk_id)
+                    if LOGGER.isEnabledFor(logging.INFO):
+                        LOGGER.info("Writing Bevy Content len=%x", len(content))
+                    bevy.SeekWrite(0)
+                    bevy.Write(content)
 
             # We dont need to hold these in memory any more.
             self.resolver.Close(bevy)
 
-        # In Python it is more efficient to keep a list of chunks and then join
-        # them at the end in one operation.
-        self.chunk_count_in_bevy = 0
-        self.bevy_number += 1
-        self.bevy = []
-        self.bevy_index = []
-        self.bevy_length = 0
-        self.bevy_is_loaded_from_disk = False
-        self.bevy_size_has_changed = False
-
     def Flush(self):
         if self.IsDirty():
             if len(self.buffer) == 0:
@@ -370,10 +662,18 @@ class RandomImageStream(AFF4SImage):
                         self.FlushChunk(self.padToChunksize(self.buffer))
 
             self._FlushBevy()
+            self._WritePendingBevies()
+            self._ClosePool()
 
             self._write_metadata()
         self._dirty = False
 
+    def Abort(self):
+        # The stream is discarded, so pending bevies are dropped.
+        self.pending_bevies.clear()
+        self._ClosePool(terminate=True)
+        super(RandomImageStream, self).Abort()
+
     def dump(self):
         if len(self.bevy) == 0:
             hexdump.hexdump(self.buffer)
@@ -388,6 +688,9 @@ class RandomImageStream(AFF4SImage):
 class AFF4EncryptedStream(RandomImageStream):
     DEBUG = False
     compression = lexicon.AFF4_IMAGE_COMPRESSION_STORED
+
+    # Encryption is the costly part of writing out a bevy.
+    background_bevies = 2
     def LoadFromURN(self):
         super(AFF4EncryptedStream, self).LoadFromURN()
         volume_urn = self.resolver.GetUnique(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED)
@@ -396,6 +699,7 @@ class AFF4EncryptedStream(RandomImageStream):
         if storedChunksize == None:
             # initializing so setup the proper (non-debug chunksize)
             self.chunk_size = 512
+            self.bevy = BevyBuffer(self.chunk_size)
             self.DEBUG = False
         else:
             if self.chunk_size != 512:
@@ -412,7 +716,7 @@ class AFF4EncryptedStream(RandomImageStream):
         self.vek = vek
         self.key1 = vek[0:16]
         self.key2 = vek[16:]
-        self.cipher = python_AES.new((self.key1, self.key2), python_AES.MODE_XTS)
+        self.cipher = NewXTSCipher(self.key1, self.key2)
         if self.size > 0:
             self.doLoadInitialBevy()
 
@@ -424,65 +728,44 @@ class AFF4EncryptedStream(RandomImageStream):
         super(AFF4EncryptedStream, self).Flush()
 
     def _FlushBevy(self):
-        # Bevy is empty nothing to do.
-        if not self.bevy:
-            return
-
-        if self.bevy_number > self.maxBevyIdx:
-            self.maxBevyIdx = self.bevy_number
-
-        volume_urn = self.resolver.GetUnique(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED)
-        if not volume_urn:
-            raise IOError("Unable to find storage for urn %s" % self.urn)
+        # Each chunk is a whole XTS data unit, so the last is zero padded.
+        if self.bevy:
+            lastChunkIdx = len(self.bevy)-1
+            lastChunk = self.bevy[lastChunkIdx]
+            if len(lastChunk) < self.chunk_size:
+                self.bevy[lastChunkIdx] = lastChunk + b'\0' * (self.chunk_size - len(lastChunk))
+
+        super(AFF4EncryptedStream, self)._FlushBevy()
+
+    def onChunksFlush(self, data, chunk_id):
+        # Each chunk is one XTS data unit, numbered by its address in the
+        # stream, so a run of chunks is encrypted in one call.
+        if self.DEBUG:
+            return data
 
-        if len(self.bevy) > self.bevy_length or self.bevy_size_has_changed:
-            with self.resolver.AFF4FactoryOpen(volume_urn, version=self.version) as volume:
-                bevy_urn = self.urn.Append("%08d" % self.bevy_number)
-                bevy_index_urn = rdfvalue.URN("%s.index" % bevy_urn)
-                #if self.bevy_is_loaded_from_disk:
-                volume.RemoveMember(bevy_urn)
-                volume.RemoveMember(bevy_index_urn)
+        return self.cipher.encrypt(data, chunk_id, self.chunk_size)
 
-        lastChunkIdx = len(self.bevy)-1
-        lastChunk = self.bevy[lastChunkIdx]
-        if len(lastChunk) < self.chunk_size:
-            self.bevy[lastChunkIdx] = lastChunk + b'\0' * (self.chunk_size - len(lastChunk))
-            (bevy_offset, lenToWrite) = self.bevy_index[lastChunkIdx]
-            self.bevy_index[lastChunkIdx] = (bevy_offset, self.chunk_size)
+    def onBevyLoad(self, bevy, bevy_index, bevy_id):
+        # Chunks are stored back to back at full size, so the whole bevy is
+        # read with one I/O and decrypted in one pass. Anything else is left
+        # to the chunk at a time path.
+        chunk_size = self.chunk_size
+        for i in range(0, len(bevy_index)):
+            if bevy_index[i] != (i * chunk_size, chunk_size):
+                return super(AFF4EncryptedStream, self).onBevyLoad(
+                    bevy, bevy_index, bevy_id)
 
-        bevy_urn = self.urn.Append("%08d" % self.bevy_number)
-        with self.resolver.AFF4FactoryOpen(volume_urn) as volume:
-            self._write_bevy_index(volume, bevy_urn, self.bevy_index, flush=True)
-            encryptedBevys = []
+        length = len(bevy_index) * chunk_size
+        data = bevy.ReadAt(0, length)
+        if len(data) != length:
+            return super(AFF4EncryptedStream, self).onBevyLoad(
+                bevy, bevy_index, bevy_id)
 
-            with volume.CreateMember(bevy_urn) as bevy:
-                for chunkIdx in range(0,len(self.bevy)):
-                    chunk_address = self.bevy_number * self.chunks_per_segment + chunkIdx
-                    tweak = struct.pack("<Q", chunk_address)
+        if not self.DEBUG:
+            data = self.cipher.decrypt(
+                data, bevy_id * self.chunks_per_segment, chunk_size)
 
-                    if self.DEBUG:
-                        encryptedBevys.append(self.bevy[chunkIdx])
-                    else:
-                        encryptedBevys.append(self.cipher.encrypt(self.bevy[chunkIdx], tweak))
-                buf = b"".join(encryptedBevys)
-                bevy.Write(buf)
-                if self.bevy_is_loaded_from_disk and not self.bevy_size_has_changed:
-                    # no need to rewrite the bevy as the zip header is still good
-                    # and the blocks have been rewritten in-place
-                    bevy._dirty = False
-
-            # We dont need to hold these in memory any more.
-            self.resolver.Close(bevy)
-
-        # In Python it is more efficient to keep a list of chunks and then join
-        # them at the end in one operation.
-        self.chunk_count_in_bevy = 0
-        self.bevy_number += 1
-        self.bevy = []
-        self.bevy_index = []
-        self.bevy_length = 0
-        self.bevy_is_loaded_from_disk = False
-        self.bevy_size_has_changed = False
+        return BevyBuffer(chunk_size, data, [chunk_size] * len(bevy_index))
 
     def onChunkLoad(self, chunk, bevy_index, chunk_index):
         chunk_id = bevy_index * self.chunks_per_segment + chunk_index
@@ -492,13 +775,7 @@ class AFF4EncryptedStream(RandomImageStream):
         if self.DEBUG:
             return cbuffer
 
-        unit_number = chunk_id
-        tweak = struct.pack("<Q", unit_number)
-
-        cipher = python_AES.new((self.key1,self.key2), python_AES.MODE_XTS)
-        plaintext = cipher.decrypt(cbuffer, tweak)
-
-        return plaintext
+        return self.cipher.decrypt(cbuffer, chunk_id, self.chunk_size)
 
     def _write_metadata(self):
         volume_urn = self.resolver.GetUnique(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED)
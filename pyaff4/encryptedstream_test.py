@@ -22,7 +22,9 @@ standard_library.install_aliases()
 from builtins import range
 import os
 import io
+import threading
 import unittest
+import zipfile
 
 from pyaff4 import aff4_image
 from pyaff4 import data_store
@@ -30,6 +32,7 @@ from pyaff4 import lexicon
 from pyaff4 import rdfvalue
 from pyaff4 import zip
 from pyaff4 import container
+from pyaff4 import encrypted_stream
 from pyaff4 import keybag
 
 
@@ -620,6 +623,215 @@ class AFF4EncryptedStreamTest(unittest.TestCase):
                     self.assertEquals(2, image.Size())
                     self.assertEquals(b'ba', image.ReadAll())
 
+    def _openImage(self, kb, mode, callback):
+        with data_store.MemoryDataStore() as resolver:
+            if mode is not None:
+                resolver.Set(lexicon.transient_graph, self.filename_urn,
+                             lexicon.AFF4_STREAM_WRITE_MODE,
+                             rdfvalue.XSDString(mode))
+
+            with zip.ZipFile.NewZipFile(resolver, container.Version(1, 1, "pyaff4"),
+                                        self.filename_urn) as zip_file:
+                resolver.Set(lexicon.transient_graph, self.image_urn,
+                             lexicon.AFF4_STORED, zip_file.urn)
+                with resolver.AFF4FactoryOpen(self.image_urn) as image:
+                    image.setKeyBag(kb)
+                    image.setKey(kb.unwrap_key("secret"))
+                    callback(image)
+
+                return sorted(zip_file.members)
+
+    def testInPlaceRewrite(self):
+        kb = keybag.PasswordWrappedKeyBag.create("secret")
+        data = bytearray(os.urandom(512 * 4 * 3))
+
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+
+            with zip.ZipFile.NewZipFile(resolver, container.Version(1, 1, "pyaff4"),
+                                        self.filename_urn) as zip_file:
+                self.image_urn = zip_file.urn.Append(self.image_name)
+                with zip_file.CreateMember(zip_file.urn.Append("container.description")) as fd:
+                    fd.Write(zip_file.urn.SerializeToString().encode("utf-8"))
+
+                with aff4_image.AFF4Image.NewAFF4Image(
+                    resolver, self.image_urn, zip_file.urn, type=lexicon.AFF4_ENCRYPTEDSTREAM_TYPE) as image:
+                    image.chunks_per_segment = 4
+                    image.setKeyBag(kb)
+                    image.setKey(kb.unwrap_key("secret"))
+                    image.Write(bytes(data))
+
+        def check(image):
+            self.assertEqual(len(data), image.Size())
+            self.assertEqual(bytes(data), image.ReadAll())
+
+        members = self._openImage(kb, None, check)
+
+        # One chunk in the middle of a bevy, then a run over three chunks.
+        def rewrite(image):
+            image.SeekWrite(512 * 5 + 10)
+            image.Write(b"x" * 20)
+            image.SeekWrite(512 * 8 + 100)
+            image.Write(b"y" * 1200)
+
+        data[512 * 5 + 10:512 * 5 + 30] = b"x" * 20
+        data[512 * 8 + 100:512 * 8 + 1300] = b"y" * 1200
+        self.assertEqual(members, self._openImage(kb, "random", rewrite))
+
+        self._openImage(kb, None, check)
+
+    def _writeImage(self, kb, data, **settings):
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+
+            with zip.ZipFile.NewZipFile(resolver, container.Version(1, 1, "pyaff4"),
+                                        self.filename_urn) as zip_file:
+                self.image_urn = zip_file.urn.Append(self.image_name)
+                with zip_file.CreateMember(zip_file.urn.Append("container.description")) as fd:
+                    fd.Write(zip_file.urn.SerializeToString().encode("utf-8"))
+
+                with aff4_image.AFF4Image.NewAFF4Image(
+                    resolver, self.image_urn, zip_file.urn, type=lexicon.AFF4_ENCRYPTEDSTREAM_TYPE) as image:
+                    image.chunks_per_segment = 4
+                    for name, value in settings.items():
+                        setattr(image, name, value)
+                    image.setKeyBag(kb)
+                    image.setKey(kb.unwrap_key("secret"))
+                    for i in range(0, len(data), 1000):
+                        image.Write(data[i:i + 1000])
+
+                    # Flushing waits for the background and stops the pool.
+                    used_pool = image.pool is not None
+                    image.Flush()
+                    self.assertIsNone(image.pool)
+                    self.assertEqual([], list(image.pending_bevies))
+                    return used_pool
+
+    def _bevies(self):
+        with zipfile.ZipFile(self.filename) as zf:
+            return dict((name, zf.read(name)) for name in zf.namelist()
+                        if name.startswith(self.image_name + "/"))
+
+    def testBackgroundBevies(self):
+        kb = keybag.PasswordWrappedKeyBag.create("secret")
+        data = os.urandom(512 * 4 * 10 + 700)
+
+        self.assertFalse(self._writeImage(kb, data, background_bevies=0))
+        expected = self._bevies()
+        self.assertEqual(22, len(expected))
+
+        # Small pieces, so each bevy is split between the threads.
+        self.assertTrue(self._writeImage(kb, data, background_bevies=2,
+                                         background_workers=3,
+                                         background_min_chunks=1))
+        self.assertEqual(expected, self._bevies())
+
+        def check(image):
+            self.assertEqual(len(data), image.Size())
+            self.assertEqual(data, image.ReadAll())
+            self.assertEqual(data[2000:5000], image.ReadAt(2000, 3000))
+
+        self._openImage(kb, None, check)
+
+    def testBackgroundBevyError(self):
+        kb = keybag.PasswordWrappedKeyBag.create("secret")
+
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+
+            with zip.ZipFile.NewZipFile(resolver, container.Version(1, 1, "pyaff4"),
+                                        self.filename_urn) as zip_file:
+                image_urn = zip_file.urn.Append(self.image_name)
+                with aff4_image.AFF4Image.NewAFF4Image(
+                    resolver, image_urn, zip_file.urn, type=lexicon.AFF4_ENCRYPTEDSTREAM_TYPE) as image:
+                    image.chunks_per_segment = 4
+                    image.setKeyBag(kb)
+                    image.setKey(kb.unwrap_key("secret"))
+
+                    def fail(data, chunk_id):
+                        raise RuntimeError("encryption failed")
+
+                    image.onChunksFlush = fail
+                    image.Write(b"a" * 512 * 4)
+                    self.assertEqual(1, len(image.pending_bevies))
+                    for result in image.pending_bevies[0][1]:
+                        result.wait()
+
+                    # Once the failure is in, it is raised by the next write.
+                    with self.assertRaises(RuntimeError):
+                        image.Write(b"b")
+                    image.Abort()
+
+    def testAbortWithPendingBevies(self):
+        kb = keybag.PasswordWrappedKeyBag.create("secret")
+        threads = threading.active_count()
+
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+
+            with zip.ZipFile.NewZipFile(resolver, container.Version(1, 1, "pyaff4"),
+                                        self.filename_urn) as zip_file:
+                image_urn = zip_file.urn.Append(self.image_name)
+                with aff4_image.AFF4Image.NewAFF4Image(
+                    resolver, image_urn, zip_file.urn, type=lexicon.AFF4_ENCRYPTEDSTREAM_TYPE) as image:
+                    image.chunks_per_segment = 4
+                    image.background_bevies = 3
+                    image.setKeyBag(kb)
+                    image.setKey(kb.unwrap_key("secret"))
+
+                    # Hold the workers so that the bevies stay pending.
+                    release = threading.Event()
+                    encrypt = image.onChunksFlush
+                    def blocked(data, chunk_id):
+                        release.wait(10)
+                        return encrypt(data, chunk_id)
+
+                    image.onChunksFlush = blocked
+                    image.Write(b"a" * 512 * 4 * 3)
+                    self.assertEqual(3, len(image.pending_bevies))
+
+                    release.set()
+                    image.Abort()
+
+                    self.assertIsNone(image.pool)
+                    self.assertEqual(threads, threading.active_count())
+                    self.assertEqual([], [urn for urn in zip_file.members
+                                          if urn.value.startswith(image_urn.value)])
+
+        self.assertEqual({}, self._bevies())
+
+
+class BevyBufferTest(unittest.TestCase):
+    def testBevyBuffer(self):
+        bevy = encrypted_stream.BevyBuffer(4)
+        for chunk in (b"aaaa", b"bbbb", b"cc"):
+            bevy.append(chunk)
+
+        self.assertEqual(3, len(bevy))
+        self.assertEqual([b"aaaa", b"bbbb", b"cc"], list(bevy))
+        self.assertEqual(b"aaaabbbbcc", bevy.Content())
+        self.assertEqual([(0, 4), (4, 4), (8, 2)], bevy.Index())
+
+        bevy.ClearDirty()
+        self.assertEqual([], list(bevy.DirtyRuns()))
+
+        bevy[1] = b"xx"
+        bevy[2] = b"yyyy"
+        self.assertEqual(b"xx", bevy[1])
+        self.assertEqual([(1, 3)], list(bevy.DirtyRuns()))
+        self.assertEqual(b"xxbbyyyy", bevy.Content(1, 3))
+
+        bevy.append(b"zzzz")
+        bevy.ClearDirty()
+        bevy[0] = b"AAAA"
+        bevy[3] = b"ZZZZ"
+        self.assertEqual([(0, 1), (3, 4)], list(bevy.DirtyRuns()))
+
+
 if __name__ == '__main__':
     #logging.getLogger().setLevel(logging.DEBUG)
     unittest.main()
@@ -0,0 +1,218 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Parallel extraction of the file images in logical containers."""
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import collections
+import errno
+import multiprocessing
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from pyaff4 import aff4_file
+from pyaff4 import lexicon
+from pyaff4 import logical
+from pyaff4 import zip
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Errors meaning a copy method is not available for these files.
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                errno.EOPNOTSUPP)
+
+_Job = collections.namedtuple(
+    "_Job", ["urn", "destFile", "storedRange", "timestamps"])
+
+
+def _CopyFileRange(srcFd, offset, length, dstFd):
+    return os.copy_file_range(srcFd, dstFd, length, offset)
+
+
+def _SendFile(srcFd, offset, length, dstFd):
+    return os.sendfile(dstFd, srcFd, offset, length)
+
+
+def _PReadWrite(srcFd, offset, length, dstFd):
+    data = os.pread(srcFd, min(length, COPY_BUFFER_SIZE), offset)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(dstFd, view):]
+    return len(data)
+
+
+def _CopyMethods():
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(_CopyFileRange)
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        # Only Linux can sendfile between regular files.
+        methods.append(_SendFile)
+    methods.append(_PReadWrite)
+    return methods
+
+
+def copyRange(srcFd, offset, length, dstFd):
+    """Copies length bytes from offset in srcFd to the position of dstFd.
+
+    The copy is done in the kernel (copy_file_range or sendfile) where the
+    platform and file systems allow it.
+    """
+    methods = _CopyMethods()
+    while length > 0:
+        try:
+            copied = methods[0](srcFd, offset, length, dstFd)
+        except OSError as e:
+            if len(methods) == 1 or e.errno not in _UNSUPPORTED:
+                raise
+            methods.pop(0)
+            continue
+
+        if copied == 0:
+            raise IOError("Unexpected end of file at offset %d" % offset)
+        offset += copied
+        length -= copied
+
+
+def copyStream(src, dst, buffer):
+    """Copies an AFF4 stream into a file object through a reusable buffer."""
+    offset = 0
+    view = memoryview(buffer)
+    while True:
+        read = src.ReadAtInto(offset, buffer)
+        if not read:
+            return offset
+        dst.write(view[:read])
+        offset += read
+
+
+def _MakeDirs(directories):
+    for directory in sorted(directories):
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+
+def _NextOrNone(iterable):
+    try:
+        return next(iterable)
+    except StopIteration:
+        return None
+
+
+class LogicalExtractor(object):
+    """Extracts file images from a volume using a pool of workers.
+
+    Images are planned with Add(), which looks up what is needed from the
+    metadata. Run() then creates all the destination directories up front
+    and copies the images in parallel, with the resolver in concurrent read
+    mode, so the volume can only be read from then on. Stored (uncompressed)
+    zip segments are copied straight from the container file where it is
+    a local file; everything else is read through the resolver.
+    """
+
+    def __init__(self, volume, workers=None, resetTimestamps=True,
+                 bufferSize=COPY_BUFFER_SIZE):
+        self.volume = volume
+        self.resolver = volume.resolver
+        self.workers = workers or multiprocessing.cpu_count()
+        self.resetTimestamps = resetTimestamps
+        self.bufferSize = bufferSize
+
+        # Keyed by destination, so a later image of the same path replaces
+        # an earlier one, as it would when extracting serially.
+        self.jobs = collections.OrderedDict()
+        self.filenos = {}
+
+        # Each worker reuses its own copy buffer.
+        self.local = threading.local()
+
+    def _StoredRange(self, urn):
+        zip_file = self.volume.zip_file
+        if not isinstance(zip_file, zip.ZipFile) or urn not in zip_file.members:
+            return None
+
+        stored = zip_file.StoredMemberRange(urn)
+        if stored is None:
+            return None
+
+        backing_store_urn, offset, length = stored
+        if backing_store_urn not in self.filenos:
+            with self.resolver.AFF4FactoryOpen(backing_store_urn) as backing_store:
+                fileno = None
+                if isinstance(backing_store, aff4_file.FileBackedObject):
+                    fileno = backing_store.ReadOnlyFileno()
+                self.filenos[backing_store_urn] = fileno
+
+        fileno = self.filenos[backing_store_urn]
+        if fileno is None:
+            return None
+        return fileno, offset, length
+
+    def Add(self, urn, destFile):
+        """Plans the extraction of the image urn to destFile."""
+        timestamps = None
+        if self.resetTimestamps:
+            timestamps = [
+                _NextOrNone(self.resolver.QuerySubjectPredicate(self.volume.urn, urn, attribute))
+                for attribute in (lexicon.standard11.lastWritten,
+                                  lexicon.standard11.lastAccessed,
+                                  lexicon.standard11.recordChanged,
+                                  lexicon.standard11.birthTime)]
+
+        self.jobs.pop(destFile, None)
+        self.jobs[destFile] = _Job(urn, destFile, self._StoredRange(urn),
+                                   timestamps)
+
+    def _Extract(self, job):
+        with open(job.destFile, "wb") as dst:
+            if job.storedRange is not None:
+                fileno, offset, length = job.storedRange
+                copyRange(fileno, offset, length, dst.fileno())
+            else:
+                buffer = getattr(self.local, "buffer", None)
+                if buffer is None:
+                    buffer = self.local.buffer = bytearray(self.bufferSize)
+
+                with self.resolver.AFF4FactoryOpen(job.urn) as src:
+                    copyStream(src, dst, buffer)
+
+        if job.timestamps is not None:
+            logical.resetTimestamps(job.destFile, *job.timestamps)
+
+        return job.urn, job.destFile
+
+    def Run(self):
+        """Extracts the planned images.
+
+        Yields (urn, destFile) for each image as it is extracted, in the
+        order they were added.
+        """
+        _MakeDirs(set(os.path.dirname(destFile) for destFile in self.jobs))
+
+        self.resolver.EnableConcurrentReads()
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap(self._Extract, list(self.jobs.values())):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
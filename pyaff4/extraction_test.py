@@ -0,0 +1,126 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import extraction
+from pyaff4 import lexicon
+from pyaff4 import rdfvalue
+from pyaff4 import utils
+
+
+class CopyRangeTest(unittest.TestCase):
+    def testCopyRange(self):
+        data = os.urandom(100000)
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(data)
+            src.flush()
+            dst.write(b"head")
+            dst.flush()
+
+            extraction.copyRange(src.fileno(), 1000, 50000, dst.fileno())
+            dst.seek(0)
+            self.assertEqual(b"head" + data[1000:51000], dst.read())
+
+            self.assertRaises(IOError, extraction.copyRange,
+                              src.fileno(), 90000, 20000, dst.fileno())
+
+    def testFallback(self):
+        data = os.urandom(1000)
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(data)
+            src.flush()
+            # A pipe can not be the target of copy_file_range, so this
+            # falls back to the other methods.
+            r, w = os.pipe()
+            try:
+                extraction.copyRange(src.fileno(), 10, 100, w)
+                self.assertEqual(data[10:110], os.read(r, 1000))
+            finally:
+                os.close(r)
+                os.close(w)
+
+
+class LogicalExtractorTest(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.filename = os.path.join(tempfile.gettempdir(),
+                                     "aff4_test_extraction.aff4")
+        self.urn = rdfvalue.URN.FromFileName(self.filename)
+        self.files = {
+            "/a/small1": os.urandom(1000),
+            "/a/small2": b"",
+            "/a/b/small3": b"x" * 5000,
+            "/c/large": os.urandom(200000),
+            "C:\\d\\e": os.urandom(10),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+        os.unlink(self.filename)
+
+    def create(self, compression_method):
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(
+                    resolver, self.urn, zip_based=True,
+                    compression_method=compression_method) as volume:
+                volume.maxSegmentResidentSize = 64 * 1024
+                for pathName, data in sorted(self.files.items()):
+                    volume.writeLogicalStream(pathName, io.BytesIO(data), len(data))
+
+    def extract(self):
+        results = {}
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            extractor = extraction.LogicalExtractor(volume, workers=4)
+            for image in volume.images():
+                destFile = os.path.join(
+                    self.dest, utils.SmartUnicode(image.pathName).replace("\\", "/").strip("/"))
+                extractor.Add(image.urn, destFile)
+
+            stored = [job for job in extractor.jobs.values()
+                      if job.storedRange is not None]
+            order = list(extractor.jobs)
+            self.assertEqual(order, [destFile for _, destFile in extractor.Run()])
+
+        for pathName in self.files:
+            with open(os.path.join(self.dest, pathName.replace("\\", "/").strip("/")), "rb") as fd:
+                results[pathName] = fd.read()
+        return results, stored
+
+    def testStored(self):
+        self.create(lexicon.AFF4_IMAGE_COMPRESSION_STORED)
+        results, stored = self.extract()
+        self.assertEqual(self.files, results)
+
+        # All but the AFF4Image are copied straight from the container file.
+        self.assertEqual(4, len(stored))
+
+    def testDeflated(self):
+        self.create(lexicon.AFF4_IMAGE_COMPRESSION_ZLIB)
+        results, stored = self.extract()
+        self.assertEqual(self.files, results)
+        self.assertEqual([], stored)
+
+
+if __name__ == '__main__':
+    unittest.main()
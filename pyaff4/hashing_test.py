@@ -13,7 +13,12 @@ from __future__ import unicode_literals
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
 # License for the specific language governing permissions and limitations under
 # the License.
+import binascii
+import contextlib
+import gc
+import io
 import os
+import threading
 import unittest
 import logging
 
@@ -179,5 +184,296 @@ class ValidatorTest(unittest.TestCase):
         print(hash.value)
         self.assertEqual(hash.value, "7d3d27f667f95f7ec5b9d32121622c0f4b60b48d")
 
+
+class SpotCheckListener(block_hasher.ValidationListener):
+    def __init__(self):
+        self.sampled = None
+        self.blocks = 0
+
+    def onValidBlockHashes(self, imageStreamURI, offset, count, digests):
+        self.blocks += count
+
+    def onSpotCheck(self, imageStreamURI, sampled, total, probability):
+        self.sampled = (sampled, total)
+
+
+class SpotCheckTest(unittest.TestCase):
+    def testSampleSize(self):
+        spot_check = block_hasher.SpotCheck(confidence=0.99,
+                                            corruption_rate=0.01)
+        # ln(0.01) / ln(0.99) = 458.2
+        self.assertEqual(459, spot_check.SampleSize(100000))
+        self.assertEqual(100, spot_check.SampleSize(100))
+        self.assertGreaterEqual(
+            spot_check.DetectionProbability(459, 100000), 0.99)
+        self.assertEqual(1.0, spot_check.DetectionProbability(100, 100))
+
+    def testSample(self):
+        for stratified in (True, False):
+            spot_check = block_hasher.SpotCheck(
+                confidence=0.9, corruption_rate=0.1, stratified=stratified,
+                seed=1)
+            sample = spot_check.Sample(1000)
+            self.assertEqual(22, len(sample))
+            self.assertEqual(sorted(set(sample)), sample)
+            self.assertTrue(all(0 <= x < 1000 for x in sample))
+
+            if stratified:
+                for i, chunk in enumerate(sample):
+                    self.assertTrue(i * 1000 // 22 <= chunk < (i + 1) * 1000 // 22)
+
+    @conditional_on_images
+    def testSpotCheckStdLinearImage(self):
+        listener = SpotCheckListener()
+        spot_check = block_hasher.SpotCheck(confidence=0.9,
+                                            corruption_rate=0.05, seed=1)
+        validator = block_hasher.Validator(listener, spot_check=spot_check)
+        validator.validateContainer(ValidatorTest.stdLinearURN)
+        self.assertEqual((45, 121), listener.sampled)
+        self.assertEqual(45, listener.blocks)
+
+
+class BlockHashImage(object):
+    """An image stream with per-bevy block hashes, held in memory."""
+
+    def __init__(self, data, chunk_size, chunks_per_segment, corrupt=()):
+        self.data = data
+        self.size = len(data)
+        self.chunk_size = chunk_size
+        self.chunks_per_segment = chunks_per_segment
+        self.digests = []
+        for offset in range(0, len(data), chunk_size):
+            h = hashes.new(lexicon.HASH_SHA1)
+            if offset // chunk_size in corrupt:
+                h.update(b"corrupt")
+            h.update(data[offset:offset + chunk_size])
+            self.digests.append(h.digest())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def ReadAt(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def readBlockHashes(self, bevy_id, hash_datatype):
+        start = bevy_id * self.chunks_per_segment
+        return b"".join(self.digests[start:start + self.chunks_per_segment])
+
+
+class BlockHashImageResolver(object):
+    def __init__(self, image):
+        self.image = image
+
+    def AFF4FactoryOpen(self, urn):
+        return self.image
+
+
+class PerBlockListener(block_hasher.ValidationListener):
+    """A listener written against the per block callback."""
+
+    def __init__(self):
+        self.valid = []
+        self.invalid = []
+
+    def onValidBlockHash(self, a):
+        self.valid.append(a)
+
+    def onInvalidBlockHash(self, a, b, imageStreamURI, offset):
+        self.invalid.append(offset)
+
+
+class BatchListener(PerBlockListener):
+    def __init__(self):
+        super(BatchListener, self).__init__()
+        self.count = 0
+
+    def onValidBlockHashes(self, imageStreamURI, offset, count, digests):
+        self.count += count
+
+
+class BlockHashBatchTest(unittest.TestCase):
+    def validate(self, listener, spot_check=None, workers=2):
+        image = BlockHashImage(os.urandom(600 * 16), 16, 50,
+                               corrupt=(3, 300))
+        with block_hasher.Validator(listener, workers=workers,
+                                    spot_check=spot_check) as validator:
+            validator.resolver = BlockHashImageResolver(image)
+            validator.getStoredBlockHashes = lambda urn: [
+                block_hasher.BlockHashesHash(lexicon.HASH_SHA1, None,
+                                             lexicon.HASH_SHA512)]
+            validator.calculateBlockHashesHash("aff4://image")
+            if spot_check is None and workers is not None:
+                self.assertIsNotNone(validator.pool)
+
+        self.assertIsNone(validator.pool)
+        self.assertEqual([3 * 16, 300 * 16], listener.invalid)
+        return image
+
+    def testPerBlockListener(self):
+        listener = PerBlockListener()
+        image = self.validate(listener)
+
+        valid = [binascii.hexlify(d).decode("ascii")
+                 for i, d in enumerate(image.digests) if i not in (3, 300)]
+        self.assertEqual(valid, listener.valid)
+
+    def testMergedRanges(self):
+        image = BlockHashImage(os.urandom(600 * 16), 16, 50,
+                               corrupt=(3, 300))
+        stored = [block_hasher.BlockHashesHash(lexicon.HASH_SHA1, None,
+                                               lexicon.HASH_SHA512)]
+
+        def validator(listener):
+            result = block_hasher.Validator(listener)
+            result.resolver = BlockHashImageResolver(image)
+            result.getStoredBlockHashes = lambda urn: stored
+            return result
+
+        listener = PerBlockListener()
+        expected = validator(listener).calculateBlockHashesHash("aff4://image")
+
+        # Verifying the blocks in ranges, then merging what did not match
+        # into the stored hashes gives the same blockHashesHash.
+        ranged = PerBlockListener()
+        merged = validator(ranged)
+        mismatches = []
+        for first in range(0, 600, 70):
+            mismatches.extend(merged.hashBlocks(
+                "aff4://image", image, stored, first, 70))
+
+        self.assertEqual([3, 300], [chunk for _, chunk, _ in mismatches])
+        self.assertEqual(listener.invalid, ranged.invalid)
+        self.assertEqual(listener.valid, ranged.valid)
+
+        merged.blockMismatches = {"aff4://image": mismatches}
+        self.assertEqual(expected, merged.calculateBlockHashesHash("aff4://image"))
+
+        merged.blockMismatches = {"aff4://image": []}
+        self.assertNotEqual(expected, merged.calculateBlockHashesHash("aff4://image"))
+
+    def testSerial(self):
+        # Without workers the blocks are hashed without a pool.
+        listener = PerBlockListener()
+        self.validate(listener, workers=None)
+        self.assertEqual(598, len(listener.valid))
+
+    def testBatchListener(self):
+        listener = BatchListener()
+        self.validate(listener)
+
+        # Every valid block is counted, not just those before the first
+        # invalid block of a batch.
+        self.assertEqual(598, listener.count)
+        self.assertEqual([], listener.valid)
+
+    def testSpotCheck(self):
+        # Sampling every block finds both corrupt ones.
+        spot_check = block_hasher.SpotCheck(confidence=0.99,
+                                            corruption_rate=0.0001, seed=1)
+        listener = SpotCheckListener()
+        listener.invalid = []
+        listener.onInvalidBlockHash = (
+            lambda a, b, urn, offset: listener.invalid.append(offset))
+
+        # The library itself prints nothing, reporting is up to listeners.
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.validate(listener, spot_check)
+
+        self.assertEqual("", output.getvalue())
+        self.assertEqual((600, 600), listener.sampled)
+        self.assertEqual(598, listener.blocks)
+
+
+class HashEngineTest(unittest.TestCase):
+    datatypes = [lexicon.HASH_SHA1, lexicon.HASH_MD5, lexicon.HASH_SHA512]
+
+    def testThreadedMatchesInline(self):
+        data = [os.urandom(n) for n in (10, 100 * 1024, 5, 300 * 1024, 1)]
+
+        threaded = linear_hasher.PushHasher(self.datatypes)
+        inline = linear_hasher.PushHasher(self.datatypes, threaded=False)
+        for buf in data:
+            threaded.update(buf)
+            inline.update(buf)
+
+        # Reading the hashes waits for the threads to catch up.
+        self.assertEqual(inline.getHash(lexicon.HASH_SHA1).hexdigest(),
+                         threaded.getHash(lexicon.HASH_SHA1).hexdigest())
+        threaded.Finish()
+
+        for datatype in self.datatypes:
+            expected = hashes.new(datatype)
+            expected.update(b"".join(data))
+            self.assertEqual(expected.hexdigest(),
+                             threaded.getHash(datatype).hexdigest())
+            self.assertEqual(expected.hexdigest(),
+                             inline.getHash(datatype).hexdigest())
+
+        for h in threaded.hashes:
+            self.assertEqual(inline.getHash(threaded.hashToType[h]).hexdigest(),
+                             h.hexdigest())
+
+    def testStreamHasher(self):
+        data = os.urandom(1024 * 1024)
+        hasher = linear_hasher.StreamHasher(io.BytesIO(data), self.datatypes)
+        while hasher.read(64 * 1024):
+            pass
+        hasher.Finish()
+
+        expected = hashes.new(lexicon.HASH_SHA1)
+        expected.update(data)
+        self.assertEqual(expected.hexdigest(),
+                         hasher.getHash(lexicon.HASH_SHA1).hexdigest())
+
+    def testPipelinedRead(self):
+        data = os.urandom(1024 * 1024 + 17)
+        hasher = linear_hasher.LinearHasher2(None, read_size=64 * 1024,
+                                             queue_depth=2)
+        stream = linear_hasher.StreamHasher(io.BytesIO(data), self.datatypes)
+        hasher.readall2(stream)
+        stream.Finish()
+
+        expected = hashes.new(lexicon.HASH_MD5)
+        expected.update(data)
+        self.assertEqual(expected.hexdigest(),
+                         stream.getHash(lexicon.HASH_MD5).hexdigest())
+
+    def testPipelinedReadError(self):
+        class BrokenStream(object):
+            def read(self, length):
+                raise IOError("Broken")
+
+        hasher = linear_hasher.LinearHasher2(None)
+        stream = linear_hasher.StreamHasher(BrokenStream(), self.datatypes)
+        self.assertRaises(IOError, hasher.readall2, stream)
+
+    def testWorkersStopped(self):
+        baseline = threading.active_count()
+
+        # Leaving a with block stops the threads, even on error.
+        with self.assertRaises(IOError):
+            with linear_hasher.PushHasher(self.datatypes) as hasher:
+                hasher.update(os.urandom(100 * 1024))
+                self.assertEqual(baseline + len(self.datatypes),
+                                 threading.active_count())
+                raise IOError("Broken")
+
+        self.assertEqual(baseline, threading.active_count())
+
+        # So does dropping a hasher which was never finished.
+        hasher = linear_hasher.PushHasher(self.datatypes)
+        hasher.update(os.urandom(100 * 1024))
+        workers = hasher.workers
+        del hasher
+        gc.collect()
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,363 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Ingestion of files and tar archives into logical containers."""
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import collections
+import functools
+import io
+import multiprocessing
+import tarfile
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from pyaff4 import chunking
+from pyaff4 import escaping
+from pyaff4 import hashes
+from pyaff4 import lexicon
+from pyaff4 import linear_hasher
+from pyaff4 import logical
+from pyaff4 import rdfvalue
+from pyaff4 import zip
+
+DEFAULT_HASHES = [lexicon.HASH_SHA1, lexicon.HASH_MD5]
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class _PreparedMember(object):
+    """A file which has been read, hashed and compressed by a worker.
+
+    Files for hash based images are chunked instead, with chunks holding
+    (offset, chunk, SHA-512 hash) tuples.
+    """
+    def __init__(self, data, length, crc32, digests, chunks=None):
+        self.data = data
+        self.length = length
+        self.crc32 = crc32
+        self.digests = digests
+        self.chunks = chunks
+
+
+def _Digests(data, hashDatatypes):
+    digests = []
+    for hashDatatype in hashDatatypes:
+        h = hashes.new(hashDatatype)
+        h.update(data)
+        digests.append(hashes.newImmutableHash(h.hexdigest(), hashDatatype))
+    return digests
+
+
+def _PrepareMember(source, compression_method, hashDatatypes):
+    with source() as src:
+        data = src.read()
+
+    digests = _Digests(data, hashDatatypes)
+    crc32 = zlib.crc32(data) & 0xffffffff
+    length = len(data)
+    if compression_method == zip.ZIP_DEFLATE:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+
+    return _PreparedMember(data, length, crc32, digests)
+
+
+def _PrepareHashedMember(source, hashDatatypes):
+    with source() as src:
+        data = src.read()
+
+    chunks = chunking.Chunker().chunks(io.BytesIO(data), len(data))
+    return _PreparedMember(None, len(data), None, _Digests(data, hashDatatypes),
+                           list(chunking.hashChunks(chunks)))
+
+
+def writeStream(volume, pathname, src, length, hashDatatypes, hashbased=False,
+                pool=None, checkBytes=False, urn=None):
+    """Writes length bytes of src to the volume as the image of pathname,
+    hashing them on the way. The image is stored under urn if given.
+
+    Returns the URN of the image and the digests of its content.
+    """
+    with linear_hasher.StreamHasher(src, hashDatatypes) as hasher:
+        if not hashbased:
+            urn = volume.writeLogicalStream(pathname, hasher, length, pool=pool,
+                                            image_urn=urn)
+        else:
+            urn = volume.writeLogicalStreamRabinHashBased(
+                pathname, hasher, length, checkBytes, pool=pool, image_urn=urn)
+        hasher.Finish()
+
+    digests = [hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
+               for h in hasher.hashes]
+    return urn, digests
+
+
+def addFolder(volume, pathname, fsmeta):
+    """Records the folder pathname in the volume, returning its URN."""
+    resolver = volume.resolver
+    if volume.isAFF4Collision(pathname):
+        image_urn = rdfvalue.URN("aff4://%s" % uuid.uuid4())
+    else:
+        image_urn = volume.urn.Append(
+            escaping.arnPathFragment_from_path(pathname), quote=False)
+
+    fsmeta.urn = image_urn
+    fsmeta.store(resolver)
+    resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName),
+                 rdfvalue.XSDString(pathname))
+    resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
+                 rdfvalue.URN(lexicon.standard11.FolderImage))
+    resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
+                 rdfvalue.URN(lexicon.standard.Image))
+    return image_urn
+
+
+class _PrefixedStream(object):
+    """A stream of some bytes already read from fileobj, then the rest."""
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+
+        if size is None or size < 0:
+            data = self.prefix + self.fileobj.read()
+        else:
+            data = self.prefix[:size]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        self.prefix = self.prefix[len(data):]
+        return data
+
+
+def openTarStream(fileobj):
+    """Opens a tar archive for reading in a single pass over fileobj.
+
+    The archive may be compressed with gzip, bzip2 or xz, or with zstd
+    where tarfile or the zstandard module supports it. fileobj need not be seekable,
+    so this works on stdin.
+    """
+    magic = fileobj.read(len(ZSTD_MAGIC))
+    stream = _PrefixedStream(magic, fileobj)
+    if magic == ZSTD_MAGIC and "zst" not in tarfile.TarFile.OPEN_METH:
+        if zstandard is None:
+            raise IOError("Reading zstd compressed tar archives needs the zstandard module")
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+
+    return tarfile.open(fileobj=stream, mode="r|*")
+
+
+def ingestTar(volume, fileobj, hashDatatypes=None, hashbased=False, pool=None):
+    """Adds the members of a tar archive to the volume as it is read.
+
+    Each regular file is streamed from the archive into the volume and
+    hashed on the way, so the archive is read once and never extracted.
+    Large members are written as AFF4Images, with their chunks compressed
+    on the pool's workers if a pool is given.
+
+    Yields (pathname, urn) for each member, where urn is None for members
+    which are not files or folders (links, devices and the like).
+    """
+    resolver = volume.resolver
+    hashDatatypes = hashDatatypes or DEFAULT_HASHES
+    with openTarStream(fileobj) as tar:
+        for tarinfo in tar:
+            pathname = tarinfo.name
+            if tarinfo.isdir():
+                fsmeta = logical.FSMetadata.createFromTarInfo(pathname, tarinfo)
+                yield pathname, addFolder(volume, pathname, fsmeta)
+            elif tarinfo.isreg():
+                fsmeta = logical.FSMetadata.createFromTarInfo(pathname, tarinfo)
+                src = tar.extractfile(tarinfo)
+                urn, digests = writeStream(volume, pathname, src, fsmeta.length,
+                                           hashDatatypes, hashbased, pool)
+                fsmeta.urn = urn
+                fsmeta.store(resolver)
+                for hh in digests:
+                    resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+                yield pathname, urn
+            else:
+                yield pathname, None
+
+
+class LogicalIngester(object):
+    """Adds files to a writable logical container using a pool of workers.
+
+    Files small enough to be stored as zip segments are read, hashed and
+    compressed by the workers. The thread calling Add() is the only one
+    writing to the volume, and it writes the files in the order they were
+    added, so the container holds the same members and metadata as one
+    written serially with writeLogicalStream().
+
+    Larger files are streamed by the writing thread into an AFF4Image, with
+    the chunks of each bevy compressed by the workers.
+
+    With hashbased, small files are chunked and their chunks hashed by the
+    workers instead, and larger files are streamed by the writing thread
+    with their chunks hashed by the workers. checkBytes compares chunks
+    with the stored chunks of the same hash.
+    """
+
+    def __init__(self, volume, workers=None, hashDatatypes=None,
+                 hashbased=False, maxPending=None, checkBytes=False):
+        self.volume = volume
+        self.resolver = volume.resolver
+        self.hashDatatypes = hashDatatypes or DEFAULT_HASHES
+        self.hashbased = hashbased
+        self.checkBytes = checkBytes
+        self.workers = workers or multiprocessing.cpu_count()
+
+        # Bounds the number of prepared files held in memory.
+        self.maxPending = maxPending or 4 * self.workers
+        self.pending = collections.deque()
+        self.pool = ThreadPool(self.workers)
+
+        # Maps path names to the images already in the volume, built by
+        # IsUnchanged() when appending incrementally.
+        self.index = None
+
+        # The path names added in this run. Their URNs are chosen when they
+        # are queued, before any of them are written.
+        self.queued = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def IsUnchanged(self, pathname, fsmeta):
+        """Returns True if the volume already holds an image of the file with
+        the same size and timestamps.
+
+        Used when appending, to skip files stored by an earlier run without
+        reading them. Files which have changed are then added beside the
+        earlier images rather than written over them.
+        """
+        if self.index is None:
+            self.index = self.volume.pathIndex()
+
+        for urn in self.index.get(pathname):
+            if fsmeta.matches(self.resolver, urn):
+                return True
+        return False
+
+    def IsQueued(self, pathname):
+        """Returns True if a file was added under pathname in this run."""
+        return pathname in self.queued
+
+    def Add(self, pathname, fsmeta, source=None):
+        """Queues a file to be added to the volume.
+
+        The file is read from source(), which returns a new file object
+        each time it is called, or else from pathname.
+
+        Returns the URNs of any files written to the volume to make room.
+        """
+        if source is None:
+            source = functools.partial(open, pathname, "rb")
+
+        result = None
+        if fsmeta.length <= self.volume.maxSegmentResidentSize:
+            if self.hashbased:
+                result = self.pool.apply_async(
+                    _PrepareHashedMember, (source, self.hashDatatypes))
+            else:
+                result = self.pool.apply_async(
+                    _PrepareMember,
+                    (source, self.volume.zipCompressionMethod(),
+                     self.hashDatatypes))
+
+        urn = self._NewURN(pathname)
+        self.queued.add(pathname)
+        self.pending.append((pathname, fsmeta, source, result, urn))
+
+        written = []
+        while len(self.pending) > self.maxPending:
+            written.append(self._WriteNext())
+        return written
+
+    def Flush(self):
+        """Writes all the queued files, returning their URNs."""
+        written = []
+        while self.pending:
+            written.append(self._WriteNext())
+        return written
+
+    def _NewURN(self, pathname):
+        # A path already stored in the volume, or added earlier in this run,
+        # gets a fresh URN, so that the earlier image is kept as it was.
+        if pathname in self.queued or (
+                self.index is not None and self.index.get(pathname)):
+            return rdfvalue.URN("aff4://%s" % uuid.uuid4())
+        return self.volume.newImageURN(pathname)
+
+    def _WriteNext(self):
+        pathname, fsmeta, source, result, urn = self.pending.popleft()
+        if result is None:
+            urn, digests = self._WriteStream(pathname, fsmeta, source, urn)
+        else:
+            member = result.get()
+            if member.chunks is not None:
+                urn = self.volume.writeHashedChunks(
+                    pathname, member.chunks, self.checkBytes, urn)
+            else:
+                urn = self.volume.writeCompressedLogicalStream(
+                    pathname, member.data, member.length, member.crc32, urn)
+            digests = member.digests
+
+        fsmeta.urn = urn
+        fsmeta.store(self.resolver)
+        for hh in digests:
+            self.resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+        return urn
+
+    def _WriteStream(self, pathname, fsmeta, source, urn):
+        with source() as src:
+            return writeStream(self.volume, pathname, src, fsmeta.length,
+                               self.hashDatatypes, self.hashbased, self.pool,
+                               self.checkBytes, urn)
+
+    def close(self):
+        """Writes the queued files and stops the workers."""
+        try:
+            self.Flush()
+        except:
+            self.abort()
+            raise
+
+        self.pool.close()
+        self.pool.join()
+
+    def abort(self):
+        """Stops the workers, dropping any files not written yet."""
+        self.pending.clear()
+        self.pool.terminate()
+        self.pool.join()
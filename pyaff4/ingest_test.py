@@ -0,0 +1,429 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import calendar
+import functools
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from dateutil.parser import parse
+
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import escaping
+from pyaff4 import hashes
+from pyaff4 import ingest
+from pyaff4 import lexicon
+from pyaff4 import linear_hasher
+from pyaff4 import logical
+from pyaff4 import rdfvalue
+from pyaff4 import utils
+
+
+class LogicalIngesterTest(unittest.TestCase):
+    maxSegmentResidentSize = 64 * 1024
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.containers = []
+        self.pathnames = []
+
+        sizes = [0, 1, 100, 5000, 200000, 65536, 65537, 30000] + \
+                [i * 997 for i in range(1, 20)] + [300000]
+        for i, size in enumerate(sizes):
+            pathname = os.path.join(self.root, "file%02d" % i)
+            with open(pathname, "wb") as fd:
+                # Half random so the data compresses, but not to nothing.
+                data = os.urandom(size // 2) + b"x" * (size - size // 2)
+                fd.write(data)
+            self.pathnames.append(utils.SmartUnicode(pathname))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        for filename in self.containers:
+            os.unlink(filename)
+
+    def create(self, name, add):
+        filename = os.path.join(tempfile.gettempdir(), name)
+        self.containers.append(filename)
+        container_urn = rdfvalue.URN.FromFileName(filename)
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, container_urn) as volume:
+                volume.maxSegmentResidentSize = self.maxSegmentResidentSize
+                add(volume)
+        return container_urn
+
+    def addSerially(self, volume):
+        for pathname in self.pathnames:
+            fsmeta = logical.FSMetadata.create(pathname)
+            with open(pathname, "rb") as src, \
+                    linear_hasher.StreamHasher(src, ingest.DEFAULT_HASHES) as hasher:
+                urn = volume.writeLogicalStream(pathname, hasher, fsmeta.length)
+                hasher.Finish()
+            fsmeta.urn = urn
+            fsmeta.store(volume.resolver)
+            for h in hasher.hashes:
+                hh = hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
+                volume.resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+
+    def addInParallel(self, volume):
+        with ingest.LogicalIngester(volume, workers=4, maxPending=3) as ingester:
+            for pathname in self.pathnames:
+                ingester.Add(pathname, logical.FSMetadata.create(pathname))
+
+    def describe(self, container_urn):
+        """Returns the members, images and hashes of a container."""
+        with container.Container.openURNtoContainer(container_urn) as volume:
+            resolver = volume.resolver
+            with resolver.AFF4FactoryOpen(volume.urn) as zip_file:
+                members = []
+                for urn, info in zip_file.members.items():
+                    name = escaping.member_name_for_urn(
+                        urn, volume.version, volume.urn, use_unicode=True)
+                    if name == "information.turtle" or name == "container.description":
+                        # These hold the volume URN.
+                        continue
+                    members.append((name, info.compression_method,
+                                    info.compress_size, info.file_size,
+                                    info.crc32))
+
+            images = {}
+            for image in volume.images():
+                with resolver.AFF4FactoryOpen(image.urn) as fd:
+                    data = fd.ReadAll()
+                digests = sorted(
+                    (h.datatype, h.value) for h in resolver.QuerySubjectPredicate(
+                        volume.urn, image.urn, lexicon.standard.hash))
+                images[utils.SmartUnicode(image.pathName)] = (data, digests)
+
+        return members, images
+
+    def testSameAsSerial(self):
+        serial = self.describe(self.create("aff4_test_ingest_serial.aff4",
+                                           self.addSerially))
+        parallel = self.describe(self.create("aff4_test_ingest_parallel.aff4",
+                                             self.addInParallel))
+
+        self.assertEqual(serial[0], parallel[0])
+        self.assertEqual(serial[1], parallel[1])
+
+        members, images = parallel
+        self.assertEqual(len(self.pathnames), len(images))
+        for pathname in self.pathnames:
+            with open(pathname, "rb") as fd:
+                expected = fd.read()
+            data, digests = images[pathname]
+            self.assertEqual(expected, data)
+            self.assertEqual(
+                sorted([(lexicon.HASH_MD5, hashlib.md5(expected).hexdigest()),
+                        (lexicon.HASH_SHA1, hashlib.sha1(expected).hexdigest())]),
+                digests)
+
+        # The large files are AFF4Images, the others zip segments.
+        bevies = [m for m in members if m[0].endswith("/00000000")]
+        self.assertEqual(3, len(bevies))
+
+    def describeHashBased(self, container_urn):
+        """Returns the content, hashes and chunk hashes of the images."""
+        images = {}
+        with container.Container.openURNtoContainer(container_urn) as volume:
+            resolver = volume.resolver
+            for image in volume.images():
+                with resolver.AFF4FactoryOpen(image.urn) as fd:
+                    data = fd.Read(fd.Size())
+                    ranges = [(r.map_offset, r.length, fd.targets[r.target_id])
+                              for r in fd.GetRanges()]
+                digests = sorted(
+                    (h.datatype, h.value) for h in resolver.QuerySubjectPredicate(
+                        volume.urn, image.urn, lexicon.standard.hash))
+                images[utils.SmartUnicode(image.pathName)] = (data, digests, ranges)
+        return images
+
+    def testHashBasedSameAsSerial(self):
+        def addSerially(volume):
+            for pathname in self.pathnames:
+                with open(pathname, "rb") as src:
+                    urn, digests = ingest.writeStream(
+                        volume, pathname, src, os.path.getsize(pathname),
+                        ingest.DEFAULT_HASHES, hashbased=True)
+                for hh in digests:
+                    volume.resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+
+        def addInParallel(volume):
+            with ingest.LogicalIngester(volume, workers=4, hashbased=True) as ingester:
+                for pathname in self.pathnames:
+                    with open(pathname, "rb") as fd:
+                        data = fd.read()
+                    # Read from a source other than the file.
+                    ingester.Add(pathname, logical.FSMetadata.create(pathname),
+                                 functools.partial(io.BytesIO, data))
+
+        serial = self.describeHashBased(self.create(
+            "aff4_test_ingest_hash_serial.aff4", addSerially))
+        parallel = self.describeHashBased(self.create(
+            "aff4_test_ingest_hash_parallel.aff4", addInParallel))
+
+        self.assertEqual(len(self.pathnames), len(parallel))
+        self.assertEqual(serial, parallel)
+        for pathname in self.pathnames:
+            with open(pathname, "rb") as fd:
+                self.assertEqual(fd.read(), parallel[pathname][0])
+
+    def testSamePathTwice(self):
+        # Both files are queued before either is written, and each is given
+        # its own image.
+        contents = [b"first", b"second" * 20000]
+        def add(volume):
+            with ingest.LogicalIngester(volume, workers=2) as ingester:
+                for data in contents:
+                    self.assertEqual(data is contents[1],
+                                     ingester.IsQueued("same"))
+                    ingester.Add("same", logical.FSMetadata("same", "same", len(data)),
+                                 functools.partial(io.BytesIO, data))
+                self.assertEqual(2, len(ingester.Flush()))
+
+        container_urn = self.create("aff4_test_ingest_same_path.aff4", add)
+        with container.Container.openURNtoContainer(container_urn) as volume:
+            resolver = volume.resolver
+            urns = volume.pathIndex().get("same")
+            self.assertEqual(2, len(urns))
+
+            found = set()
+            for urn in urns:
+                with resolver.AFF4FactoryOpen(urn) as fd:
+                    data = fd.ReadAll()
+                found.add(data)
+                sizes = list(resolver.Get(lexicon.any, urn, lexicon.AFF4_STREAM_SIZE))
+                self.assertEqual(set([len(data)]), set(int(size) for size in sizes))
+                digests = dict((h.datatype, h.value) for h in resolver.QuerySubjectPredicate(
+                    volume.urn, urn, lexicon.standard.hash))
+                self.assertEqual(hashlib.sha1(data).hexdigest(), digests[lexicon.HASH_SHA1])
+            self.assertEqual(set(contents), found)
+
+    def testWorkerError(self):
+        os.unlink(self.pathnames[3])
+        filename = os.path.join(tempfile.gettempdir(),
+                                "aff4_test_ingest_error.aff4")
+        self.containers.append(filename)
+        container_urn = rdfvalue.URN.FromFileName(filename)
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, container_urn) as volume:
+                ingester = ingest.LogicalIngester(volume, workers=2)
+                fsmeta = logical.FSMetadata.create(self.pathnames[2])
+                ingester.Add(self.pathnames[2], fsmeta)
+                ingester.Add(self.pathnames[3], fsmeta)
+                self.assertRaises(IOError, ingester.close)
+                self.assertEqual(0, len(ingester.pending))
+
+
+class IncrementalIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filename = os.path.join(tempfile.gettempdir(),
+                                     "aff4_test_ingest_incremental.aff4")
+        self.urn = rdfvalue.URN.FromFileName(self.filename)
+        self.pathnames = []
+        for i in range(4):
+            pathname = os.path.join(self.root, "file%d" % i)
+            with open(pathname, "wb") as fd:
+                fd.write(b"data%d" % i)
+            self.pathnames.append(utils.SmartUnicode(pathname))
+
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, self.urn) as volume:
+                self.assertEqual([], self.add(volume))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        os.unlink(self.filename)
+
+    def add(self, volume):
+        skipped = []
+        with ingest.LogicalIngester(volume, workers=2) as ingester:
+            for pathname in self.pathnames:
+                fsmeta = logical.FSMetadata.create(pathname)
+                if ingester.IsUnchanged(pathname, fsmeta):
+                    skipped.append(pathname)
+                else:
+                    ingester.Add(pathname, fsmeta)
+        return skipped
+
+    def testSkipUnchanged(self):
+        with open(self.pathnames[1], "ab") as fd:
+            fd.write(b"more")
+        pathname = os.path.join(self.root, "new")
+        with open(pathname, "wb") as fd:
+            fd.write(b"new")
+        self.pathnames.append(utils.SmartUnicode(pathname))
+
+        with container.Container.openURNtoContainer(self.urn, mode="+") as volume:
+            skipped = self.add(volume)
+        self.assertEqual([self.pathnames[0], self.pathnames[2], self.pathnames[3]],
+                         skipped)
+
+        # The modified file is stored again as a new image, and the earlier
+        # one is kept.
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            index = volume.pathIndex()
+            self.assertEqual(sorted(self.pathnames + [self.pathnames[1]]),
+                             sorted(index.pathNames))
+            self.assertEqual(2, len(index.get(self.pathnames[1])))
+
+            contents = set()
+            for urn in index.get(self.pathnames[1]):
+                with volume.resolver.AFF4FactoryOpen(urn) as fd:
+                    contents.add(fd.ReadAll())
+            self.assertEqual(set([b"data1", b"data1more"]), contents)
+
+            # Nothing changed since.
+            with ingest.LogicalIngester(volume, workers=1) as ingester:
+                for pathname in self.pathnames:
+                    self.assertTrue(ingester.IsUnchanged(
+                        pathname, logical.FSMetadata.create(pathname)))
+
+    def testAppendKeepsPathARNs(self):
+        # Without the incremental check the files are stored under their
+        # paths again, as before.
+        with open(self.pathnames[1], "ab") as fd:
+            fd.write(b"more")
+
+        with container.Container.openURNtoContainer(self.urn, mode="+") as volume:
+            with ingest.LogicalIngester(volume, workers=2) as ingester:
+                for pathname in self.pathnames:
+                    ingester.Add(pathname, logical.FSMetadata.create(pathname))
+                urns = ingester.Flush()
+            self.assertEqual(
+                [volume.urn.Append(escaping.arnPathFragment_from_path(pathname),
+                                   quote=False)
+                 for pathname in self.pathnames], urns)
+
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            index = volume.pathIndex()
+            self.assertEqual(sorted(self.pathnames), sorted(index.pathNames))
+            with volume.resolver.AFF4FactoryOpen(index.get(self.pathnames[1])[0]) as fd:
+                self.assertEqual(b"data1more", fd.ReadAll())
+
+
+class _ReadOnlyStream(object):
+    """A stream which can not seek or tell, like stdin."""
+    def __init__(self, data):
+        self.fd = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.fd.read(size)
+
+
+class TarIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(tempfile.gettempdir(),
+                                     "aff4_test_ingest_tar.aff4")
+        self.urn = rdfvalue.URN.FromFileName(self.filename)
+        self.files = {
+            "dir/small": os.urandom(1000),
+            "dir/empty": b"",
+            "dir/sub/large": os.urandom(100000) + b"x" * 100000,
+        }
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def makeTar(self, mode, format):
+        fd = io.BytesIO()
+        with tarfile.open(fileobj=fd, mode=mode, format=format) as tar:
+            info = tarfile.TarInfo("dir")
+            info.type = tarfile.DIRTYPE
+            info.mtime = 1500000000
+            tar.addfile(info)
+
+            for pathname, data in sorted(self.files.items()):
+                info = tarfile.TarInfo(pathname)
+                info.size = len(data)
+                info.mtime = 1500000000
+                if format == tarfile.PAX_FORMAT:
+                    info.pax_headers = {"atime": "1500000001.5",
+                                        "ctime": "1500000002"}
+                tar.addfile(info, io.BytesIO(data))
+
+            info = tarfile.TarInfo("dir/link")
+            info.type = tarfile.SYMTYPE
+            info.linkname = "small"
+            tar.addfile(info)
+        return fd.getvalue()
+
+    def ingest(self, data, workers):
+        pool = ThreadPool(workers)
+        try:
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(resolver, self.urn) as volume:
+                    volume.maxSegmentResidentSize = 64 * 1024
+                    return [(pathname, urn is not None) for pathname, urn in
+                            ingest.ingestTar(volume, _ReadOnlyStream(data), pool=pool)]
+        finally:
+            pool.close()
+            pool.join()
+
+    def check(self, added):
+        self.assertEqual([("dir", True), ("dir/empty", True), ("dir/small", True),
+                          ("dir/sub/large", True), ("dir/link", False)], added)
+
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            resolver = volume.resolver
+            images = dict((utils.SmartUnicode(image.pathName), image.urn)
+                          for image in volume.images())
+            self.assertEqual(sorted(self.files), sorted(images))
+
+            for pathname, data in self.files.items():
+                urn = images[pathname]
+                with resolver.AFF4FactoryOpen(urn) as fd:
+                    self.assertEqual(data, fd.ReadAll())
+
+                digests = dict((h.datatype, h.value) for h in
+                               resolver.QuerySubjectPredicate(volume.urn, urn, lexicon.standard.hash))
+                self.assertEqual(hashlib.sha1(data).hexdigest(), digests[lexicon.HASH_SHA1])
+
+                lastWritten = next(resolver.QuerySubjectPredicate(
+                    volume.urn, urn, lexicon.standard11.lastWritten))
+                self.assertEqual(1500000000, calendar.timegm(
+                    parse(str(lastWritten)).utctimetuple()))
+
+            return list(resolver.QuerySubjectPredicate(
+                volume.urn, images["dir/small"], lexicon.standard11.lastAccessed))
+
+    def testPax(self):
+        self.check(self.ingest(self.makeTar("w:gz", tarfile.PAX_FORMAT), 4))
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            urn = volume.pathIndex().get("dir/small")[0]
+            lastAccessed = next(volume.resolver.QuerySubjectPredicate(
+                volume.urn, urn, lexicon.standard11.lastAccessed))
+            self.assertEqual(1500000001, calendar.timegm(
+                parse(str(lastAccessed)).utctimetuple()))
+
+    def testUstar(self):
+        # There are no access or change times in a ustar header.
+        accessed = self.check(self.ingest(self.makeTar("w", tarfile.USTAR_FORMAT), 1))
+        self.assertEqual([], accessed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,6 +22,10 @@ from builtins import next
 from builtins import str
 from builtins import object
 import binascii, rdflib, os
+import hashlib
+import hmac
+import threading
+import time
 from passlib.crypto import digest
 from pyaff4.aes_keywrap import aes_wrap_key, aes_unwrap_key
 from pyaff4.utils import SmartStr
@@ -40,6 +44,65 @@ keysize = 0x20  # in bytes
 iterations = 147256
 saltSize = 16
 
+# How long a KeyCache keeps unwrapped keys, in seconds.
+KEY_CACHE_TTL = 15 * 60
+
+
+class KeyCache(object):
+    """An in-process cache of unwrapped volume encryption keys.
+
+    Unwrapping a password wrapped keybag runs PBKDF2 over many iterations, so
+    repeatedly opening the same container is slow. Keys are cached per keybag
+    (by its salt and wrapped key) for ttl seconds, or until Wipe().
+
+    The secrets themselves are not kept. Each entry holds an HMAC of the
+    secret keyed by the volume key, and a cached key is only returned for
+    the secret that unwrapped it.
+
+    The cache may be shared between threads. Keys are unwrapped outside its
+    lock, so several containers can be unwrapped in parallel.
+    """
+
+    def __init__(self, ttl=KEY_CACHE_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _Verifier(self, vek, secret):
+        return hmac.new(vek, SmartStr(secret), hashlib.sha256).digest()
+
+    def Unwrap(self, keyBag, secret):
+        """Returns the volume key of keyBag, unwrapping it if needed."""
+        key = keyBag.cacheKey()
+        material = keyBag.cacheSecret(secret)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.clock() >= entry[2]:
+                del self.entries[key]
+                entry = None
+
+        if entry is not None:
+            vek, verifier, _ = entry
+            if hmac.compare_digest(verifier, self._Verifier(vek, material)):
+                return vek
+
+        vek = keyBag.unwrap_key(secret)
+        now = self.clock()
+        with self.lock:
+            for k in [k for k, v in self.entries.items() if now >= v[2]]:
+                del self.entries[k]
+            self.entries[key] = (vek, self._Verifier(vek, material),
+                                 now + self.ttl)
+
+        return vek
+
+    def Wipe(self):
+        """Forgets all the cached keys."""
+        with self.lock:
+            self.entries.clear()
+
+
 class PasswordWrappedKeyBag:
     def __init__(self, salt, iterations, keySizeBytes, wrappedKey):
         self.salt = salt
@@ -73,6 +136,13 @@ class PasswordWrappedKeyBag:
         #print("VEK: " + str(binascii.hexlify(vek)))
         return vek
 
+    def cacheKey(self):
+        return ("PasswordWrappedKeyBag", SmartStr(self.salt), self.iterations,
+                SmartStr(self.wrappedKey))
+
+    def cacheSecret(self, password):
+        return password
+
     def write(self, resolver, volumeARN):
         resolver.Add(volumeARN, self.ID, lexicon.AFF4_TYPE, rdfvalue.URN(lexicon.AFF4_PASSWORD_WRAPPED_KEYBAG))
         resolver.Set(volumeARN, self.ID, lexicon.AFF4_KEYSIZEBYTES, rdfvalue.XSDInteger(self.keySizeBytes))
@@ -126,6 +196,15 @@ class CertEncryptedKeyBag:
         #print("VEK: " + str(binascii.hexlify(vek)))
         return vek
 
+    def cacheKey(self):
+        return ("CertEncryptedKeyBag", self.serialNumber,
+                SmartStr(self.wrappedKey))
+
+    def cacheSecret(self, privateKey):
+        # The key file, rather than its path, is what unwraps the key.
+        with open(privateKey, "rb") as fd:
+            return fd.read()
+
     def write(self, resolver, volumeARN):
         resolver.Add(volumeARN, self.ID, lexicon.AFF4_TYPE, rdfvalue.URN(lexicon.AFF4_CERT_ENCRYPTED_KEYBAG))
         resolver.Set(volumeARN, self.ID, lexicon.AFF4_KEYSIZEBYTES, rdfvalue.XSDInteger(self.keySizeBytes))
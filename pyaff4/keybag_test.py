@@ -0,0 +1,140 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+import os
+import tempfile
+import threading
+import unittest
+
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import keybag
+from pyaff4 import rdfvalue
+
+
+class CountingKeyBag(keybag.PasswordWrappedKeyBag):
+    def __init__(self, kb):
+        keybag.PasswordWrappedKeyBag.__init__(
+            self, kb.salt, kb.iterations, kb.keySizeBytes, kb.wrappedKey)
+        self.unwraps = 0
+
+    def unwrap_key(self, password):
+        self.unwraps += 1
+        return keybag.PasswordWrappedKeyBag.unwrap_key(self, password)
+
+
+class KeyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = keybag.KeyCache(ttl=60, clock=lambda: self.now)
+        self.kb = CountingKeyBag(keybag.PasswordWrappedKeyBag.create("secret"))
+        self.vek = self.kb.unwrap_key("secret")
+        self.kb.unwraps = 0
+
+    def testCached(self):
+        self.assertEqual(self.vek, self.cache.Unwrap(self.kb, "secret"))
+        self.assertEqual(self.vek, self.cache.Unwrap(self.kb, "secret"))
+        self.assertEqual(1, self.kb.unwraps)
+
+        # A keybag loaded again (with a new ID) is the same keybag.
+        kb2 = CountingKeyBag(self.kb)
+        self.assertEqual(self.vek, self.cache.Unwrap(kb2, "secret"))
+        self.assertEqual(0, kb2.unwraps)
+
+    def testWrongPassword(self):
+        self.cache.Unwrap(self.kb, "secret")
+
+        # The cached key is only handed out for the password that unwrapped
+        # it.
+        self.assertRaises(ValueError, self.cache.Unwrap, self.kb, "wrong")
+        self.assertEqual(2, self.kb.unwraps)
+        self.assertEqual(self.vek, self.cache.Unwrap(self.kb, "secret"))
+        self.assertEqual(2, self.kb.unwraps)
+
+    def testExpiryAndWipe(self):
+        self.cache.Unwrap(self.kb, "secret")
+        self.now = 59
+        self.cache.Unwrap(self.kb, "secret")
+        self.assertEqual(1, self.kb.unwraps)
+
+        self.now = 60
+        self.cache.Unwrap(self.kb, "secret")
+        self.assertEqual(2, self.kb.unwraps)
+
+        self.cache.Wipe()
+        self.assertEqual({}, self.cache.entries)
+        self.cache.Unwrap(self.kb, "secret")
+        self.assertEqual(3, self.kb.unwraps)
+
+
+class EncryptedContainerKeyCacheTest(unittest.TestCase):
+    filenames = [tempfile.gettempdir() + "/aff4_test_keycache_%d.aff4" % i
+                 for i in range(2)]
+
+    def setUp(self):
+        self.tearDown()
+        for i, filename in enumerate(self.filenames):
+            urn = rdfvalue.URN.FromFileName(filename)
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(
+                        resolver, urn, encryption=True) as volume:
+                    volume.setPassword("password%d" % i)
+                    child = volume.getChildContainer()
+                    with child.newLogicalStream("/file", 10) as w:
+                        w.Write(b"container%d" % i)
+
+    def tearDown(self):
+        for filename in self.filenames:
+            try:
+                os.unlink(filename)
+            except (IOError, OSError):
+                pass
+
+    def read(self, i, cache):
+        urn = rdfvalue.URN.FromFileName(self.filenames[i])
+        with container.Container.openURNtoContainer(urn) as volume:
+            volume.setPassword("password%d" % i, keyCache=cache)
+            child = volume.getChildContainer()
+            image = list(child.images())[0]
+            with child.resolver.AFF4FactoryOpen(image.urn) as fd:
+                return fd.Read(100)
+
+    def testParallelOpens(self):
+        cache = keybag.KeyCache()
+        results = {}
+
+        def worker(i):
+            results[i] = self.read(i % 2, cache)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(2, len(cache.entries))
+        for i in range(4):
+            self.assertEqual(b"container%d" % (i % 2), results[i])
+
+        # Later opens use the cached keys.
+        self.assertEqual(b"container1", self.read(1, cache))
+        self.assertEqual(2, len(cache.entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
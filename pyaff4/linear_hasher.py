@@ -14,13 +14,20 @@ from __future__ import unicode_literals
 # License for the specific language governing permissions and limitations under
 # the License.
 
+from future import standard_library
+standard_library.install_aliases()
 from builtins import object
 import io
+import queue
+import threading
+import time
+import weakref
 from pyaff4 import block_hasher
 from pyaff4 import container
 from pyaff4 import data_store
 from pyaff4 import hashes
 from pyaff4 import lexicon
+from pyaff4 import utils
 from pyaff4 import zip
 from pyaff4 import aff4
 
@@ -136,22 +143,44 @@ class ScudetteLinearHasher(LinearHasher):
         self.lexicon = lex
         self.resolver = resolver
 
+# Size of the blocks LinearHasher2 reads (and decompresses) at a time.
+LINEAR_HASH_READ_SIZE = 4 * 1024 * 1024
+
+# How many blocks the reader may get ahead of the hashers.
+LINEAR_HASH_QUEUE_DEPTH = 4
+
+# Minimum time in seconds between progress reports.
+LINEAR_HASH_PROGRESS_INTERVAL = 0.25
+
+
 class LinearHasher2:
-    def __init__(self, resolver, listener=None):
+    def __init__(self, resolver, listener=None, read_size=LINEAR_HASH_READ_SIZE,
+                 queue_depth=LINEAR_HASH_QUEUE_DEPTH,
+                 progress_interval=LINEAR_HASH_PROGRESS_INTERVAL):
         if listener == None:
             self.listener = block_hasher.ValidationListener()
         else:
             self.listener = listener
         self.delegate = None
         self.resolver = resolver
+        self.read_size = read_size
+        self.queue_depth = queue_depth
+        self.progress_interval = progress_interval
 
     def hash(self, image, progress=None):
 
         storedHashes = list(self.resolver.QuerySubjectPredicate(image.container.urn, image.urn, lexicon.standard.hash))
+
+        # Report the hashes in a stable order, whatever order they were stored in.
+        storedHashes.sort(key=lambda h: (
+            block_hasher.hashOrderingMap.get(h.datatype, len(block_hasher.hashOrderingMap) + 1),
+            utils.SmartUnicode(h.datatype)))
         with self.resolver.AFF4FactoryOpen(image.urn, version=image.container.version) as stream:
             datatypes = [h.datatype for h in storedHashes]
-            stream2 = StreamHasher(stream, datatypes)
-            self.readall2(stream2, progress=progress)
+            with StreamHasher(stream, datatypes) as stream2:
+                self.readall2(stream2, progress=progress)
+                stream2.Finish()
+
             for storedHash in storedHashes:
                 dt = storedHash.datatype
                 shortHashAlgoName = storedHash.shortName()
@@ -164,54 +193,206 @@ class LinearHasher2:
 
 
     def readall2(self, stream, progress=None):
+        """Reads the stream to the end.
+
+        Reading (and so decompression) runs on its own thread, read_size
+        bytes at a time, and hands the blocks to the hashers on this thread
+        through a bounded queue.
+        """
         total_read = 0
         if progress is None:
             progress = aff4.EMPTY_PROGRESS
-        while True:
-            toRead = 32 * 1024
-            data = stream.read(toRead)
-            total_read += len(data)
-            progress.Report(total_read)
-            if data == None or len(data) == 0:
-                # EOF
-                return
-
 
-class StreamHasher(object):
-    def __init__(self, parent, hashDatatypes):
-        self.parent = parent
-        self.hashes = []
+        if isinstance(stream, StreamHasher):
+            source, sink = stream.parent, stream.update
+        else:
+            source, sink = stream, None
+
+        blocks = queue.Queue(self.queue_depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    data = source.read(self.read_size)
+                    put(data)
+                    if not data:
+                        return
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            last_report = time.time()
+            while True:
+                data = blocks.get()
+                if isinstance(data, Exception):
+                    raise data
+
+                if data == None or len(data) == 0:
+                    # EOF
+                    progress.Report(total_read)
+                    return
+
+                if sink is not None:
+                    sink(data)
+                total_read += len(data)
+
+                now = time.time()
+                if now - last_report >= self.progress_interval:
+                    progress.Report(total_read)
+                    last_report = now
+        finally:
+            stop.set()
+            thread.join()
+
+
+# Updates smaller than this are hashed inline, as handing them to the hashing
+# threads costs more than it saves.
+PARALLEL_HASH_MIN_SIZE = 16 * 1024
+
+# How many buffers each hashing thread may fall behind the producer.
+PARALLEL_HASH_QUEUE_DEPTH = 16
+
+
+def _HashWorker(h, q, errors):
+    while True:
+        data = q.get()
+        if data is None:
+            return
+
+        try:
+            h.update(data)
+        except Exception as e:
+            errors.append(e)
+
+
+def _StopWorkers(queues, workers):
+    for q in queues:
+        q.put(None)
+    for worker in workers:
+        worker.join()
+
+
+class HashEngine(object):
+    """Runs several hash algorithms over the same data.
+
+    With more than one algorithm each hash runs on its own thread, fed the
+    same (immutable) buffers through a bounded queue. hashlib releases the GIL
+    while hashing large buffers, so the algorithms run side by side and the
+    producer is free to read ahead. Finish() waits for the threads to catch
+    up; reading the hashes does so too. close() (or leaving a with block)
+    stops the threads without waiting for a result; they are also stopped
+    if the engine is dropped.
+    """
+
+    def __init__(self, hashDatatypes, threaded=None):
+        self._hashes = []
         self.hashToType = {}
         for hashDataType in hashDatatypes:
             h = hashes.new(hashDataType)
             self.hashToType[h] = hashDataType
-            self.hashes.append(h)
+            self._hashes.append(h)
 
-    def read(self, bytes):
-        data = self.parent.read(bytes)
-        datalen = len(data)
-        if datalen > 0:
-            for h in self.hashes:
-                h.update(data)
-        return data
+        if threaded is None:
+            threaded = len(self._hashes) > 1
+        self.threaded = threaded
+        self.queues = None
+        self.workers = None
+        self.errors = []
+        self._stop_workers = None
 
-    def getHash(self, dataType):
-        return next(h for h in self.hashes if self.hashToType[h] == dataType)
+    def __enter__(self):
+        return self
 
-class PushHasher(object):
-    def __init__(self, hashDatatypes):
-        self.hashes = []
-        self.hashToType = {}
-        for hashDataType in hashDatatypes:
-            h = hashes.new(hashDataType)
-            self.hashToType[h] = hashDataType
-            self.hashes.append(h)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def hashes(self):
+        self.Finish()
+        return self._hashes
 
     def update(self, data):
-        datalen = len(data)
-        if datalen > 0:
-            for h in self.hashes:
-                h.update(data)
+        if not data:
+            return
+
+        if self.workers is None:
+            if not self.threaded or len(data) < PARALLEL_HASH_MIN_SIZE:
+                for h in self._hashes:
+                    h.update(data)
+                return
+
+            self._StartWorkers()
+
+        # The buffer is shared by all the threads so it must not change.
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        for q in self.queues:
+            q.put(data)
+
+    def _StartWorkers(self):
+        self.queues = []
+        self.workers = []
+        for h in self._hashes:
+            q = queue.Queue(PARALLEL_HASH_QUEUE_DEPTH)
+            # The threads must not refer back to us, so that we can still be
+            # collected (and stop them) if we are dropped.
+            worker = threading.Thread(target=_HashWorker,
+                                      args=(h, q, self.errors))
+            worker.daemon = True
+            worker.start()
+            self.queues.append(q)
+            self.workers.append(worker)
+
+        self._stop_workers = weakref.finalize(
+            self, _StopWorkers, self.queues, self.workers)
+
+    def close(self):
+        """Stops the hashing threads once they have drained their queues."""
+        if self.workers is None:
+            return
+
+        self._stop_workers()
+        self._stop_workers = None
+        self.queues = None
+        self.workers = None
+
+    def Finish(self):
+        """Waits for all the data passed so far to be hashed.
+
+        Calling it again without new data has no further effect.
+        """
+        self.close()
+        if self.errors:
+            raise self.errors[0]
 
     def getHash(self, dataType):
-        return next(h for h in self.hashes if self.hashToType[h] == dataType)
\ No newline at end of file
+        return next(h for h in self.hashes if self.hashToType[h] == dataType)
+
+
+class StreamHasher(HashEngine):
+    def __init__(self, parent, hashDatatypes, threaded=None):
+        super(StreamHasher, self).__init__(hashDatatypes, threaded=threaded)
+        self.parent = parent
+
+    def read(self, bytes):
+        data = self.parent.read(bytes)
+        self.update(data)
+        return data
+
+
+class PushHasher(HashEngine):
+    pass
\ No newline at end of file
@@ -12,9 +12,11 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import collections
 import os
 import platform
-from pyaff4 import lexicon, rdfvalue
+import stat
+from pyaff4 import lexicon, rdfvalue, utils
 import tzlocal
 import pytz
 from datetime import datetime
@@ -24,6 +26,15 @@ import traceback
 if platform.system() == "Linux":
     from pyaff4 import statx
 
+_LOCAL_TZ = None
+
+def localZone():
+    """Returns the local timezone, looking it up only once."""
+    global _LOCAL_TZ
+    if _LOCAL_TZ is None:
+        _LOCAL_TZ = tzlocal.get_localzone()
+    return _LOCAL_TZ
+
 class FSMetadata(object):
     def __init__(self, urn, name, length):
         self.name = name
@@ -31,23 +42,45 @@ class FSMetadata(object):
         self.urn = urn
 
     def store(self, resolver):
-        resolver.Set(self.urn, rdfvalue.URN(lexicon.size), rdfvalue.XSDInteger(self.length))
-        resolver.Set(self.urn, rdfvalue.URN(lexicon.name), rdfvalue.XSDInteger(self.name))
+        resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.AFF4_STREAM_SIZE), rdfvalue.XSDInteger(self.length))
+
+    def matches(self, resolver, urn):
+        """Returns True if the metadata stored for the image urn records the
+        same size and timestamps as this metadata."""
+        if set(int(v) for v in resolver.Get(lexicon.any, urn, lexicon.AFF4_STREAM_SIZE)
+               if v is not None) != set([self.length]):
+            return False
+
+        for attribute, value in [(lexicon.standard11.lastWritten, getattr(self, "lastWritten", None)),
+                                 (lexicon.standard11.recordChanged, getattr(self, "recordChanged", None)),
+                                 (lexicon.standard11.birthTime, getattr(self, "birthTime", None))]:
+            if value is None:
+                continue
+            stored = [v for v in resolver.Get(lexicon.any, urn, attribute) if v is not None]
+            if len(stored) != 1 or parse(str(stored[0])) != value:
+                return False
+
+        return True
 
     @staticmethod
     def createFromTarInfo(filename, tarinfo):
         size = tarinfo.size
-        local_tz = tzlocal.get_localzone()
+        local_tz = localZone()
         lastWritten = datetime.fromtimestamp(tarinfo.mtime, local_tz)
-        accessed = datetime.fromtimestamp(int(tarinfo.pax_headers["atime"]), local_tz)
-        recordChanged = datetime.fromtimestamp(int(tarinfo.pax_headers["ctime"]), local_tz)
+        # only pax archives record atime and ctime
+        accessed = None
+        if "atime" in tarinfo.pax_headers:
+            accessed = datetime.fromtimestamp(float(tarinfo.pax_headers["atime"]), local_tz)
+        recordChanged = None
+        if "ctime" in tarinfo.pax_headers:
+            recordChanged = datetime.fromtimestamp(float(tarinfo.pax_headers["ctime"]), local_tz)
         # addedDate  ?? todo
-        return UnixMetadata(filename, filename, size, lastWritten, accessed, recordChanged)
+        return ClassicUnixMetadata(filename, filename, size, lastWritten, accessed, recordChanged)
 
     @staticmethod
     def createFromSFTPAttr(filename, attr):
         size = attr.st_size
-        local_tz = tzlocal.get_localzone()
+        local_tz = localZone()
         lastWritten = datetime.fromtimestamp(attr.st_mtime, local_tz)
         accessed = datetime.fromtimestamp(attr.st_atime, local_tz)
         #recordChanged = datetime.fromtimestamp(attr.st_ctime, local_tz)
@@ -55,10 +88,12 @@ class FSMetadata(object):
         return UnixMetadata(filename, filename, size, lastWritten, accessed, 0)
 
     @staticmethod
-    def create(filename):
-        s = os.stat(filename)
+    def create(filename, s=None):
+        # s may be a stat result the caller already has for filename
+        if s is None:
+            s = statPath(filename)
         p = platform.system()
-        local_tz = tzlocal.get_localzone()
+        local_tz = localZone()
 
         if p == "Windows":
             size = s.st_size
@@ -78,15 +113,57 @@ class FSMetadata(object):
             return MacOSFSMetadata(filename, filename, size, lastWritten, accessed, recordChanged, birthTime)
         elif p == "Linux":
             size = s.st_size
-            # TODO: birthTime
             lastWritten = datetime.fromtimestamp(s.st_mtime, local_tz)
             accessed = datetime.fromtimestamp(s.st_atime, local_tz)
             recordChanged = datetime.fromtimestamp(s.st_ctime, local_tz)
 
-            sx = statx.statx(filename)
-            birthTime = datetime.fromtimestamp(sx.get_btime(), local_tz)
+            # a statx result from statPath() already holds the birth time
+            if not isinstance(s, statx.Statx):
+                s = statx.statx(filename)
+            birthTime = datetime.fromtimestamp(s.get_btime(), local_tz)
             return LinuxFSMetadata(filename, filename, size, lastWritten, accessed, recordChanged, birthTime)
 
+def statPath(pathname):
+    """Returns the stat result for pathname which FSMetadata.create() takes.
+
+    On Linux this is a single statx call, which gives the birth time along
+    with the size and the other timestamps.
+    """
+    if platform.system() == "Linux":
+        return statx.statx(pathname, follow_symlinks=True)
+    return os.stat(pathname)
+
+def walk(pathnames, recursive):
+    """Yields (pathname, fsmeta, isDirectory) for each path, and if recursive
+    everything below the directories, breadth first.
+
+    Each path is only stat'ed once (with a single statx call on Linux), and
+    directories are read with scandir as they are reached rather than
+    collecting the whole tree up front. fsmeta is None for paths which could
+    not be found.
+    """
+    pending = collections.deque((utils.SmartUnicode(pathname), None)
+                                for pathname in pathnames)
+    while pending:
+        pathname, entry = pending.popleft()
+        try:
+            # scandir entries only save a call where they cache the stat
+            # result, which they do not on Linux
+            if entry is None or platform.system() == "Linux":
+                s = statPath(pathname)
+            else:
+                s = entry.stat()
+        except OSError:
+            yield pathname, None, False
+            continue
+
+        isDirectory = stat.S_ISDIR(s.st_mode)
+        yield pathname, FSMetadata.create(pathname, s), isDirectory
+
+        if isDirectory and recursive:
+            for child in os.scandir(pathname):
+                pending.append((child.path, child))
+
 class ClassicUnixMetadata(FSMetadata):
     def __init__(self, urn, name, size, lastWritten, lastAccessed, recordChanged):
         super(ClassicUnixMetadata, self).__init__(urn, name, size)
@@ -98,8 +175,11 @@ class ClassicUnixMetadata(FSMetadata):
     def store(self, resolver):
         resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.AFF4_STREAM_SIZE), rdfvalue.XSDInteger(self.length))
         resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.standard11.lastWritten), rdfvalue.XSDDateTime(self.lastWritten))
-        resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.standard11.lastAccessed), rdfvalue.XSDDateTime(self.lastAccessed))
-        resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.standard11.recordChanged), rdfvalue.XSDDateTime(self.recordChanged))
+        # timestamps taken from tar headers may be missing
+        if self.lastAccessed is not None:
+            resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.standard11.lastAccessed), rdfvalue.XSDDateTime(self.lastAccessed))
+        if self.recordChanged is not None:
+            resolver.Set(self.urn, self.urn, rdfvalue.URN(lexicon.standard11.recordChanged), rdfvalue.XSDDateTime(self.recordChanged))
 
 class ModernUnixMetadata(ClassicUnixMetadata):
     def __init__(self, urn, name, size, lastWritten, lastAccessed, recordChanged, birthTime):
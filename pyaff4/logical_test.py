@@ -26,6 +26,7 @@ import tempfile
 import random
 import math
 import platform
+import shutil
 
 
 
@@ -334,5 +335,66 @@ class LogicalTest(unittest.TestCase):
                     continue
 
 
+class WalkTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "a", "b"))
+        for name in ["f1", os.path.join("a", "f2"), os.path.join("a", "b", "f3")]:
+            with open(os.path.join(self.root, name), "wb") as fd:
+                fd.write(name.encode("utf-8"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testWalk(self):
+        missing = os.path.join(self.root, "missing")
+        entries = list(logical.walk([self.root, missing], True))
+
+        # Breadth first, as the directories are reached.
+        found = dict((pathname, (fsmeta, isDirectory))
+                     for pathname, fsmeta, isDirectory in entries)
+        self.assertEqual(7, len(entries))
+        self.assertEqual(self.root, entries[0][0])
+        self.assertEqual(missing, entries[1][0])
+        self.assertEqual(None, found[missing][0])
+        self.assertEqual(os.path.join(self.root, "a", "b", "f3"), entries[-1][0])
+
+        for name, isDirectory in [("a", True), ("f1", False),
+                                  (os.path.join("a", "b"), True),
+                                  (os.path.join("a", "f2"), False)]:
+            fsmeta, isDir = found[os.path.join(self.root, name)]
+            self.assertEqual(isDirectory, isDir)
+            if not isDirectory:
+                self.assertEqual(len(name), fsmeta.length)
+                self.assertEqual(os.path.join(self.root, name), fsmeta.name)
+
+    def testNotRecursive(self):
+        entries = list(logical.walk([self.root], False))
+        self.assertEqual(1, len(entries))
+        self.assertTrue(entries[0][2])
+
+    @unittest.skipIf(platform.system() != "Linux", "Only uses statx on Linux")
+    def testSingleStatx(self):
+        from pyaff4 import statx
+        calls = []
+        original = statx.statx
+        def counting(path, *args, **kwargs):
+            calls.append(path)
+            return original(path, *args, **kwargs)
+
+        statx.statx = counting
+        try:
+            entries = list(logical.walk([self.root], True))
+        finally:
+            statx.statx = original
+
+        self.assertEqual(sorted(pathname for pathname, _, _ in entries), sorted(calls))
+        for pathname, fsmeta, isDirectory in entries:
+            s = os.stat(pathname)
+            self.assertAlmostEqual(s.st_mtime, fsmeta.lastWritten.timestamp(), places=5)
+            if not isDirectory:
+                self.assertEqual(s.st_size, fsmeta.length)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""An index of the path names of the file images in a logical volume."""
+
+from builtins import object
+from builtins import range
+import bisect
+import re
+
+from pyaff4 import utils
+
+
+def normalize(pathName):
+    """Returns the form of a path name used for lookups.
+
+    Both kinds of separator become "/", and leading separators and "./" are
+    dropped, so "C:\\Users\\bob" is found as "C:/Users/bob" and "/tmp/a" as
+    "tmp/a".
+    """
+    pathName = utils.SmartUnicode(pathName).replace("\\", "/")
+    while True:
+        if pathName.startswith("/"):
+            pathName = pathName[1:]
+        elif pathName.startswith("./"):
+            pathName = pathName[2:]
+        else:
+            return pathName
+
+
+def _GlobToRegex(pattern):
+    """Translates a glob into a regular expression.
+
+    "*" and "?" do not match "/", "**" matches anything and [...] is a
+    character class.
+    """
+    res = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+            continue
+        elif c == "*":
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                res.append(re.escape(c))
+            else:
+                members = pattern[i + 1:end]
+                if members.startswith("!"):
+                    members = "^" + members[1:]
+                res.append("[%s]" % members.replace("\\", "\\\\"))
+                i = end
+        else:
+            res.append(re.escape(c))
+        i += 1
+
+    return re.compile("".join(res) + r"\Z", re.DOTALL)
+
+
+def _LiteralPrefix(pattern):
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+class PathIndex(object):
+    """Maps the path names of file images to their URNs.
+
+    The normalized path names are kept in a sorted array, so exact and
+    prefix lookups are a binary search, and a glob only scans the paths
+    starting with its literal prefix (everything before the first
+    wildcard). A path may map to several images, e.g. when a file was
+    appended again after it changed.
+    """
+
+    def __init__(self, entries=()):
+        entries = sorted(((normalize(pathName), utils.SmartUnicode(pathName), urn)
+                          for pathName, urn in entries), key=lambda e: e[0])
+        self.keys = [e[0] for e in entries]
+        self.pathNames = [e[1] for e in entries]
+        self.urns = [e[2] for e in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.keys, prefix)
+        for i in range(start, len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                return
+            yield i
+
+    def get(self, pathName):
+        """Returns the URNs of the images stored under pathName."""
+        key = normalize(pathName)
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, start)
+        return self.urns[start:end]
+
+    def prefix(self, prefix):
+        """Yields (pathName, urn) for the paths starting with prefix."""
+        for i in self._range(normalize(prefix)):
+            yield self.pathNames[i], self.urns[i]
+
+    def glob(self, pattern):
+        """Yields (pathName, urn) for the paths matching a glob pattern.
+
+        The pattern is matched against the whole normalized path, e.g.
+        "Users/*/NTUSER.DAT" or "C:/Users/**.lnk".
+        """
+        pattern = normalize(pattern)
+        regex = _GlobToRegex(pattern)
+        for i in self._range(_LiteralPrefix(pattern)):
+            if regex.match(self.keys[i]):
+                yield self.pathNames[i], self.urns[i]
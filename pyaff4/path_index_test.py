@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+import io
+import os
+import tempfile
+import unittest
+
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import path_index
+from pyaff4 import rdfvalue
+
+
+class PathIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = path_index.PathIndex([
+            ("C:\\Users\\bob\\NTUSER.DAT", "u1"),
+            ("C:\\Users\\alice\\NTUSER.DAT", "u2"),
+            ("C:\\Users\\alice\\Desktop\\a.lnk", "u3"),
+            ("C:\\Windows\\NTUSER.DAT", "u4"),
+            ("/Users/carol/NTUSER.DAT", "u5"),
+            ("/Users/carol/NTUSER.DAT", "u6"),
+            ("./rel/file1", "u7"),
+            ("/rel/file2", "u8"),
+        ])
+
+    def testNormalize(self):
+        self.assertEqual("C:/Users/bob", path_index.normalize("C:\\Users\\bob"))
+        self.assertEqual("tmp/a", path_index.normalize("/tmp/a"))
+        self.assertEqual("srv/share", path_index.normalize("\\\\srv\\share"))
+        self.assertEqual("a/b", path_index.normalize("./a/b"))
+
+    def testGet(self):
+        self.assertEqual(8, len(self.index))
+        self.assertEqual(["u1"], self.index.get("C:\\Users\\bob\\NTUSER.DAT"))
+        self.assertEqual(["u1"], self.index.get("C:/Users/bob/NTUSER.DAT"))
+        self.assertEqual(["u5", "u6"], self.index.get("Users/carol/NTUSER.DAT"))
+        self.assertEqual(["u7"], self.index.get("rel/file1"))
+        self.assertEqual([], self.index.get("C:/Users/bob"))
+
+    def testPrefix(self):
+        self.assertEqual(["u3", "u2", "u1"],
+                         [u for _, u in self.index.prefix("C:\\Users\\")])
+        self.assertEqual(["/rel/file2"],
+                         [p for p, _ in self.index.prefix("rel/file2")])
+
+    def testGlob(self):
+        def glob(pattern):
+            return sorted(u for _, u in self.index.glob(pattern))
+
+        self.assertEqual(["u5", "u6"], glob("Users/*/NTUSER.DAT"))
+        self.assertEqual(["u1", "u2"], glob("C:/Users/*/NTUSER.DAT"))
+        self.assertEqual(["u1", "u2", "u4"], glob("C:/**/NTUSER.DAT"))
+        self.assertEqual(["u1", "u2", "u4", "u5", "u6"], glob("**NTUSER.DAT"))
+        self.assertEqual(["u3"], glob("C:/Users/**.lnk"))
+        self.assertEqual([], glob("C:/*.lnk"))
+        self.assertEqual(["u7", "u8"], glob("rel/file?"))
+        self.assertEqual(["u8"], glob("rel/file[2-9]"))
+        self.assertEqual(["u7"], glob("rel/file[!2]"))
+        self.assertEqual(["u7"], glob("rel/file1"))
+        self.assertEqual([], glob("rel/file"))
+
+
+class ContainerPathIndexTest(unittest.TestCase):
+    filename = tempfile.gettempdir() + "/aff4_test_path_index.aff4"
+
+    def setUp(self):
+        self.urn = rdfvalue.URN.FromFileName(self.filename)
+        with data_store.MemoryDataStore() as resolver:
+            with container.Container.createURN(resolver, self.urn) as volume:
+                for pathName in ["/a/b/c.txt", "/a/d.txt", "C:\\e\\f.txt"]:
+                    volume.writeLogicalStream(pathName, io.BytesIO(b"x"), 1)
+
+                self.assertEqual(3, len(volume.pathIndex()))
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def testContainer(self):
+        with container.Container.openURNtoContainer(self.urn) as volume:
+            index = volume.pathIndex()
+            self.assertIs(index, volume.pathIndex())
+            self.assertEqual(["/a/d.txt"], [p for p, _ in index.glob("a/*.txt")])
+            urns = [u for _, u in index.glob("**.txt")]
+            self.assertEqual(3, len(urns))
+            self.assertEqual(
+                ["C:\\e\\f.txt"],
+                [volume.open(u).pathName.value for u in index.get("C:/e/f.txt")])
+
+
+if __name__ == '__main__':
+    unittest.main()
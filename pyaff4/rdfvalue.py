@@ -26,6 +26,7 @@ import os
 import binascii
 import posixpath
 import rdflib
+import weakref
 
 from pyaff4 import registry
 from pyaff4 import utils
@@ -43,15 +44,20 @@ class Memoize(object):
             if len(f.memo_pad) > 100:
                 f.memo_pad.clear()
 
-            if key not in f.memo_pad:
-                f.memo_pad[key] = f(self, *args)
+            # Another thread may clear the pad, so hold on to the result.
+            result = f.memo_pad.get(key)
+            if result is None:
+                result = f.memo_pad[key] = f(self, *args)
 
-            return f.memo_pad[key]
+            return result
 
         return Wrapped
 
 
 class RDFValue(object):
+    # Allow subclasses to declare __slots__ of their own.
+    __slots__ = ()
+
     datatype = ""
 
     def __init__(self, initializer=None):
@@ -234,12 +240,55 @@ class URN(RDFValue):
     internal representation of a URN is bytes. When creating the URN
     from other forms (e.g. filenames, we assume UTF8 encoding if the
     filename is a unicode string.
+
+    URNs are created and serialized in every resolver and object cache
+    operation, so they are interned: constructing a URN from a string (or
+    another URN) returns the live instance for that string if there is one.
+    The parsed and serialized forms are computed at most once per instance.
+    As instances are shared, a URN's value can not be changed once set.
     """
 
-    # The encoded URN as a unicode string.
-    value = None
+    __slots__ = ("value", "original_filename", "_hash", "_parsed",
+                 "_serialized", "_append_base", "__weakref__")
+
+    # Live URNs by value.
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, initializer=None):
+        if cls is URN and initializer is not None:
+            if isinstance(initializer, URN):
+                if initializer.value is None:
+                    return super(URN, cls).__new__(cls)
+                initializer = initializer.value
+
+            try:
+                result = cls._interned.get(initializer)
+            except TypeError:
+                result = None
+
+            if result is not None:
+                return result
+
+        return super(URN, cls).__new__(cls)
 
-    original_filename = None
+    def __init__(self, initializer=None):
+        try:
+            # Already initialised - this is an interned instance.
+            self.value
+            return
+        except AttributeError:
+            pass
+
+        self._Reset()
+        self.Set(initializer)
+
+    def _Reset(self):
+        self.value = None
+        self.original_filename = None
+        self._hash = hash(None)
+        self._parsed = None
+        self._serialized = None
+        self._append_base = None
 
     @classmethod
     def FromFileName(cls, filename):
@@ -258,8 +307,12 @@ class URN(RDFValue):
             # some kind of relative path
             filename = os.getcwd() + "/" + filename
 
-        result = cls("file://%s" % urllib.request.pathname2url(filename))
+        # The filename is particular to this caller, so the result is a
+        # private instance rather than the shared one for its value.
+        result = super(URN, cls).__new__(cls)
+        result._Reset()
         result.original_filename = filename
+        result.Set("file://%s" % urllib.request.pathname2url(filename))
         return result
 
     @classmethod
@@ -283,8 +336,11 @@ class URN(RDFValue):
         return rdflib.URIRef(self.value)
 
     def SerializeToString(self):
-        components = self.Parse()
-        return utils.SmartUnicode(urllib.parse.urlunparse(components))
+        if self._serialized is None:
+            components = self.Parse()
+            self._serialized = utils.SmartUnicode(
+                urllib.parse.urlunparse(components))
+        return self._serialized
 
     def UnSerializeFromString(self, string):
         utils.AssertStr(string)
@@ -296,13 +352,27 @@ class URN(RDFValue):
             return
 
         elif isinstance(data, URN):
-            self.value = data.value
+            data = data.value
         else:
             utils.AssertUnicode(data)
-            self.value = data
+
+        if self.value is not None:
+            if data == self.value:
+                return
+
+            raise TypeError("URN %s can not be changed to %s" % (
+                self.value, data))
+
+        self.value = data
+        if type(self) is URN and self.original_filename is None:
+            URN._interned.setdefault(data, self)
+
+        self._hash = hash(self.value)
 
     def Parse(self):
-        return self._Parse(self.value)
+        if self._parsed is None:
+            self._parsed = self._Parse(self.value)
+        return self._parsed
 
     # URL parsing seems to be slow in Python so we cache it as much as possible.
     @Memoize()
@@ -322,7 +392,6 @@ class URN(RDFValue):
                 netloc="",
                 path=urllib.request.pathname2url(value),
                 scheme="file")
-            self.original_filename = value
 
         return components
 
@@ -331,10 +400,22 @@ class URN(RDFValue):
         return components.scheme
 
     def Append(self, component, quote=True):
-        components = self.Parse()
         if quote:
             component = urllib.parse.quote(component)
 
+        # Fast path for the common case of appending a single plain path
+        # element (e.g. bevy and index names) to an aff4 URN.
+        if ("/" not in component and component not in ("", ".", "..") and
+                self.value.startswith("aff4:")):
+            if self._append_base is None:
+                components = self.Parse()
+                self._append_base = (u"%s://%s%s" % (
+                    components.scheme, components.hostname,
+                    components.path)).rstrip("/")
+            return URN(u"%s/%s" % (self._append_base, component))
+
+        components = self.Parse()
+
         if components.scheme.startswith("http"):
             new_path = posixpath.normpath(posixpath.join(
                 "/", components.path, component))
@@ -375,11 +456,15 @@ class URN(RDFValue):
         return "<%s>" % self.value
 
     def __eq__(self, other):
+        if other is self:
+            return True
+        if isinstance(other, URN):
+            return self.value == other.value
         #return utils.SmartStr(self) == utils.SmartStr(other)
         return utils.SmartUnicode(self.value) == utils.SmartUnicode(other)
 
     def __hash__(self):
-        return hash(self.value)
+        return self._hash
 
     def __ne__(self, other):
         #return utils.SmartStr(self) == utils.SmartStr(other)
@@ -56,6 +56,37 @@ class URNTest(unittest.TestCase):
             test.Append("aa///////////.///./c").SerializeToString(),
             "http://www.google.com/aa/c")
 
+    def testInterning(self):
+        a = rdfvalue.URN("aff4://volumeguid/image")
+        b = rdfvalue.URN("aff4://volumeguid/image")
+        self.assertTrue(a is b)
+        self.assertTrue(rdfvalue.URN(a) is a)
+        self.assertTrue(a.Append("0000") is b.Append("0000"))
+
+        # Shared URNs can not be changed.
+        c = rdfvalue.URN("aff4://volumeguid/other")
+        c.Set("aff4://volumeguid/other")
+        with self.assertRaises(TypeError):
+            c.Set("aff4://volumeguid/renamed")
+        self.assertEquals(c.SerializeToString(), "aff4://volumeguid/other")
+
+        # A URN made from a filename keeps it to itself.
+        d = rdfvalue.URN.FromFileName("/tmp/foo bar")
+        self.assertEquals(d.original_filename, "/tmp/foo bar")
+        self.assertFalse(rdfvalue.URN(d) is d)
+        self.assertEquals(rdfvalue.URN(d), d)
+        self.assertIsNone(rdfvalue.URN(d).original_filename)
+
+    def testAppendFastPath(self):
+        self.assertEquals(rdfvalue.URN("aff4://volumeguid").Append("map"),
+                          "aff4://volumeguid/map")
+        self.assertEquals(rdfvalue.URN("aff4://volumeguid/").Append("map"),
+                          "aff4://volumeguid/map")
+        self.assertEquals(rdfvalue.URN("aff4://volumeguid/a b").Append("c d"),
+                          "aff4://volumeguid/a b/c%20d")
+        self.assertEquals(rdfvalue.URN("aff4://volumeguid/a").Append(".."),
+                          "aff4://volumeguid/")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -59,6 +59,28 @@ class Statx(ctypes.Structure):
     def get_btime(self):
         return self.stx_btime.tv_sec + (self.stx_btime.tv_nsec / 1000000000)
 
+    # The same fields as an os.stat_result, so the result can be used in
+    # place of one.
+    @property
+    def st_mode(self):
+        return self.stx_mode
+
+    @property
+    def st_size(self):
+        return self.stx_size
+
+    @property
+    def st_atime(self):
+        return self.stx_atime.tv_sec + (self.stx_atime.tv_nsec / 1000000000)
+
+    @property
+    def st_mtime(self):
+        return self.stx_mtime.tv_sec + (self.stx_mtime.tv_nsec / 1000000000)
+
+    @property
+    def st_ctime(self):
+        return self.stx_ctime.tv_sec + (self.stx_ctime.tv_nsec / 1000000000)
+
 
 # https://github.com/hrw/syscalls-table
 SYSCALLS = {
@@ -106,18 +128,29 @@ STATX_ALL = 0xfff # stat.h
 SYS_STATX = SYSCALLS[platform.machine()]
 
 
-def statx(path):
-    pathname = ctypes.c_char_p(utils.SmartStr(path))
-    statxbuf = ctypes.create_string_buffer(ctypes.sizeof(Statx))
+_SYSCALL = None
+
+def _syscall():
+    # Loading libc and declaring the prototype is slow, so only do it once.
+    global _SYSCALL
+    if _SYSCALL is None:
+        lib = ctypes.CDLL(None, use_errno=True)
+        syscall = lib.syscall
+
+        # int statx(int dirfd, const char *pathname, int flags, unsigned int mask, struct statx *statxbuf);
+        syscall.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_char_p]
+        syscall.restype = ctypes.c_int
+        _SYSCALL = syscall
+    return _SYSCALL
 
-    lib = ctypes.CDLL(None, use_errno=True)
-    syscall = lib.syscall
 
-    # int statx(int dirfd, const char *pathname, int flags, unsigned int mask, struct statx *statxbuf);
-    syscall.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_char_p]
-    syscall.restype = ctypes.c_int
+def statx(path, follow_symlinks=False):
+    pathname = ctypes.c_char_p(utils.SmartStr(path))
+    statxbuf = ctypes.create_string_buffer(ctypes.sizeof(Statx))
+    flags = 0 if follow_symlinks else AT_SYMLINK_NOFOLLOW
 
-    if syscall(SYS_STATX, AT_FDCWD, pathname, AT_SYMLINK_NOFOLLOW, STATX_ALL, statxbuf):
+    syscall = _syscall()
+    if syscall(SYS_STATX, AT_FDCWD, pathname, flags, STATX_ALL, statxbuf):
         e = ctypes.get_errno()
         raise OSError(e, os.strerror(e), path)
     return Statx.from_buffer(statxbuf)
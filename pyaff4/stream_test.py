@@ -68,6 +68,16 @@ class StreamTest(unittest.TestCase):
         self.assertEquals(b"heI have 2 arms and 0x401 legs.",
                           stream.Read(1000))
 
+        # Positional reads leave the read pointer alone.
+        stream.SeekRead(3, 0)
+        self.assertEquals(b"have", stream.ReadAt(4, 4))
+        self.assertEquals(3, stream.TellRead())
+
+        buf = bytearray(8)
+        self.assertEquals(4, stream.ReadAtInto(27, buf))
+        self.assertEquals(b"egs.", bytes(buf[:4]))
+        self.assertEquals(3, stream.TellRead())
+
     def testFileBackedStream(self):
         filename = tempfile.gettempdir() + "/test_filename.zip"
         fileURI = rdfvalue.URN.FromFileName(filename)
@@ -86,6 +96,27 @@ class StreamTest(unittest.TestCase):
         finally:
             os.unlink(filename)
 
+    def testReadOnlyFileReadAt(self):
+        filename = tempfile.gettempdir() + "/test_readat.bin"
+        fileURI = rdfvalue.URN.FromFileName(filename)
+        with open(filename, "wb") as fd:
+            fd.write(b"0123456789")
+
+        try:
+            with data_store.MemoryDataStore() as resolver:
+                with resolver.AFF4FactoryOpen(fileURI) as file_stream:
+                    self.assertEquals(b"345", file_stream.ReadAt(3, 3))
+                    self.assertEquals(b"89", file_stream.ReadAt(8, 10))
+                    self.assertEquals(b"", file_stream.ReadAt(20, 10))
+
+                    buf = bytearray(4)
+                    self.assertEquals(4, file_stream.ReadAtInto(6, buf))
+                    self.assertEquals(b"6789", bytes(buf))
+
+                    self.assertEquals(b"0123", file_stream.Read(4))
+        finally:
+            os.unlink(filename)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -33,6 +33,9 @@ class RepeatedStream(aff4.AFF4Stream):
     def Read(self, length):
         return self.symbol * length
 
+    def ReadAt(self, offset, length):
+        return self.symbol * length
+
     def Write(self, data):
         raise NotImplementedError()
 
@@ -74,14 +77,19 @@ class RepeatedStringStream(aff4.AFF4Stream):
         self.tilesize = len(self.tile)
 
     def Read(self, length):
+        res = self.ReadAt(self.readptr, length)
+        self.readptr += len(res)
+        return res
+
+    def ReadAt(self, offset, length):
         toRead = length
         res = b""
         while toRead > 0:
-            offsetInTile = self.readptr % self.tilesize
+            offsetInTile = offset % self.tilesize
             chunk = self.tile[offsetInTile : offsetInTile + toRead]
             res += chunk
             toRead -= len(chunk)
-            self.readptr += len(chunk)
+            offset += len(chunk)
 
         return res
 
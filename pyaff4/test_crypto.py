@@ -2,6 +2,7 @@ from future import standard_library
 standard_library.install_aliases()
 import os
 import io
+import threading
 import unittest
 
 import binascii
@@ -14,6 +15,7 @@ from Crypto.Hash import SHA256, SHA1
 from Crypto.Signature import pss
 import codecs
 import rdflib
+from pyaff4 import encrypted_stream
 from pyaff4 import keybag
 
 referenceImagesPath = os.path.join(os.path.dirname(__file__), u"..",
@@ -107,6 +109,46 @@ class CryptoTest(unittest.TestCase):
 
         self.assertEqual(src[0:len(src)], text[0:len(src)])
 
+    def testXTSBackends(self):
+        vek = binascii.unhexlify("000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f")
+        plaintext = src + b'\x00' * (512-len(src))
+        data = os.urandom(512 * 5)
+
+        results = []
+        for backend in encrypted_stream.XTS_CIPHER_BACKENDS:
+            cipher = backend(vek[0:16], vek[16:])
+            self.assertEqual(target_ciphertext, cipher.encrypt(plaintext, 0, 512))
+            self.assertEqual(plaintext, cipher.decrypt(target_ciphertext, 0, 512))
+
+            ciphertext = cipher.encrypt(data, 1000, 512)
+            self.assertEqual(data, cipher.decrypt(ciphertext, 1000, 512))
+            self.assertEqual(ciphertext[512:1024], cipher.encrypt(data[512:1024], 1001, 512))
+            results.append(ciphertext)
+
+        self.assertEqual(results[0], results[1])
+
+    def testXTSBackendsInParallel(self):
+        vek = os.urandom(32)
+        data = os.urandom(512 * 8)
+
+        for backend in encrypted_stream.XTS_CIPHER_BACKENDS:
+            cipher = backend(vek[0:16], vek[16:])
+            expected = [cipher.encrypt(data, sector, 512)
+                        for sector in range(4)]
+
+            results = {}
+            def worker(sector):
+                results[sector] = cipher.encrypt(data, sector, 512)
+
+            threads = [threading.Thread(target=worker, args=(sector,))
+                       for sector in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(expected, [results[i] for i in range(4)])
+
 
     def testWrap(self):
         keysize = 0x20   # in bytes
@@ -0,0 +1,335 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Verification of many images and containers on a pool of processes."""
+
+from builtins import object
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+
+from pyaff4 import block_hasher
+from pyaff4 import container
+from pyaff4 import keybag
+from pyaff4 import lexicon
+from pyaff4 import linear_hasher
+from pyaff4 import rdfvalue
+from pyaff4 import utils
+
+LOGGER = logging.getLogger("pyaff4")
+
+# With several workers, the blocks of image streams larger than this are
+# verified in ranges of about this size, of whole bevies where they are
+# smaller.
+BLOCK_RANGE_SIZE = 1024 * 1024 * 1024
+
+
+class VerificationResult(object):
+    """The outcome of one hash comparison."""
+
+    def __init__(self, typ, valid, stored, calculated, urn, offset=None):
+        self.typ = typ
+        self.valid = valid
+        self.stored = stored
+        self.calculated = calculated
+        self.urn = urn
+        self.offset = offset
+
+
+class CollectingListener(block_hasher.ValidationListener):
+    """Records the verification outcomes instead of acting on them."""
+
+    def __init__(self):
+        super(CollectingListener, self).__init__()
+        self.results = []
+
+    def onInvalidBlockHash(self, a, b, imageStreamURI, offset):
+        self.results.append(VerificationResult(
+            "BlockHash", False, b, a, utils.SmartUnicode(imageStreamURI),
+            offset=offset))
+
+    def onValidHash(self, typ, hash, imageStreamURI):
+        self.results.append(VerificationResult(
+            typ, True, utils.SmartUnicode(hash), utils.SmartUnicode(hash),
+            utils.SmartUnicode(imageStreamURI)))
+
+    def onInvalidHash(self, typ, a, b, streamURI):
+        self.results.append(VerificationResult(
+            typ, False, utils.SmartUnicode(a), utils.SmartUnicode(b),
+            utils.SmartUnicode(streamURI)))
+
+    def onSpotCheck(self, imageStreamURI, sampled, total, probability):
+        self.results.append(VerificationResult(
+            "SpotCheck", True, "%d of %d blocks" % (sampled, total),
+            "%.4f" % probability, utils.SmartUnicode(imageStreamURI)))
+
+
+class VerificationJob(object):
+    """A unit of verification work.
+
+    A job either hashes one logical image (image_urn is set), validates
+    the block hashes of a whole physical image container, or verifies a
+    range of the blocks of one of its image streams (first_chunk is set).
+
+    A container job with ranges is run once they are done, and uses the
+    mismatches they found rather than reading the blocks again.
+    """
+
+    def __init__(self, filename, password=None, image_urn=None, name=None,
+                 size=0, spot_check=None, image_stream_urn=None,
+                 first_chunk=None, chunk_count=None):
+        self.filename = filename
+        self.spot_check = spot_check
+        self.password = password
+        self.image_urn = image_urn
+        self.name = name
+        self.size = size
+        self.image_stream_urn = image_stream_urn
+        self.first_chunk = first_chunk
+        self.chunk_count = chunk_count
+        self.ranges = None
+        self.mismatches = None
+        self.results = None
+        self.error = None
+
+
+# Containers opened by this (worker) process, keyed by (filename, password).
+# Reopening a container means parsing its zip directory and metadata again,
+# so workers keep them open for the images that follow.
+_OPEN_CONTAINERS = {}
+
+# Volume keys unwrapped by this process, so that an encrypted container's
+# key derivation is run once per process rather than once per open.
+_KEY_CACHE = keybag.KeyCache()
+
+
+def _OpenContainer(filename, password):
+    key = (filename, password)
+    result = _OPEN_CONTAINERS.get(key)
+    if result is None:
+        volume = container.Container.openURNtoContainer(
+            rdfvalue.URN.FromFileName(filename))
+        image_volume = volume
+        if password is not None:
+            volume.setPassword(password, keyCache=_KEY_CACHE)
+            image_volume = volume.getChildContainer()
+
+        images = dict((utils.SmartUnicode(image.urn), image)
+                      for image in image_volume.images())
+        result = _OPEN_CONTAINERS[key] = (volume, image_volume, images)
+
+    return result
+
+
+def _CloseContainers():
+    while _OPEN_CONTAINERS:
+        _, (volume, _, _) = _OPEN_CONTAINERS.popitem()
+        volume.__exit__(None, None, None)
+
+    _KEY_CACHE.Wipe()
+
+
+def _InitWorker():
+    # Pool workers close their cached containers as they exit, which they do
+    # once the pool is closed and has run out of jobs.
+    multiprocessing.util.Finalize(None, _CloseContainers, exitpriority=10)
+
+
+def RunJob(job):
+    """Runs a verification job, returns its list of VerificationResults."""
+    listener = CollectingListener()
+    if job.first_chunk is not None:
+        with block_hasher.Validator(listener) as validator:
+            job.mismatches = validator.validateBlockRange(
+                rdfvalue.URN.FromFileName(job.filename), job.image_stream_urn,
+                job.first_chunk, job.chunk_count)
+    elif job.image_urn is None:
+        with block_hasher.Validator(listener,
+                                    spot_check=job.spot_check) as validator:
+            validator.blockMismatches = job.mismatches
+            validator.validateContainer(
+                rdfvalue.URN.FromFileName(job.filename))
+    else:
+        _, volume, images = _OpenContainer(job.filename, job.password)
+        hasher = linear_hasher.LinearHasher2(volume.resolver, listener)
+        hasher.hash(images[job.image_urn])
+
+    return listener.results
+
+
+def _RunJob(job):
+    # Pool entry point: failures are reported with the job rather than
+    # tearing down the whole run.
+    try:
+        job.results = RunJob(job)
+    except Exception as e:
+        LOGGER.exception("Verification of %s failed", job.name)
+        job.error = utils.SmartUnicode(e)
+
+    return job
+
+
+class VerificationScheduler(object):
+    """Verifies the images of several containers with a pool of workers.
+
+    Jobs are handed out largest first, so that a single huge image starts
+    early rather than holding up the end of the run. The blocks of large
+    physical images are verified in ranges spread over the workers. Results
+    are reported in the order the jobs were added.
+
+    If spot_check is a block_hasher.SpotCheck, physical images only have a
+    sample of their blocks verified.
+    """
+
+    def __init__(self, workers=1, spot_check=None,
+                 block_range_size=BLOCK_RANGE_SIZE):
+        self.workers = workers
+        self.spot_check = spot_check
+        self.block_range_size = block_range_size
+        self.jobs = []
+
+    def _BlockRanges(self, filename, volume):
+        """Splits the blocks of the large image streams of a container.
+
+        Returns a list of range jobs, or None if there is nothing to split.
+        """
+        resolver = volume.resolver
+        ranges = []
+        for image_type in (lexicon.AFF4_IMAGE_TYPE, lexicon.AFF4_LEGACY_IMAGE_TYPE):
+            for stream_urn in resolver.QueryPredicateObject(
+                    volume.urn, lexicon.AFF4_TYPE, rdfvalue.URN(image_type)):
+                with resolver.AFF4FactoryOpen(stream_urn) as stream:
+                    if stream.size <= self.block_range_size:
+                        continue
+
+                    # Each range reads the stored hashes of its bevies.
+                    count = max(1, self.block_range_size // stream.chunk_size)
+                    if count > stream.chunks_per_segment:
+                        count -= count % stream.chunks_per_segment
+                    total = (stream.size + stream.chunk_size - 1) // stream.chunk_size
+                    for first_chunk in range(0, total, count):
+                        ranges.append(VerificationJob(
+                            filename, name=utils.SmartUnicode(stream_urn),
+                            size=min(count, total - first_chunk) * stream.chunk_size,
+                            image_stream_urn=utils.SmartUnicode(stream_urn),
+                            first_chunk=first_chunk, chunk_count=count))
+
+        return ranges or None
+
+    @staticmethod
+    def _Finish(job, ranges, run):
+        """Runs a container job once the ranges of its blocks are done."""
+        results = []
+        mismatches = {}
+        for done in ranges:
+            if done.error is not None:
+                job.error = done.error
+                job.results = results
+                return job
+
+            results.extend(done.results)
+            mismatches.setdefault(done.image_stream_urn, []).extend(
+                done.mismatches)
+
+        job.mismatches = mismatches
+        job = run(job)
+        if job.results is not None:
+            job.results = results + job.results
+        return job
+
+    def AddContainer(self, filename, password=None, onOpen=None):
+        """Adds jobs for all the images of a container.
+
+        onOpen, if given, is called with the (decrypted) container while it is
+        open. Returns the list of jobs added.
+        """
+        filename = os.path.abspath(filename)
+        jobs = []
+        with container.Container.openURNtoContainer(
+                rdfvalue.URN.FromFileName(filename)) as volume:
+            image_volume = volume
+            if password is not None:
+                volume.setPassword(password, keyCache=_KEY_CACHE)
+                image_volume = volume.getChildContainer()
+
+            if onOpen is not None:
+                onOpen(image_volume)
+
+            if password is None and issubclass(
+                    volume.__class__, container.PhysicalImageContainer):
+                job = VerificationJob(
+                    filename, name=utils.SmartUnicode(volume.urn),
+                    size=os.path.getsize(filename),
+                    spot_check=self.spot_check)
+
+                # Spot checks only read a sample, which is not worth splitting.
+                if self.workers > 1 and self.spot_check is None:
+                    job.ranges = self._BlockRanges(filename, volume)
+                jobs.append(job)
+            else:
+                for image in image_volume.images():
+                    size = image_volume.resolver.GetUnique(
+                        image_volume.urn, image.urn, lexicon.AFF4_STREAM_SIZE)
+                    jobs.append(VerificationJob(
+                        filename, password=password,
+                        image_urn=utils.SmartUnicode(image.urn),
+                        name=image.name(), size=int(size or 0)))
+
+        self.jobs.extend(jobs)
+        return jobs
+
+    def Run(self):
+        """Runs all the jobs, yielding each one once its results are in."""
+        if self.workers <= 1:
+            try:
+                for job in self.jobs:
+                    if job.ranges:
+                        yield self._Finish(
+                            job, [_RunJob(r) for r in job.ranges], _RunJob)
+                    else:
+                        yield _RunJob(job)
+            finally:
+                _CloseContainers()
+            return
+
+        pool = multiprocessing.Pool(self.workers, initializer=_InitWorker)
+        def run(job):
+            return pool.apply_async(_RunJob, (job,)).get()
+
+        try:
+            units = []
+            for job in self.jobs:
+                units.extend(job.ranges or [job])
+
+            pending = {}
+            for unit in sorted(units, key=lambda u: -u.size):
+                pending[id(unit)] = pool.apply_async(_RunJob, (unit,))
+
+            for job in self.jobs:
+                if job.ranges:
+                    ranges = [pending.pop(id(r)).get() for r in job.ranges]
+                    yield self._Finish(job, ranges, run)
+                else:
+                    yield pending.pop(id(job)).get()
+            pool.close()
+        except BaseException:
+            # Abandoned runs do not wait for the remaining jobs.
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _KEY_CACHE.Wipe()
@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+# Copyright 2019 Schatz Forensic Pty Ltd All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from future import standard_library
+standard_library.install_aliases()
+import io
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from pyaff4 import container
+from pyaff4 import data_store
+from pyaff4 import hashes
+from pyaff4 import lexicon
+from pyaff4 import linear_hasher
+from pyaff4 import rdfvalue
+from pyaff4 import verifier
+
+
+class VerificationSchedulerTest(unittest.TestCase):
+    filenames = [tempfile.gettempdir() + u"/aff4_test_verify_%d.aff4" % i
+                 for i in range(2)]
+    datatypes = [lexicon.HASH_SHA256, lexicon.HASH_SHA1, lexicon.HASH_MD5]
+
+    def setUp(self):
+        self.tearDown()
+        for i, filename in enumerate(self.filenames):
+            container_urn = rdfvalue.URN.FromFileName(filename)
+            with data_store.MemoryDataStore() as resolver:
+                with container.Container.createURN(resolver, container_urn) as volume:
+                    for j in range(3):
+                        data = os.urandom(1000 * (i + j + 1))
+                        hasher = linear_hasher.StreamHasher(
+                            io.BytesIO(data), self.datatypes)
+                        urn = volume.writeLogical(
+                            "/file%d" % j, hasher, len(data))
+                        hasher.Finish()
+
+                        for datatype in self.datatypes:
+                            # Corrupt the stored hash of one image.
+                            digest = hasher.getHash(datatype).hexdigest()
+                            if i == 1 and j == 2 and datatype == lexicon.HASH_SHA1:
+                                digest = "0" * len(digest)
+                            volume.resolver.Add(
+                                volume.urn, urn, rdfvalue.URN(lexicon.standard.hash),
+                                hashes.newImmutableHash(digest, datatype))
+
+    def tearDown(self):
+        for filename in self.filenames:
+            try:
+                os.unlink(filename)
+            except (IOError, OSError):
+                pass
+
+    def verify(self, workers):
+        scheduler = verifier.VerificationScheduler(workers)
+        for filename in self.filenames:
+            scheduler.AddContainer(filename)
+
+        return list(scheduler.Run())
+
+    def testVerify(self):
+        for workers in (1, 2):
+            jobs = self.verify(workers)
+            self.assertEqual(6, len(jobs))
+
+            # Results come back in the order the containers were added.
+            self.assertEqual([os.path.abspath(f) for f in self.filenames],
+                             [jobs[0].filename, jobs[3].filename])
+
+            for job in jobs:
+                self.assertIsNone(job.error)
+
+                # Hashes are reported in a fixed order.
+                self.assertEqual(["MD5", "SHA1", "SHA256"],
+                                 [result.typ for result in job.results])
+                corrupt = (job.filename == os.path.abspath(self.filenames[1])
+                           and job.name == "/file2")
+                self.assertEqual([True, not corrupt, True],
+                                 [result.valid for result in job.results])
+
+            # Workers are not left behind, nor containers in this process.
+            self.assertEqual([], multiprocessing.active_children())
+            self.assertEqual({}, verifier._OPEN_CONTAINERS)
+
+
+class SplitBlockHashTest(unittest.TestCase):
+    filename = os.path.join(os.path.dirname(__file__), u"..", u"test_images",
+                            u"AFF4Std", u"Base-Linear.aff4")
+
+    def verify(self, workers, block_range_size):
+        scheduler = verifier.VerificationScheduler(
+            workers, block_range_size=block_range_size)
+        scheduler.AddContainer(self.filename)
+        jobs = list(scheduler.Run())
+        self.assertEqual(1, len(jobs))
+        self.assertIsNone(jobs[0].error)
+        return scheduler.jobs[0], [
+            (r.typ, r.valid, r.offset) for r in jobs[0].results]
+
+    def testSplit(self):
+        job, expected = self.verify(1, verifier.BLOCK_RANGE_SIZE)
+        self.assertIsNone(job.ranges)
+
+        # The 121 blocks of the image are verified in 7 ranges.
+        job, results = self.verify(2, 20 * 32768)
+        self.assertEqual([0, 20, 40, 60, 80, 100, 120],
+                         [r.first_chunk for r in job.ranges])
+        self.assertEqual(expected, results)
+        self.assertTrue(all(valid for _, valid, _ in results))
+        self.assertEqual([], multiprocessing.active_children())
+
+
+if __name__ == '__main__':
+    unittest.main()
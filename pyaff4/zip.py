@@ -19,11 +19,14 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import range
 from builtins import object
+import bisect
+import collections
 import copy
 import logging
 import io
 import zlib
 import struct
+import threading
 import traceback
 import os
 
@@ -58,6 +61,11 @@ USE_UNICODE = True
 class UnknownZipEntity(Exception):
     pass
 
+# Where the data of a member is in the backing store.
+MemberRange = collections.namedtuple(
+    "MemberRange", ["backing_store_urn", "offset", "compress_size",
+                    "file_size", "compression_method", "crc32"])
+
 
 class EndCentralDirectory(struct_parser.CreateStruct(
         "EndCentralDirectory_t",
@@ -399,13 +407,18 @@ class FileWrapper(object):
         return self.readptr
 
     def read(self, length):
-        with self.resolver.AFF4FactoryOpen(self.file_urn) as fd:
-            fd.seek(self.slice_offset + self.readptr)
-            to_read = min(self.slice_size - self.readptr, length)
-            result = fd.read(to_read)
-            self.readptr += len(result)
+        result = self.read_at(self.readptr, length)
+        self.readptr += len(result)
+
+        return result
 
-            return result
+    def read_at(self, offset, length):
+        to_read = min(self.slice_size - offset, length)
+        if to_read <= 0:
+            return b""
+
+        with self.resolver.AFF4FactoryOpen(self.file_urn) as fd:
+            return fd.ReadAt(self.slice_offset + offset, to_read)
 
 class WritableFileWrapper(FileWrapper):
     def write(self, buf):
@@ -421,6 +434,110 @@ class WritableFileWrapper(FileWrapper):
     def flush(self):
         pass
 
+
+# The state of the inflater after out_offset bytes of output, with in_offset
+# bytes of the compressed data fed to it.
+InflateCheckpoint = collections.namedtuple(
+    "InflateCheckpoint", ["out_offset", "in_offset", "decompressor", "crc32"])
+
+
+class InflatingFileWrapper(FileWrapper):
+    """Maps a DEFLATE compressed slice from a file URN.
+
+    The data is inflated on demand, so only what is read is decompressed.
+    Like zran, the state of the inflater is saved at checkpoints about
+    checkpoint_interval bytes of output apart, and a read resumes from the
+    nearest checkpoint before it (or from where the last read stopped).
+    The number of checkpoints is bounded: when there are too many, every
+    other one is dropped and the interval doubled. Each checkpoint holds
+    the 32K inflate window and at most READ_SIZE bytes of compressed data.
+
+    The CRC32 is checked whenever the inflater reaches the end.
+    """
+    READ_SIZE = 64 * 1024
+    CHECKPOINT_INTERVAL = 1024 * 1024
+    MAX_CHECKPOINTS = 64
+
+    def __init__(self, resolver, file_urn, slice_offset, slice_size,
+                 compress_size, crc32, checkpoint_interval=CHECKPOINT_INTERVAL,
+                 max_checkpoints=MAX_CHECKPOINTS):
+        super(InflatingFileWrapper, self).__init__(
+            resolver, file_urn, slice_offset, slice_size)
+        self.compress_size = compress_size
+        self.crc32 = crc32
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.checkpoints = [InflateCheckpoint(0, 0, zlib.decompressobj(-15), 0)]
+        self.lock = threading.Lock()
+        self._Restore(self.checkpoints[0])
+
+    def _Restore(self, checkpoint):
+        self.out_offset = checkpoint.out_offset
+        self.in_offset = checkpoint.in_offset
+        self.decompressor = checkpoint.decompressor.copy()
+        self.running_crc32 = checkpoint.crc32
+
+    def _Checkpoint(self):
+        last = self.checkpoints[-1]
+        if self.out_offset < last.out_offset + self.checkpoint_interval:
+            return
+
+        self.checkpoints.append(InflateCheckpoint(
+            self.out_offset, self.in_offset, self.decompressor.copy(),
+            self.running_crc32))
+        if len(self.checkpoints) > self.max_checkpoints:
+            self.checkpoints = self.checkpoints[::2]
+            self.checkpoint_interval *= 2
+
+    def _Seek(self, offset):
+        """Moves the inflater to the nearest saved state before offset."""
+        index = bisect.bisect_right(
+            [c.out_offset for c in self.checkpoints], offset) - 1
+        checkpoint = self.checkpoints[index]
+        if self.out_offset > offset or checkpoint.out_offset > self.out_offset:
+            self._Restore(checkpoint)
+
+    def _Inflate(self, fd, max_length):
+        compressed = self.decompressor.unconsumed_tail
+        if not compressed:
+            to_read = min(self.READ_SIZE, self.compress_size - self.in_offset)
+            if to_read > 0:
+                compressed = fd.ReadAt(self.slice_offset + self.in_offset, to_read)
+                self.in_offset += len(compressed)
+
+        if not compressed or self.decompressor.eof:
+            raise IOError("Zip member is truncated or corrupt")
+
+        data = self.decompressor.decompress(compressed, max_length)
+        self.out_offset += len(data)
+        self.running_crc32 = zlib.crc32(data, self.running_crc32)
+        if (self.out_offset == self.slice_size and
+                self.running_crc32 & 0xffffffff != self.crc32):
+            raise IOError("CRC32 mismatch reading zip member")
+
+        self._Checkpoint()
+        return data
+
+    def read_at(self, offset, length):
+        to_read = min(self.slice_size - offset, length)
+        if to_read <= 0:
+            return b""
+
+        result = []
+        with self.lock:
+            with self.resolver.AFF4FactoryOpen(self.file_urn) as fd:
+                self._Seek(offset)
+                while self.out_offset < offset:
+                    self._Inflate(fd, min(offset - self.out_offset, self.READ_SIZE))
+
+                while to_read > 0:
+                    data = self._Inflate(fd, min(to_read, self.READ_SIZE))
+                    result.append(data)
+                    to_read -= len(data)
+
+        return b"".join(result)
+
+
 def DecompressBuffer(buffer):
     """Decompress using deflate a single buffer.
 
@@ -432,6 +549,77 @@ def DecompressBuffer(buffer):
     return result + decompressor.flush()
 
 
+class MemberReader(object):
+    """Reads the data of a zip member from a file object, inflating it as
+    it is read.
+
+    Only the file object is used, not the resolver, so several threads can
+    each read a member through their own file object. The CRC32 is checked
+    once the whole member has been read.
+    """
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, fd, member_range):
+        if member_range.compression_method == ZIP_DEFLATE:
+            self.decompressor = zlib.decompressobj(-15)
+        elif member_range.compression_method == ZIP_STORED:
+            self.decompressor = None
+        else:
+            raise IOError("Unsupported compression method %d" %
+                          member_range.compression_method)
+
+        self.fd = fd
+        self.member_range = member_range
+        self.compressed_left = member_range.compress_size
+        self.left = member_range.file_size
+        self.crc32 = 0
+        self.fd.seek(member_range.offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.fd.close()
+
+    def _ReadCompressed(self, length):
+        data = self.fd.read(min(length, self.compressed_left))
+        self.compressed_left -= len(data)
+        return data
+
+    def read(self, length=-1):
+        if length is None or length < 0 or length > self.left:
+            length = self.left
+
+        result = []
+        wanted = length
+        while wanted > 0:
+            if self.decompressor is None:
+                data = self._ReadCompressed(wanted)
+                stuck = not data
+            else:
+                compressed = self.decompressor.unconsumed_tail
+                if not compressed:
+                    compressed = self._ReadCompressed(self.READ_SIZE)
+                data = self.decompressor.decompress(compressed, wanted)
+                stuck = (not data and not self.compressed_left and
+                         not self.decompressor.unconsumed_tail)
+
+            if stuck:
+                raise IOError("Zip member is truncated or corrupt")
+            result.append(data)
+            wanted -= len(data)
+
+        data = b"".join(result)
+        self.left -= len(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        if self.left == 0 and self.crc32 & 0xffffffff != self.member_range.crc32:
+            raise IOError("CRC32 mismatch reading zip member")
+        return data
+
+
 class ZipFileSegment(aff4_file.FileBackedObject):
     compression_method = ZIP_STORED
 
@@ -491,9 +679,17 @@ class ZipFileSegment(aff4_file.FileBackedObject):
 
             buffer_size = zip_info.file_size
             self.length = zip_info.file_size
-            if file_header.compression_method == ZIP_DEFLATE:
+            if (file_header.compression_method == ZIP_DEFLATE and
+                    not backing_store.properties.writable):
+                # Inflate on demand so huge members are not held in memory.
+                self.compression_method = ZIP_DEFLATE
+                self.fd = InflatingFileWrapper(
+                    self.resolver, backing_store_urn, backing_store.TellRead(),
+                    buffer_size, zip_info.compress_size, zip_info.crc32)
+
+            elif file_header.compression_method == ZIP_DEFLATE:
                 # We write the entire file in a memory buffer if we need to
-                # deflate it.
+                # deflate it, as it may be modified.
                 self.compression_method = ZIP_DEFLATE
                 c_buffer = backing_store.Read(zip_info.compress_size)
                 decomp_buffer = DecompressBuffer(c_buffer)
@@ -553,6 +749,12 @@ class ZipFileSegment(aff4_file.FileBackedObject):
                 volume.RemoveMembers([self.urn])
             self.resolver.DeleteSubject(self.urn)
 
+    def ReadAt(self, offset, length):
+        if isinstance(self.fd, FileWrapper):
+            return self.fd.read_at(offset, length)
+
+        return super(ZipFileSegment, self).ReadAt(offset, length)
+
     def Reset(self):
         self.readptr = 0
 
@@ -621,11 +823,14 @@ class BasicZipFile(aff4.AFF4Volume):
             # the old, randomly selected URN.
             if not urn_string and urn:
               urn_string = urn
-            if urn_string and self.urn != urn_string and self.version != basic_zip :
-                self.resolver.DeleteSubject(self.urn)
-                self.urn.Set(utils.SmartUnicode(urn_string))
+            if urn_string and self.version != basic_zip :
+                if self.urn != urn_string:
+                    self.resolver.DeleteSubject(self.urn)
+                    self.urn = rdfvalue.URN(utils.SmartUnicode(urn_string))
 
                 # Set these triples so we know how to open the zip file again.
+                # This is done on every parse, as LoadFromURN throws away the
+                # transient triples of its first pass.
                 self.resolver.Set(self.urn, self.urn, lexicon.AFF4_TYPE, rdfvalue.URN(
                     lexicon.AFF4_ZIP_TYPE))
                 self.resolver.Set(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED, rdfvalue.URN(
@@ -987,6 +1192,97 @@ class BasicZipFile(aff4.AFF4Volume):
             zip_info.WriteFileHeader(backing_store)
             self.members[member_urn] = zip_info
 
+    def AddCompressedMember(self, member_urn, data, file_size, crc32,
+                            compression_method=ZIP_STORED):
+        """Add a new archive member from data which is already compressed.
+
+        This allows the data to be compressed on another thread, leaving
+        only the write to the caller.
+
+        Args:
+          member_urn: The new member URN to be added.
+          data: The member data, compressed with compression_method (raw
+            deflate for ZIP_DEFLATE).
+          file_size: The size of the uncompressed data.
+          crc32: The CRC32 of the uncompressed data.
+          compression_method: How the data was compressed.
+        """
+        if not self.properties.writable:
+            raise IOError("Appempt to add member to R/O Object")
+
+        if compression_method not in (ZIP_STORED, ZIP_DEFLATE):
+            raise RuntimeError("Unsupported compression method")
+
+        self.MarkDirty()
+        self.resolver.Set(lexicon.transient_graph,
+            member_urn, lexicon.AFF4_TYPE,
+            rdfvalue.URN(lexicon.AFF4_ZIP_SEGMENT_TYPE))
+        self.resolver.Set(lexicon.transient_graph, member_urn, lexicon.AFF4_STORED, self.urn)
+        self.children.add(member_urn)
+
+        backing_store_urn = self.resolver.GetUnique(lexicon.transient_graph, self.urn, lexicon.AFF4_STORED)
+        with self.resolver.AFF4FactoryOpen(backing_store_urn) as backing_store:
+            backing_store.SeekWrite(0, aff4.SEEK_END)
+
+            if LOGGER.isEnabledFor(logging.INFO):
+                LOGGER.info("Appending ZIP file header %s @ %x", member_urn, backing_store.TellWrite())
+
+            # The sizes and CRC are known up front, so the header is only
+            # written once.
+            zip_info = ZipInfo(
+                local_header_offset=backing_store.TellWrite() - self.global_offset,
+                filename=escaping.member_name_for_urn(member_urn, self.version, self.urn, use_unicode=USE_UNICODE),
+                file_size=file_size, compress_size=len(data),
+                crc32=crc32 & 0xffffffff, compression_method=compression_method)
+            zip_info.WriteFileHeader(backing_store)
+            backing_store.Write(data)
+            self.members[member_urn] = zip_info
+
+    def LocateMember(self, member_urn):
+        """Locates the data of a member in the backing store.
+
+        Returns a MemberRange, which a MemberReader can read without the
+        resolver.
+        """
+        zip_info = self.members.get(member_urn)
+        if zip_info is None:
+            raise IOError("Segment %s does not exist yet" % member_urn)
+
+        with self.resolver.AFF4FactoryOpen(self.backing_store_urn) as backing_store:
+            header_offset = zip_info.local_header_offset + self.global_offset
+            file_header = ZipFileHeader(
+                backing_store.ReadAt(header_offset, ZipFileHeader.sizeof()))
+
+            if not file_header.IsValid():
+                raise IOError("Local file header invalid!")
+
+            data_offset = (header_offset + ZipFileHeader.sizeof() +
+                           file_header.file_name_length +
+                           file_header.extra_field_len)
+            return MemberRange(self.backing_store_urn, data_offset,
+                               zip_info.compress_size, zip_info.file_size,
+                               file_header.compression_method, zip_info.crc32)
+
+    def StoredMemberRange(self, member_urn):
+        """Locates the data of a stored (uncompressed) member.
+
+        Returns a (backing store URN, offset, length) tuple, or None if the
+        member is compressed.
+        """
+        zip_info = self.members.get(member_urn)
+        if zip_info is None:
+            raise IOError("Segment %s does not exist yet" % member_urn)
+
+        if zip_info.compression_method != ZIP_STORED:
+            return None
+
+        member_range = self.LocateMember(member_urn)
+        if member_range.compression_method != ZIP_STORED:
+            return None
+
+        return (member_range.backing_store_urn, member_range.offset,
+                member_range.file_size)
+
     def RemoveMember(self, child_urn):
         self.RemoveMembers([child_urn])
 
@@ -18,6 +18,7 @@ from future import standard_library
 standard_library.install_aliases()
 import os
 import io
+import random
 import unittest
 import tempfile
 
@@ -91,6 +92,24 @@ class ZipTest(unittest.TestCase):
         with resolver.AFF4FactoryOpen(segment_urn) as segment:
             self.assertEquals(segment.Read(1000), self.data1 + self.data2)
 
+    def testMemberReader(self):
+        resolver = data_store.MemoryDataStore()
+        with zip.ZipFile.NewZipFile(resolver, version.aff4v10, self.filename_urn) as zip_file:
+            ranges = [zip_file.LocateMember(zip_file.urn.Append(self.streamed_segment)),
+                      zip_file.LocateMember(zip_file.urn.Append(self.segment_name))]
+
+        self.assertEquals(zip.ZIP_DEFLATE, ranges[0].compression_method)
+        for member_range, expected in [(ranges[0], self.data1),
+                                       (ranges[1], self.data1 + self.data2)]:
+            with zip.MemberReader(open(self.filename, "rb"), member_range) as reader:
+                self.assertEquals(expected[:4], reader.read(4))
+                self.assertEquals(expected[4:], reader.read())
+                self.assertEquals(b"", reader.read(10))
+
+            with zip.MemberReader(open(self.filename, "rb"),
+                                  member_range._replace(crc32=member_range.crc32 ^ 1)) as reader:
+                self.assertRaises(IOError, reader.read)
+
     def testSeekThrowsWhenWriting(self):
         resolver = data_store.MemoryDataStore()
         resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
@@ -112,5 +131,77 @@ class ZipTest(unittest.TestCase):
                     pass
 
 
+class InflatingFileWrapperTest(unittest.TestCase):
+    filename = tempfile.gettempdir() + "/aff4_inflatetest.zip"
+    filename_urn = rdfvalue.URN.FromFileName(filename)
+    data = b"".join(b"%08x" % (i * i) for i in range(200000))
+
+    def setUp(self):
+        with data_store.MemoryDataStore() as resolver:
+            resolver.Set(lexicon.transient_graph, self.filename_urn, lexicon.AFF4_STREAM_WRITE_MODE,
+                         rdfvalue.XSDString("truncate"))
+
+            with zip.ZipFile.NewZipFile(resolver, version.aff4v10, self.filename_urn) as zip_file:
+                with zip_file.CreateMember(zip_file.urn.Append("large")) as member:
+                    member.compression_method = zip.ZIP_DEFLATE
+                    member.WriteStream(io.BytesIO(self.data))
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def wrapper(self, resolver, crc32=None, **kwargs):
+        with zip.ZipFile.NewZipFile(resolver, version.aff4v10, self.filename_urn) as zip_file:
+            member_range = zip_file.LocateMember(zip_file.urn.Append("large"))
+
+        self.assertEqual(zip.ZIP_DEFLATE, member_range.compression_method)
+        self.assertTrue(member_range.compress_size < len(self.data) // 2)
+        if crc32 is None:
+            crc32 = member_range.crc32
+        return zip.InflatingFileWrapper(
+            resolver, member_range.backing_store_urn, member_range.offset,
+            member_range.file_size, member_range.compress_size, crc32, **kwargs)
+
+    def testRandomReads(self):
+        with data_store.MemoryDataStore() as resolver:
+            fd = self.wrapper(resolver, checkpoint_interval=16 * 1024,
+                              max_checkpoints=8)
+            rand = random.Random(1)
+            for _ in range(100):
+                offset = rand.randrange(len(self.data) + 100)
+                length = rand.randrange(100000)
+                self.assertEqual(self.data[offset:offset + length],
+                                 fd.read_at(offset, length))
+
+            # Checkpoints are thinned out to stay within the limit.
+            self.assertTrue(len(fd.checkpoints) <= 8)
+            self.assertTrue(fd.checkpoint_interval > 16 * 1024)
+            self.assertEqual(0, fd.checkpoints[0].out_offset)
+
+            # Reads resume from the nearest checkpoint.
+            fd.read_at(len(self.data) - 10, 10)
+            fd.read_at(len(self.data) // 2, 10)
+            self.assertTrue(fd.out_offset - len(self.data) // 2 <=
+                            fd.checkpoint_interval + fd.READ_SIZE)
+
+            fd.seek(0)
+            self.assertEqual(self.data, fd.read(len(self.data) + 1))
+
+    def testBadCRC(self):
+        with data_store.MemoryDataStore() as resolver:
+            fd = self.wrapper(resolver, crc32=0)
+            self.assertEqual(self.data[:100], fd.read_at(0, 100))
+            self.assertRaises(IOError, fd.read_at, len(self.data) - 100, 100)
+
+    def testSegment(self):
+        with data_store.MemoryDataStore() as resolver:
+            with zip.ZipFile.NewZipFile(resolver, version.aff4v10, self.filename_urn) as zip_file:
+                with zip_file.OpenMember(zip_file.urn.Append("large")) as segment:
+                    self.assertTrue(isinstance(segment.fd, zip.InflatingFileWrapper))
+                    self.assertEqual(len(self.data), segment.Size())
+                    self.assertEqual(self.data[1000000:1000010], segment.ReadAt(1000000, 10))
+                    segment.SeekRead(0)
+                    self.assertEqual(self.data, segment.Read(len(self.data)))
+
+
 if __name__ == '__main__':
     unittest.main()